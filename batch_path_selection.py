@@ -0,0 +1,183 @@
+### Batched path selection ###
+# A simulation takes many samples of the same user model, and so in a given
+# minute many clients typically need a new circuit for the same request, such
+# as covering the same port need or carrying the same stream. A
+# BatchPathSelector chooses the exits and middles of all of those circuits
+# together with NumPy. Each round draws one candidate for every circuit still
+# pending from the alias table of the weighted relays (see
+# weighted_sampling.py), applies the relay checks to all of the candidates as
+# array operations, and redraws only the candidates that were rejected. Family
+# checks, which need the relays' family lists, are still made one at a time,
+# but only when both relays declare a family. Guards are chosen by each client
+# from its own guard list.
+# Paths are drawn from the same distribution as by pathsim.create_circuit().
+# However, the draws are made by a NumPy random generator shared by all of the
+# samples, which create_circuits() seeds from the simulation seed and the
+# network state, and so a batched simulation does not output the same paths
+# as an unbatched simulation with the same seed.
+# NumPy is only needed for batched simulation.
+
+from random import randint
+import pathsim
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class BatchPathSelector(object):
+    """Selects the exits and middles of many circuits at once in one network
+    state. Relays are identified by their index in relays."""
+
+    def __init__(self, cons_rel_stats, descriptors, seed=None):
+        """
+        Inputs:
+            cons_rel_stats: (dict) relay keys and relay status vals
+            descriptors: (dict or RelayTable) relay keys and descriptor vals,
+                including those of any guards not in the consensus
+            seed: (int) seed of the NumPy random generator, below 2**32,
+                drawn at random if None
+        """
+        if (numpy is None):
+            raise ImportError('Batched path selection requires NumPy.')
+        self.descriptors = descriptors
+        self.relays = list(cons_rel_stats.keys())
+        self.relay_index = dict((relay, i) for i, relay in\
+            enumerate(self.relays))
+        num_relays = len(self.relays)
+        self.running = numpy.zeros(num_relays, dtype=bool)
+        self.fast = numpy.zeros(num_relays, dtype=bool)
+        self.stable = numpy.zeros(num_relays, dtype=bool)
+        self.has_family = numpy.zeros(num_relays, dtype=bool)
+        # /16 prefixes of relay addresses
+        self.subnets = numpy.zeros(num_relays, dtype=numpy.int32)
+        for i, relay in enumerate(self.relays):
+            flag_mask = cons_rel_stats[relay].flag_mask
+            self.running[i] = bool(flag_mask & pathsim.RUNNING_MASK)
+            self.fast[i] = bool(flag_mask & pathsim.FAST_MASK)
+            self.stable[i] = bool(flag_mask & pathsim.STABLE_MASK)
+            self.has_family[i] = (len(descriptors[relay].family) > 0)
+            self.subnets[i] = descriptors[relay].subnet_16
+        self.hibernating = numpy.zeros(num_relays, dtype=bool)
+        # alias tables as arrays, by id() of the AliasSampler
+        self.tables = {}
+        # results of exit checks (-1 if not yet known) by key of exit check
+        self.exits_accepted = {}
+        if (seed == None):
+            seed = randint(0, 2**32-1)
+        self.rng = numpy.random.RandomState(seed)
+
+    def set_hibernating(self, hibernating_status):
+        """Updates hibernating relays from dict hibernating_status."""
+        self.hibernating = numpy.fromiter(\
+            (bool(hibernating_status.get(relay, False))\
+                for relay in self.relays),
+            dtype=bool, count=len(self.relays))
+
+    def table(self, weighted_nodes):
+        """Returns (prob, alias, items) arrays of the alias table of
+        AliasSampler weighted_nodes, with items given as relay indices."""
+        entry = self.tables.get(id(weighted_nodes))
+        if (entry is None) or (entry[0] is not weighted_nodes):
+            # keep a reference to the sampler so that its id isn't reused
+            entry = (weighted_nodes,
+                numpy.array(weighted_nodes.prob, dtype=float),
+                numpy.array(weighted_nodes.alias, dtype=numpy.intp),
+                numpy.array([self.relay_index[item] for item in\
+                    weighted_nodes.items], dtype=numpy.intp))
+            self.tables[id(weighted_nodes)] = entry
+        return entry[1:]
+
+    def draw(self, weighted_nodes, num):
+        """Returns array of indices of num relays drawn independently from
+        AliasSampler weighted_nodes."""
+        prob, alias, items = self.table(weighted_nodes)
+        u = self.rng.random_sample(num) * len(prob)
+        column = numpy.minimum(u.astype(numpy.intp), len(prob)-1)
+        keep = (u - column) < prob[column]
+        return items[numpy.where(keep, column, alias[column])]
+
+    def select_exits(self, weighted_exits, num, accept=None,
+        accept_key=None):
+        """Returns array of indices of num exits drawn from weighted_exits
+        that are not hibernating.
+        Inputs:
+            weighted_exits: (AliasSampler) weighted exits
+            num: (int) number of exits to select
+            accept: function of exit relay checking if it is suitable,
+                or None if all weighted exits are suitable
+            accept_key: hashable key identifying the check made by accept,
+                under which its results are kept for this network state
+        """
+        if (accept is not None):
+            accepted = self.exits_accepted.get(accept_key)
+            if (accepted is None):
+                accepted = numpy.empty(len(self.relays), dtype=numpy.int8)
+                accepted.fill(-1)
+                self.exits_accepted[accept_key] = accepted
+        exits = numpy.empty(num, dtype=numpy.intp)
+        pending = numpy.arange(num)
+        while (len(pending) > 0):
+            candidates = self.draw(weighted_exits, len(pending))
+            ok = ~self.hibernating[candidates]
+            if (accept is not None):
+                for i in numpy.unique(candidates[accepted[candidates] < 0]):
+                    accepted[i] = bool(accept(self.relays[i]))
+                ok &= (accepted[candidates] > 0)
+            exits[pending[ok]] = candidates[ok]
+            pending = pending[~ok]
+        return exits
+
+    def select_middles(self, weighted_middles, fast, stable, exits, guards,
+        same_family):
+        """Returns array of indices of middles drawn from weighted_middles
+        for circuits with the given exits and guards, applying the checks of
+        pathsim.middle_filter() and rejecting hibernating relays.
+        Inputs:
+            weighted_middles: (AliasSampler) weighted middles
+            fast: (bool) middles must be fast
+            stable: (bool) middles must be stable
+            exits: array of relay indices of the circuits' exits
+            guards: list of relays that are the circuits' guards, which need
+                not be in the consensus
+            same_family: function of two relays checking if the relays
+                are in the same family
+        """
+        num = len(exits)
+        guard_indices = numpy.array([self.relay_index.get(guard, -1)\
+            for guard in guards], dtype=numpy.intp)
+        guard_subnets = numpy.zeros(num, dtype=numpy.int32)
+        guard_family = numpy.zeros(num, dtype=bool)
+        for j, guard in enumerate(guards):
+            guard_subnets[j] = self.descriptors[guard].subnet_16
+            guard_family[j] = (len(self.descriptors[guard].family) > 0)
+        exit_subnets = self.subnets[exits]
+        exit_family = self.has_family[exits]
+        allowed = self.running & ~self.hibernating
+        if fast:
+            allowed &= self.fast
+        if stable:
+            allowed &= self.stable
+
+        middles = numpy.empty(num, dtype=numpy.intp)
+        pending = numpy.arange(num)
+        while (len(pending) > 0):
+            candidates = self.draw(weighted_middles, len(pending))
+            subnets = self.subnets[candidates]
+            ok = allowed[candidates] &\
+                (candidates != exits[pending]) &\
+                (candidates != guard_indices[pending]) &\
+                (subnets != exit_subnets[pending]) &\
+                (subnets != guard_subnets[pending])
+            check_family = ok & self.has_family[candidates] &\
+                (exit_family[pending] | guard_family[pending])
+            for k in numpy.flatnonzero(check_family):
+                j = pending[k]
+                middle = self.relays[candidates[k]]
+                if (exit_family[j] and\
+                        same_family(self.relays[exits[j]], middle)) or\
+                    (guard_family[j] and same_family(guards[j], middle)):
+                    ok[k] = False
+            middles[pending[ok]] = candidates[ok]
+            pending = pending[~ok]
+        return middles
@@ -7,7 +7,7 @@
 #     If avg stored latency is > l=500ms, don't use. Ping after use and store.
 
 import pathsim
-from random import choice
+import random
 import stem
 import collections
 from models import *
@@ -20,14 +20,14 @@ min_ping = 500 # minimum ping to use circuit in milliseconds
 
 
 def ping_circuit(client_ip, guard_node, middle_node, exit_node,\
-    cons_rel_stats, descriptors, congmodel, pdelmodel):    
+    cons_rel_stats, descriptors, congmodel, pdelmodel, rng=random):
     ping_time = 0
     for node, coef in ((guard_node, 2), (middle_node, 2), (exit_node, 1)):
         rel_stat = cons_rel_stats[node]
         is_exit = (stem.Flag.EXIT in rel_stat.flags)
         is_guard = (stem.Flag.GUARD in rel_stat.flags)
         ping_time += coef*(congmodel.get_congestion(node,\
-            rel_stat.bandwidth, is_exit, is_guard))
+            rel_stat.bandwidth, is_exit, is_guard, rng))
 
     # ca-tor subtracts minrtt from its pings to isolate congestion
     # so we dont actually want to include prop delay
@@ -48,7 +48,7 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
     guards, circ_time, circ_fast, circ_stable, circ_internal, circ_ip,
     circ_port, congmodel, pdelmodel, weighted_exits=None,
     exits_exact=False, weighted_middles=None, weighted_guards=None,
-    callbacks=None):
+    callbacks=None, rng=random):
     """Creates path for requested circuit based on the input consensus
     statuses and descriptors. Uses congestion-aware path selection.
     Inputs:
@@ -68,14 +68,16 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
         circ_port: (int) desired TCP port (None if not known)
         congmodel: congestion model
         pdelmodel: propagation delay model
-        weighted_exits: (list) (middle, cum_weight) pairs for exit position
+        weighted_exits: (AliasSampler) weighted exits, see get_weighted_nodes()
         exits_exact: (bool) Is weighted_exits exact or does it need rechecking?
             weighed_exits is special because exits are chosen first and thus
             don't depend on the other circuit positions, and so potentially are        
             precomputed exactly.
-        weighted_middles: (list) (middle, cum_weight) pairs for middle position
-        weighted_guards: (list) (middle, cum_weight) pairs for middle position
+        weighted_middles: (AliasSampler) weighted middles
+        weighted_guards: (AliasSampler) weighted guards
         callbacks: object w/ method circuit_creation(circuit)        
+        rng: (random.Random) random number generator of the requesting
+            client, see pathsim.sample_rng()
     Output:
         circuit: (dict) a newly created circuit with keys
             'time': (int) seconds from time zero
@@ -103,7 +105,7 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
             exit_node = pathsim.select_exit_node(cons_bw_weights,
                 cons_bwweightscale, cons_rel_stats, descriptors, circ_fast,
                 circ_stable, circ_internal, circ_ip, circ_port, weighted_exits,
-                exits_exact)
+                exits_exact, rng)
     #        exit_node = pathsim.select_weighted_node(weighted_exits)
             if (not hibernating_status[exit_node]):
                 break
@@ -126,8 +128,8 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
             circ_guards = pathsim.get_guards_for_circ(cons_bw_weights,\
                 cons_bwweightscale, cons_rel_stats, descriptors,\
                 circ_fast, circ_stable, guards,\
-                exit_node, circ_time, weighted_guards)   
-            guard_node = choice(circ_guards)
+                exit_node, circ_time, weighted_guards, rng)
+            guard_node = rng.choice(circ_guards)
             if (hibernating_status[guard_node]):
                 if (not guards[guard_node]['made_contact']):
                     if pathsim._testing:
@@ -165,7 +167,7 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
         while (True):
             middle_node = pathsim.select_middle_node(cons_bw_weights,\
                 cons_bwweightscale, cons_rel_stats, descriptors, circ_fast,\
-                circ_stable, exit_node, guard_node, weighted_middles)
+                circ_stable, exit_node, guard_node, weighted_middles, rng)
             if (not hibernating_status[middle_node]):
                 break
             if pathsim._testing:
@@ -194,7 +196,7 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
     if pathsim._testing: print 'Doing {0} circuit pings on creation... '.format(num_pings_create),
     for i in xrange(num_pings_create):
         cum_ping_time += ping_circuit(client_ip, guard_node, middle_node,\
-            exit_node, cons_rel_stats, descriptors, congmodel, pdelmodel)
+            exit_node, cons_rel_stats, descriptors, congmodel, pdelmodel, rng)
     avg_ping_time = float(cum_ping_time)/num_pings_create
     if pathsim._testing: print "ave congestion is {0}".format(avg_ping_time)
 
@@ -295,8 +297,9 @@ at {0}'.format(stream['time']))
                 descriptors, hibernating_status, guards, stream['time'], True,
                 stable, False, stream['ip'], stream['port'],
                 congmodel, pdelmodel,
-                stream_weighted_exits, False,
-                weighted_middles, weighted_guards, callbacks)
+                stream_weighted_exits, True,
+                weighted_middles, weighted_guards, callbacks,
+                client_state['rng'])
         elif (stream['type'] == 'resolve'):
             new_circ = create_circuit(cons_rel_stats,
                 cons_valid_after, cons_fresh_until,
@@ -305,7 +308,8 @@ at {0}'.format(stream['time']))
                 False, False, None, None,
                 congmodel, pdelmodel,
                 stream_weighted_exits, True,
-                weighted_middles, weighted_guards, callbacks)
+                weighted_middles, weighted_guards, callbacks,
+                client_state['rng'])
         else:
             raise ValueError('Unrecognized stream in client_assign_stream(): \
 {0}'.format(stream['type']))        
@@ -331,7 +335,8 @@ stream.'.format(stream['time']))
     exit_node = stream_assigned['path'][2]
     for i in xrange(num_pings_use):
         cum_ping_time += ping_circuit(client_ip, guard_node, middle_node,\
-            exit_node, cons_rel_stats, descriptors, congmodel, pdelmodel)
+            exit_node, cons_rel_stats, descriptors, congmodel, pdelmodel,
+            client_state['rng'])
     stream_assigned['avg_ping'] = float(cum_ping_time)/num_pings_use
     if pathsim._testing: print "ave congestion is {0}".format(stream_assigned['avg_ping'])
     
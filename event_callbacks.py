@@ -6,6 +6,13 @@
 #     set_sample_id(id): updates ID of current sample being executed
 #     circuit_creation(circuit): called on successful circuit creation on circuit dict
 #     stream_assignment(stream, circuit): called on assignment of stream to circuit
+# pathsim.create_circuits() also calls start_segment(key) before each pass over
+# the clients if the callbacks object has it, with keys that increase over the
+# simulation (see parallel_simulation.py). The classes here don't need it.
+# Relays in circuit paths and the keys of cons_rel_stats and descriptors are relay IDs
+# (see relay_tables.py) or fingerprints, depending on the simulator. Either way,
+# descriptors[relay].fingerprint and descriptors[relay].address give the fingerprint and
+# IP of a relay.
 ###
 
 import sys
@@ -76,11 +83,13 @@ class PrintStreamAssignments(object):
                 exit_prefix = 'FFFFFFFFFFFFFFFFFFFFFFFFFFFFFF'
                 guard_bad = False
                 exit_bad = False
-                if (circuit['path'][0][0:30] == guard_prefix) or\
-                    (circuit['path'][0][0:30] == exit_prefix):
+                guard_fprint = self.descriptors[circuit['path'][0]].fingerprint
+                exit_fprint = self.descriptors[circuit['path'][2]].fingerprint
+                if (guard_fprint[0:30] == guard_prefix) or\
+                    (guard_fprint[0:30] == exit_prefix):
                     guard_bad = True
-                if (circuit['path'][2][0:30] == guard_prefix) or\
-                    (circuit['path'][2][0:30] == exit_prefix):
+                if (exit_fprint[0:30] == guard_prefix) or\
+                    (exit_fprint[0:30] == exit_prefix):
                     exit_bad = True
                 compromise_code = 0
                 if (guard_bad and exit_bad):
@@ -145,9 +154,9 @@ class PrintStreamAssignmentsAdvRelays(object):
 
         guard_bad = False
         exit_bad = False
-        if (circuit['path'][0] in self.adv_relays):
+        if (self.descriptors[circuit['path'][0]].fingerprint in self.adv_relays):
             guard_bad = True
-        if (circuit['path'][2] in self.adv_relays):
+        if (self.descriptors[circuit['path'][2]].fingerprint in self.adv_relays):
             exit_bad = True
         compromise_code = 0
         if (guard_bad and exit_bad):
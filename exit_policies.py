@@ -0,0 +1,291 @@
+### Compiled exit policies ###
+# Parsing a stem ExitPolicy from its string form is slow, and network state
+# files contain an exit policy for every relay in every hour. A
+# CompiledExitPolicy holds everything the simulator asks of an exit policy in
+# a compact form that pickles without stem objects:
+#   - port-interval tables answering the strict (can_exit_to_port), loose
+#     (might_exit_to_port) and reject-star checks
+#   - the policy rules as (is_accept, address type, masked address, mask,
+#     min_port, max_port) tuples for checks against an exact IP and port
+# A stem ExitPolicy is only built if one is explicitly requested.
+# Compiled policies are interned by their string form, so relays and hours
+# sharing a policy share a single object. The port-interval tables are
+# searched once per policy and port, after which the strict and loose answers
+# for that port are looked up directly.
+# Each interned policy also gets a small integer ID (policy_id), which
+# identifies its class of relays sharing that policy, so that checks of many
+# relays (e.g. pathsim.filter_exits()) can be made once per class.
+
+from bisect import bisect_right
+import socket
+import struct
+from stem.exit_policy import ExitPolicy
+
+# address types in compiled rules, None is a wildcard
+IPV4 = 4
+IPV6 = 6
+
+# maximum number of (address, port) results cached per policy
+CAN_EXIT_TO_CACHE_SIZE = 4096
+
+# interned CompiledExitPolicy objects by policy string
+_compiled_policies = {}
+# interned CompiledExitPolicy objects by policy strings that stem writes
+# differently, which aren't given policy IDs of their own
+_policy_aliases = {}
+
+
+def address_to_int(address):
+    """Returns (address type, integer value) of an IPv4 or IPv6 address."""
+    try:
+        return (IPV4, struct.unpack('>I', socket.inet_pton(socket.AF_INET,
+            address))[0])
+    except socket.error:
+        pass
+    try:
+        high, low = struct.unpack('>QQ', socket.inet_pton(socket.AF_INET6,
+            address.lstrip('[').rstrip(']')))
+        return (IPV6, (high << 64) | low)
+    except socket.error:
+        raise ValueError('\'{0}\' isn\'t a valid IPv4 or IPv6 address'.\
+            format(address))
+
+
+def compile_rule(rule):
+    """Returns compiled tuple for stem ExitPolicyRule, or None if stem never
+    matches the rule against a destination."""
+    if getattr(rule, '_skip_rule', False):
+        return None
+    if rule.is_address_wildcard():
+        return (rule.is_accept, None, 0, 0, rule.min_port, rule.max_port)
+    addr_type, addr = address_to_int(str(rule.address))
+    if (rule.get_masked_bits() is not None):
+        width = 32 if (addr_type == IPV4) else 128
+        mask = ((1 << width) - 1) ^ ((1 << (width-rule.get_masked_bits())) - 1)
+    else:
+        mask = address_to_int(str(rule.get_mask()))[1]
+    return (rule.is_accept, addr_type, addr & mask, mask, rule.min_port,
+        rule.max_port)
+
+
+def rules_can_exit_to_port(rules, port):
+    """Strict port check against stem rules, see pathsim.can_exit_to_port."""
+    for rule in rules:
+        if (port >= rule.min_port) and\
+                (port <= rule.max_port): # assumes full range for wildcard port
+            if (rule.is_address_wildcard()) or\
+                (rule.get_masked_bits() == 0):
+                if rule.is_accept:
+                    return True
+                else:
+                    return False
+    return True # default accept if no rule matches
+
+
+def rules_might_exit_to_port(rules, port):
+    """Loose port check against stem rules, see pathsim.might_exit_to_port."""
+    for rule in rules:
+        if (port >= rule.min_port) and\
+                (port <= rule.max_port): # assumes full range for wildcard port
+            if rule.is_accept:
+                return True
+            else:
+                if (rule.is_address_wildcard()) or\
+                    (rule.get_masked_bits() == 0):
+                    return False
+    return True # default accept if no rule matches
+
+
+def rules_are_reject_star(rules):
+    """Reject-star check against stem rules, see
+    pathsim.policy_is_reject_star. Note that get_masked_bits is compared
+    uncalled, as it always has been, so only address wildcards count."""
+    for rule in rules:
+        if rule.is_accept:
+            return False
+        elif (((rule.min_port <= 1) and (rule.max_port == 65535)) or\
+                (rule.is_port_wildcard())) and\
+            ((rule.is_address_wildcard()) or (rule.get_masked_bits == 0)):
+            return True
+    return True
+
+
+def port_table(rules, port_check):
+    """Returns (starts, values) such that port_check(rules, port) is
+    values[i] for the largest i with starts[i] <= port."""
+    boundaries = set([0])
+    for rule in rules:
+        boundaries.add(rule.min_port)
+        if (rule.max_port < 65535):
+            boundaries.add(rule.max_port+1)
+    starts = []
+    values = []
+    for start in sorted(boundaries):
+        value = port_check(rules, start)
+        if (not values) or (values[-1] != value):
+            starts.append(start)
+            values.append(value)
+    return (tuple(starts), tuple(values))
+
+
+class CompiledExitPolicy(object):
+    """Exit policy compiled from a stem ExitPolicy.
+    Use compile_exit_policy() rather than constructing directly."""
+
+    def __init__(self, policy_str, rules, exiting_allowed, strict_ports,
+        loose_ports, reject_star):
+        self.policy_str = policy_str
+        self.rules = rules
+        self.exiting_allowed = exiting_allowed
+        self.strict_ports = strict_ports
+        self.loose_ports = loose_ports
+        self.reject_star = reject_star
+        # ID among interned policies, or None if not interned
+        self.policy_id = None
+        # answers of port checks by port, filled as ports are checked
+        self._strict_port_answers = {}
+        self._loose_port_answers = {}
+        self._can_exit_to_cache = {}
+        self._stem_policy = None
+
+    @staticmethod
+    def from_stem(policy):
+        """Returns CompiledExitPolicy for stem ExitPolicy."""
+        rules = list(policy)
+        compiled_rules = []
+        for rule in rules:
+            compiled_rule = compile_rule(rule)
+            if (compiled_rule is not None):
+                compiled_rules.append(compiled_rule)
+        return CompiledExitPolicy(str(policy), tuple(compiled_rules),
+            policy.is_exiting_allowed(),
+            port_table(rules, rules_can_exit_to_port),
+            port_table(rules, rules_might_exit_to_port),
+            rules_are_reject_star(rules))
+
+    def __reduce__(self):
+        return (_restore_exit_policy, (self.policy_str, self.rules,
+            self.exiting_allowed, self.strict_ports, self.loose_ports,
+            self.reject_star))
+
+    def __str__(self):
+        return self.policy_str
+
+    def to_stem(self):
+        """Returns stem ExitPolicy, which is built on first request."""
+        if (self._stem_policy is None):
+            self._stem_policy = ExitPolicy(*self.policy_str.split(', '))
+        return self._stem_policy
+
+    def can_exit_to_port(self, port):
+        """Returns if relay will exit to port for any IP, as in Tor's
+        compare_unknown_tor_addr_to_addr_policy()."""
+        try:
+            return self._strict_port_answers[port]
+        except KeyError:
+            pass
+        starts, values = self.strict_ports
+        answer = values[bisect_right(starts, port)-1]
+        self._strict_port_answers[port] = answer
+        return answer
+
+    def might_exit_to_port(self, port):
+        """Returns if relay will exit to port for *some* IP."""
+        try:
+            return self._loose_port_answers[port]
+        except KeyError:
+            pass
+        starts, values = self.loose_ports
+        answer = values[bisect_right(starts, port)-1]
+        self._loose_port_answers[port] = answer
+        return answer
+
+    def is_reject_star(self):
+        """Returns if policy rejects all exiting, as Tor's
+        policy_is_reject_star()."""
+        return self.reject_star
+
+    def can_exit_to(self, address=None, port=None):
+        """Returns if exiting to address and port is allowed, with the same
+        semantics as stem's ExitPolicy.can_exit_to() (non-strict)."""
+        key = (address, port)
+        try:
+            return self._can_exit_to_cache[key]
+        except KeyError:
+            pass
+        result = self._can_exit_to(address, port)
+        if (len(self._can_exit_to_cache) >= CAN_EXIT_TO_CACHE_SIZE):
+            self._can_exit_to_cache.clear()
+        self._can_exit_to_cache[key] = result
+        return result
+
+    def _can_exit_to(self, address, port):
+        if (not self.exiting_allowed):
+            return False
+        if (address is not None):
+            addr_type, addr = address_to_int(address)
+        if (port is not None) and ((port <= 0) or (port > 65535)):
+            raise ValueError('\'{0}\' isn\'t a valid port'.format(port))
+        for is_accept, rule_type, rule_addr, rule_mask, min_port, max_port\
+            in self.rules:
+            fuzzy_match = False
+            if (rule_type is not None):
+                if (address is None):
+                    fuzzy_match = True
+                elif (rule_type != addr_type) or\
+                    ((addr & rule_mask) != rule_addr):
+                    continue
+            if not ((min_port in (0, 1)) and (max_port == 65535)):
+                if (port is None):
+                    fuzzy_match = True
+                elif (port < min_port) or (port > max_port):
+                    continue
+            if (not fuzzy_match) or is_accept:
+                return is_accept
+        return True # default accept if no rule matches
+
+
+def _restore_exit_policy(policy_str, rules, exiting_allowed, strict_ports,
+    loose_ports, reject_star):
+    """Unpickles CompiledExitPolicy, returning interned copy if present."""
+    if (policy_str in _compiled_policies):
+        return _compiled_policies[policy_str]
+    policy = CompiledExitPolicy(policy_str, rules, exiting_allowed,
+        strict_ports, loose_ports, reject_star)
+    return intern_policy(policy)
+
+
+def intern_policy(policy):
+    """Interns CompiledExitPolicy under its string form, giving it the next
+    policy ID, and returns it."""
+    policy.policy_id = len(_compiled_policies)
+    _compiled_policies[policy.policy_str] = policy
+    return policy
+
+
+def compile_exit_policy(policy):
+    """Returns interned CompiledExitPolicy for policy, which may be a
+    CompiledExitPolicy, a stem ExitPolicy, or the string form of either.
+    Policies compile with the semantics of their string form, which is what
+    network state files have always stored."""
+    if isinstance(policy, CompiledExitPolicy):
+        return policy
+    policy_str = str(policy)
+    if (policy_str in _compiled_policies):
+        return _compiled_policies[policy_str]
+    if (policy_str in _policy_aliases):
+        return _policy_aliases[policy_str]
+    # compile from the string form, as stem drops the IPv6-only marker
+    # of ignored rules when writing out the policy
+    stem_policy = ExitPolicy(*policy_str.split(', '))
+    compiled = CompiledExitPolicy.from_stem(stem_policy)
+    # stem may write the policy differently than given (e.g. masks as
+    # prefix lengths), and it is interned under the string stem writes
+    if (compiled.policy_str in _compiled_policies):
+        compiled = _compiled_policies[compiled.policy_str]
+    else:
+        compiled._stem_policy = stem_policy
+        intern_policy(compiled)
+    if (policy_str != compiled.policy_str):
+        _policy_aliases[policy_str] = compiled
+    return compiled
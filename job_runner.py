@@ -0,0 +1,556 @@
+### Running simulations as work units on one or many hosts ###
+# An experiment is described by a spec, a JSON object giving the options of
+# "pathsim.py simulate" (see SPEC_KEYS and write_spec_template()), the total
+# number of samples, and the number of samples per work unit. submit() splits
+# the samples into work units, each a contiguous range of sample IDs, and
+# queues them in the experiment directory. Every unit is simulated with
+# the same seed, and because each sample draws from its own random stream
+# (see pathsim.sample_rng()), the units together give the output lines of a
+# single simulation of all of the samples, with globally unique sample IDs.
+# run() simulates queued units with a local pool of processes. Any number of
+# hosts sharing the experiment directory (e.g. over NFS) can run it at the
+# same time, because units are claimed by renaming their files, which is
+# atomic. A unit whose simulation fails is requeued until it has been tried
+# max_attempts times. A running unit's file is touched regularly, and a unit
+# whose file hasn't been touched for stale_timeout seconds, e.g. because its
+# host crashed, is requeued by the other runners.
+# merge() checks that every unit is done, merges their output into one log
+# with the lines in the order of a single simulation's output, i.e. by time
+# and then by sample ID, and writes a manifest of the units.
+# Experiment directory layout:
+#   spec.json: the spec, with its seed filled in
+#   units/{pending,running,done,failed}/unit-NNNNN.json: the state of each unit
+#   output/unit-NNNNN.out, unit-NNNNN.err: simulation output of each unit
+#   simulate.[name].[num_samples]-samples.out: merged output
+#   merge_manifest.json: the units in the merged output
+
+import argparse
+import errno
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import os.path
+import random
+import socket
+import subprocess
+import sys
+import time
+
+UNIT_STATES = ['pending', 'running', 'done', 'failed']
+
+# spec keys that give options of the simulate command, with their defaults
+SPEC_KEYS = {
+    'nsf_dir':'out/network-state-files',
+    'start':None,
+    'end':None,
+    'trace_file':'in/users2-processed.traces.pickle',
+    'user_model':'simple=600',
+    'output_class':None,
+    'format':'relay-adv',
+    'adv_guard_cons_bw':0,
+    'adv_exit_cons_bw':0,
+    'adv_time':0,
+    'num_adv_guards':0,
+    'num_adv_exits':0,
+    'other_network_modifier':None,
+    'num_guards':None,
+    'guard_expiration':None,
+    'prefetch':None,
+    'shared_cache':None,
+    'workers':None,
+    'loglevel':'WARNING'}
+
+# spec keys of the experiment, with their defaults
+EXPERIMENT_KEYS = {
+    'name':None,
+    'num_samples':None,
+    'samples_per_unit':None,
+    'seed':None,
+    'pathalg':'tor',
+    'pathalg_args':[],
+    'max_attempts':3}
+
+
+def read_json(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write_json(filename, obj):
+    """Writes obj to filename atomically, by writing a temporary file and
+    renaming it."""
+    tmp_filename = '{0}.tmp.{1}.{2}'.format(filename, socket.gethostname(),
+        os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.rename(tmp_filename, filename)
+
+
+def write_spec_template(filename):
+    """Writes spec with default values to filename, to be edited."""
+    spec = dict(SPEC_KEYS)
+    spec.update(EXPERIMENT_KEYS)
+    spec['name'] = 'experiment'
+    spec['num_samples'] = 5000
+    spec['samples_per_unit'] = 500
+    write_json(filename, spec)
+
+
+def check_spec(spec):
+    """Returns spec with defaults filled in, raising ValueError if it is
+    invalid."""
+    for key in spec:
+        if (key not in SPEC_KEYS) and (key not in EXPERIMENT_KEYS):
+            raise ValueError('Unknown spec key: {0}'.format(key))
+    checked = dict(SPEC_KEYS)
+    checked.update(EXPERIMENT_KEYS)
+    checked.update(spec)
+    if (checked['name'] == None):
+        raise ValueError('Spec must give name.')
+    for key in ('num_samples', 'samples_per_unit', 'max_attempts'):
+        if (not isinstance(checked[key], int)) or (checked[key] < 1):
+            raise ValueError('Spec must give positive integer {0}.'.\
+                format(key))
+    if (checked['pathalg'] not in ('tor', 'cat')):
+        raise ValueError('Unsupported pathalg: {0}'.format(checked['pathalg']))
+    return checked
+
+
+def unit_name(unit_id):
+    return 'unit-{0:05d}'.format(unit_id)
+
+
+def unit_filename(exp_dir, state, unit_id):
+    return os.path.join(exp_dir, 'units', state,
+        '{0}.json'.format(unit_name(unit_id)))
+
+
+def output_filename(exp_dir, unit_id, extension):
+    return os.path.join(exp_dir, 'output', '{0}.{1}'.\
+        format(unit_name(unit_id), extension))
+
+
+def merged_filename(exp_dir, spec):
+    return os.path.join(exp_dir, 'simulate.{0}.{1}-samples.out'.\
+        format(spec['name'], spec['num_samples']))
+
+
+def list_units(exp_dir, state):
+    """Returns sorted IDs of the units in state."""
+    unit_ids = []
+    for filename in os.listdir(os.path.join(exp_dir, 'units', state)):
+        if filename.startswith('unit-') and filename.endswith('.json'):
+            unit_ids.append(int(filename[5:-5]))
+    unit_ids.sort()
+    return unit_ids
+
+
+def move_unit(exp_dir, unit_id, from_state, to_state, unit=None):
+    """Moves unit from from_state to to_state, then updating its file to
+    unit if given. Returns False if the unit wasn't in from_state, e.g.
+    because another runner moved it first."""
+    filename = unit_filename(exp_dir, to_state, unit_id)
+    try:
+        os.rename(unit_filename(exp_dir, from_state, unit_id), filename)
+    except OSError as e:
+        if (e.errno == errno.ENOENT):
+            return False
+        raise
+    if (unit is not None):
+        write_json(filename, unit)
+    return True
+
+
+def submit(spec, exp_dir):
+    """Creates experiment directory exp_dir and queues the work units of the
+    experiment given by spec. A seed is drawn if spec doesn't give one."""
+    spec = check_spec(spec)
+    if (spec['seed'] == None):
+        spec['seed'] = random.SystemRandom().randint(0, 2**32-1)
+    if os.path.exists(os.path.join(exp_dir, 'spec.json')):
+        raise ValueError('Experiment already submitted in {0}'.\
+            format(exp_dir))
+    for state in UNIT_STATES:
+        state_dir = os.path.join(exp_dir, 'units', state)
+        if (not os.path.exists(state_dir)):
+            os.makedirs(state_dir)
+    output_dir = os.path.join(exp_dir, 'output')
+    if (not os.path.exists(output_dir)):
+        os.makedirs(output_dir)
+    unit_id = 0
+    for first_sample in xrange(0, spec['num_samples'],
+        spec['samples_per_unit']):
+        num_samples = min(spec['samples_per_unit'],
+            spec['num_samples'] - first_sample)
+        write_json(unit_filename(exp_dir, 'pending', unit_id),
+            {'id':unit_id, 'first_sample':first_sample,
+            'num_samples':num_samples, 'attempts':0, 'errors':[]})
+        unit_id += 1
+    # written last, so that runners only start once all units are queued
+    write_json(os.path.join(exp_dir, 'spec.json'), spec)
+    return unit_id
+
+
+def simulate_command(spec, unit, python, pathsim_path):
+    """Returns command line simulating unit of experiment given by spec."""
+    command = [python, pathsim_path, 'simulate']
+    for key in sorted(SPEC_KEYS):
+        if (spec[key] != None):
+            command.extend(['--{0}'.format(key), str(spec[key])])
+    command.extend(['--num_samples', str(unit['num_samples']),
+        '--first_sample', str(unit['first_sample']),
+        '--seed', str(spec['seed']), spec['pathalg']])
+    command.extend(spec['pathalg_args'])
+    return command
+
+
+def requeue_stale_units(exp_dir, stale_timeout):
+    """Requeues running units whose files haven't been touched for
+    stale_timeout seconds, counting the lost run as a failed attempt."""
+    spec = read_json(os.path.join(exp_dir, 'spec.json'))
+    for unit_id in list_units(exp_dir, 'running'):
+        filename = unit_filename(exp_dir, 'running', unit_id)
+        try:
+            unit = read_json(filename)
+            # renaming a file to claim it changes its ctime
+            age = time.time() - max(os.path.getmtime(filename),
+                os.path.getctime(filename))
+        except (IOError, OSError, ValueError):
+            # moved or being rewritten by another runner
+            continue
+        if (age > stale_timeout):
+            unit['attempts'] += 1
+            unit['errors'].append('no progress from {0} for {1:.0f} s'.\
+                format(unit.get('host'), age))
+            if (unit['attempts'] < spec['max_attempts']):
+                to_state = 'pending'
+            else:
+                to_state = 'failed'
+            if move_unit(exp_dir, unit_id, 'running', to_state, unit):
+                print('Requeued stale {0} as {1}.'.format(unit_name(unit_id),
+                    to_state))
+
+
+def run_unit(exp_dir, spec, unit_id, python, pathsim_path,
+    heartbeat_interval):
+    """Simulates claimed unit, and moves it to done, back to pending, or to
+    failed."""
+    running_filename = unit_filename(exp_dir, 'running', unit_id)
+    try:
+        unit = read_json(running_filename)
+    except IOError:
+        # unit was requeued as stale already
+        return
+    unit['host'] = socket.gethostname()
+    unit['pid'] = os.getpid()
+    write_json(running_filename, unit)
+
+    out_filename = output_filename(exp_dir, unit_id, 'out')
+    err_filename = output_filename(exp_dir, unit_id, 'err')
+    tmp_out_filename = '{0}.tmp.{1}.{2}'.format(out_filename, unit['host'],
+        unit['pid'])
+    command = simulate_command(spec, unit, python, pathsim_path)
+    start_time = time.time()
+    with open(tmp_out_filename, 'w') as out_file:
+        with open(err_filename, 'w') as err_file:
+            process = subprocess.Popen(command, stdout=out_file,
+                stderr=err_file, cwd=os.path.dirname(pathsim_path))
+            last_heartbeat = start_time
+            while (process.poll() is None):
+                time.sleep(1)
+                if (time.time() - last_heartbeat < heartbeat_interval):
+                    continue
+                last_heartbeat = time.time()
+                try:
+                    os.utime(running_filename, None)
+                except OSError:
+                    # unit was requeued as stale, so leave it to its new run
+                    process.kill()
+                    process.wait()
+                    os.remove(tmp_out_filename)
+                    return
+    unit['elapsed'] = time.time() - start_time
+    unit['attempts'] += 1
+    if (process.returncode == 0):
+        # any run of the unit gives the same output, so a run finishing
+        # after the unit was requeued can keep its output
+        os.rename(tmp_out_filename, out_filename)
+        move_unit(exp_dir, unit_id, 'running', 'done', unit)
+        print('Finished {0} in {1:.0f} s.'.format(unit_name(unit_id),
+            unit['elapsed']))
+    else:
+        os.remove(tmp_out_filename)
+        with open(err_filename) as err_file:
+            err_tail = err_file.readlines()[-5:]
+        unit['errors'].append('exit status {0} on {1}: {2}'.\
+            format(process.returncode, unit['host'], ''.join(err_tail)))
+        if (unit['attempts'] < spec['max_attempts']):
+            to_state = 'pending'
+        else:
+            to_state = 'failed'
+        move_unit(exp_dir, unit_id, 'running', to_state, unit)
+        print('{0} failed with exit status {1}, moved to {2}.'.\
+            format(unit_name(unit_id), process.returncode, to_state))
+
+
+def runner(exp_dir, python, pathsim_path, stale_timeout, heartbeat_interval,
+    poll_interval):
+    """Claims and simulates units until no unit is pending or running."""
+    spec = read_json(os.path.join(exp_dir, 'spec.json'))
+    while True:
+        claimed = None
+        for unit_id in list_units(exp_dir, 'pending'):
+            if move_unit(exp_dir, unit_id, 'pending', 'running'):
+                # touch the claimed unit at once, so that other runners
+                # don't take it for stale by its time in pending
+                try:
+                    os.utime(unit_filename(exp_dir, 'running', unit_id),
+                        None)
+                except OSError:
+                    continue
+                claimed = unit_id
+                break
+        if (claimed is not None):
+            run_unit(exp_dir, spec, claimed, python, pathsim_path,
+                heartbeat_interval)
+        elif list_units(exp_dir, 'running'):
+            # wait for units running elsewhere, which may be requeued
+            time.sleep(poll_interval)
+            requeue_stale_units(exp_dir, stale_timeout)
+        else:
+            break
+
+
+def run(exp_dir, processes=1, python=sys.executable, stale_timeout=600,
+    heartbeat_interval=10, poll_interval=10):
+    """Simulates the queued units of experiment in exp_dir with the given
+    number of local processes, until every unit is done or failed.
+    Inputs:
+        exp_dir: experiment directory created by submit()
+        processes: (int) number of units to simulate at once on this host
+        python: Python interpreter with which to run pathsim.py
+        stale_timeout: (int) seconds after which a running unit whose file
+            hasn't been touched is requeued
+        heartbeat_interval: (int) seconds between touches of the file of a
+            running unit, which must be well below stale_timeout
+        poll_interval: (int) seconds between checks of units running
+            elsewhere once none is pending
+    """
+    if (not os.path.exists(os.path.join(exp_dir, 'spec.json'))):
+        raise ValueError('No experiment submitted in {0}'.format(exp_dir))
+    pathsim_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'pathsim.py')
+    requeue_stale_units(exp_dir, stale_timeout)
+    args = (exp_dir, python, pathsim_path, stale_timeout, heartbeat_interval,
+        poll_interval)
+    if (processes == 1):
+        runner(*args)
+    else:
+        ps = []
+        for i in xrange(processes):
+            p = multiprocessing.Process(target=runner, args=args)
+            p.start()
+            ps.append(p)
+        for p in ps:
+            p.join()
+
+
+def status(exp_dir):
+    """Returns dict of the number of units in each state."""
+    return dict((state, len(list_units(exp_dir, state)))\
+        for state in UNIT_STATES)
+
+
+def file_sha256(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def line_order_key(line):
+    """Returns (time, sample ID) of simulation output line, or None if line
+    doesn't start with a sample ID and a time, e.g. if it is a header."""
+    fields = line.split('\t', 2)
+    if (len(fields) < 2):
+        return None
+    try:
+        return (float(fields[1]), int(fields[0]))
+    except ValueError:
+        return None
+
+
+def ordered_lines(lines):
+    """Yields (time, index, sample ID, line) for the simulation output lines
+    of a unit, where index counts the earlier lines of the sample with the
+    same time. A single simulation writes the lines of each stream for all
+    of the samples before the next stream, and so merging these tuples of all
+    units gives the order of its output, as long as every sample writes a line
+    for every stream."""
+    last = {}
+    for line in lines:
+        key = line_order_key(line)
+        if (key == None):
+            raise ValueError('Output line without sample and time: {0}'.\
+                format(line.rstrip('\n')))
+        line_time, sample_id = key
+        last_time, index = last.get(sample_id, (None, 0))
+        if (line_time == last_time):
+            index += 1
+        else:
+            index = 0
+        last[sample_id] = (line_time, index)
+        yield (line_time, index, sample_id, line)
+
+
+def merge(exp_dir):
+    """Merges the output of the units of the experiment in exp_dir in the
+    order of a single simulation's output, writing the header line of the
+    output once, and writes a manifest of the merged units. Raises ValueError
+    if not every unit is done.
+    Output:
+        merged_filename: name of file of merged output
+    """
+    spec = read_json(os.path.join(exp_dir, 'spec.json'))
+    unit_counts = status(exp_dir)
+    if (unit_counts['done'] == 0) or (unit_counts['pending'] > 0) or\
+        (unit_counts['running'] > 0) or (unit_counts['failed'] > 0):
+        raise ValueError('Not all units are done: {0}'.format(', '.join(\
+            '{0} {1}'.format(unit_counts[state], state)\
+                for state in UNIT_STATES)))
+    units = [read_json(unit_filename(exp_dir, 'done', unit_id))\
+        for unit_id in list_units(exp_dir, 'done')]
+    units.sort(key=lambda unit: unit['first_sample'])
+    next_sample = 0
+    for unit in units:
+        if (unit['first_sample'] != next_sample):
+            raise ValueError('Units don\'t cover samples from {0}'.\
+                format(next_sample))
+        next_sample += unit['num_samples']
+    if (next_sample != spec['num_samples']):
+        raise ValueError('Units cover {0} samples instead of {1}'.\
+            format(next_sample, spec['num_samples']))
+
+    manifest = {'name':spec['name'], 'seed':spec['seed'],
+        'num_samples':spec['num_samples'], 'spec':spec, 'units':[]}
+    out_filename = merged_filename(exp_dir, spec)
+    tmp_out_filename = '{0}.tmp'.format(out_filename)
+    unit_files = []
+    try:
+        header = None
+        unit_lines = []
+        for unit in units:
+            unit_file = open(output_filename(exp_dir, unit['id'], 'out'))
+            unit_files.append(unit_file)
+            first_line = unit_file.readline()
+            if (first_line == ''):
+                continue
+            if (line_order_key(first_line) == None):
+                if (header == None):
+                    header = first_line
+                unit_lines.append(ordered_lines(unit_file))
+            else:
+                unit_lines.append(ordered_lines(\
+                    itertools.chain([first_line], unit_file)))
+        with open(tmp_out_filename, 'w') as out_file:
+            if (header != None):
+                out_file.write(header)
+            for line_time, index, sample_id, line in\
+                heapq.merge(*unit_lines):
+                out_file.write(line)
+    finally:
+        for unit_file in unit_files:
+            unit_file.close()
+    for unit in units:
+        unit_out_filename = output_filename(exp_dir, unit['id'], 'out')
+        manifest['units'].append({'id':unit['id'],
+            'first_sample':unit['first_sample'],
+            'num_samples':unit['num_samples'],
+            'output':os.path.relpath(unit_out_filename, exp_dir),
+            'sha256':file_sha256(unit_out_filename),
+            'attempts':unit['attempts'],
+            'host':unit.get('host'),
+            'elapsed':unit.get('elapsed')})
+    os.rename(tmp_out_filename, out_filename)
+    manifest['output'] = os.path.relpath(out_filename, exp_dir)
+    manifest['sha256'] = file_sha256(out_filename)
+    write_json(os.path.join(exp_dir, 'merge_manifest.json'), manifest)
+    return out_filename
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(\
+        description='Run TorPS simulations as work units on one or many hosts')
+    subparsers = parser.add_subparsers(help='job runner commands',
+        dest='subparser')
+
+    template_parser = subparsers.add_parser('template',
+        help='write experiment spec with default values, to be edited')
+    template_parser.add_argument('spec_file',
+        help='JSON file to which to write spec')
+
+    submit_parser = subparsers.add_parser('submit',
+        help='create experiment directory and queue the work units of an \
+experiment spec')
+    submit_parser.add_argument('spec_file', help='JSON file of experiment spec')
+    submit_parser.add_argument('exp_dir', help='experiment directory')
+
+    run_parser = subparsers.add_parser('run',
+        help='simulate queued work units until all are done or failed, which \
+may be run on every host sharing the experiment directory')
+    run_parser.add_argument('exp_dir', help='experiment directory')
+    run_parser.add_argument('--processes', type=int, default=1,
+        help='number of work units to simulate at once on this host')
+    run_parser.add_argument('--python', default=sys.executable,
+        help='Python interpreter with which to run pathsim.py, e.g. pypy')
+    run_parser.add_argument('--stale_timeout', type=int, default=600,
+        help='seconds without progress after which a running work unit is \
+requeued, e.g. because its host crashed')
+
+    status_parser = subparsers.add_parser('status',
+        help='print number of work units in each state')
+    status_parser.add_argument('exp_dir', help='experiment directory')
+
+    merge_parser = subparsers.add_parser('merge',
+        help='merge the output of all work units and write a manifest')
+    merge_parser.add_argument('exp_dir', help='experiment directory')
+
+    args = parser.parse_args()
+
+    if (args.subparser == 'template'):
+        write_spec_template(args.spec_file)
+    elif (args.subparser == 'submit'):
+        try:
+            num_units = submit(read_json(args.spec_file), args.exp_dir)
+        except ValueError as e:
+            submit_parser.error(str(e))
+        print('Queued {0} work units in {1}.'.format(num_units, args.exp_dir))
+    elif (args.subparser == 'run'):
+        if (args.processes < 1):
+            run_parser.error('--processes must be positive')
+        if (args.stale_timeout < 60):
+            run_parser.error('--stale_timeout must be at least 60')
+        try:
+            run(args.exp_dir, args.processes, args.python, args.stale_timeout)
+        except ValueError as e:
+            run_parser.error(str(e))
+        unit_counts = status(args.exp_dir)
+        print('{0} work units done, {1} failed.'.format(unit_counts['done'],
+            unit_counts['failed']))
+        if (unit_counts['failed'] > 0):
+            sys.exit(1)
+    elif (args.subparser == 'status'):
+        unit_counts = status(args.exp_dir)
+        print(', '.join('{0} {1}'.format(unit_counts[state], state)\
+            for state in UNIT_STATES))
+    elif (args.subparser == 'merge'):
+        try:
+            out_filename = merge(args.exp_dir)
+        except ValueError as e:
+            merge_parser.error(str(e))
+        print('Merged output into {0}.'.format(out_filename))
@@ -1,5 +1,5 @@
 from bisect import bisect_left
-from random import random, randint
+import random
 import cPickle as pickle
 import datetime
 
@@ -171,15 +171,16 @@ class CongestionProfile(object):
             self.total += w
             self.cumul.append(self.total)
 
-    def get_congestion(self):
-        '''returns milliseconds of congestion'''
+    def get_congestion(self, rng=random):
+        '''returns milliseconds of congestion, drawn using random number
+        generator rng'''
         # probabilistically choose a bin by sampling the bin weights CDF
-        x = random() * self.total
+        x = rng.random() * self.total
         i = bisect_left(self.cumul, x)
         # draw a uniform value from its range
         low = self.breakpoints[i]
         high = low + self.binsize
-        return randint(low, high) / 1000.0
+        return rng.randint(low, high) / 1000.0
 
 class CongestionModel(object):
     """
@@ -213,10 +214,11 @@ class CongestionModel(object):
                 dist = d
         return match
 
-    def get_congestion(self, name, weight, isexit=False, isguard=False):
+    def get_congestion(self, name, weight, isexit=False, isguard=False,
+        rng=random):
         if isguard and not isexit: isexit = True
         if name not in self.assigned: self.assigned[name] = self.find_match(weight, isexit, isguard)
-        return self.assigned[name].get_congestion()
+        return self.assigned[name].get_congestion(rng)
 
 class PropagationDelayModel(object):
     """
@@ -6,6 +6,25 @@ import pathsim
 
 class Enum(tuple): __getattr__ = tuple.index
 
+# reserved (non-public) IPv4 ranges from which adversary relays are given
+# their own /16 subnets, as (first octet, first second octet, number of /16s):
+# 10.1.0.0 to 10.255.0.0, then 100.64.0.0/10 and 198.18.0.0/15
+ADV_ADDRESS_RANGES = [(10, 1, 255), (100, 64, 64), (198, 18, 2)]
+MAX_ADV_RELAYS = sum(num_subnets for first_octet, second_octet, num_subnets\
+    in ADV_ADDRESS_RANGES)
+
+def adv_address(num):
+    """Returns IPv4 address of adversary relay number num (from 1), which is
+    in its own reserved /16 subnet. Raises ValueError if num exceeds the
+    number of such subnets."""
+    if (num < 1) or (num > MAX_ADV_RELAYS):
+        raise ValueError('Adversary relays must number from 1 to {0} to have distinct reserved /16 subnets, not {1}'.format(MAX_ADV_RELAYS, num))
+    i = num - 1
+    for first_octet, second_octet, num_subnets in ADV_ADDRESS_RANGES:
+        if (i < num_subnets):
+            return '{0}.{1}.0.0'.format(first_octet, second_octet + i)
+        i -= num_subnets
+
 ### Class inserting adversary relays ###
 class AdversaryInsertion(object):
 
@@ -25,7 +44,7 @@ class AdversaryInsertion(object):
             # create descriptor
             hibernating = False
             family = {}
-            address = '10.'+num_str+'.0.0' # avoid /16 conflicts
+            address = adv_address(i+1) # avoid /16 conflicts
             exit_policy = ExitPolicy('reject *:*')
             ntor_onion_key = num_str # indicate ntor support w/ val != None
             self.adv_descriptors[fingerprint] = pathsim.ServerDescriptor(fingerprint,
@@ -48,7 +67,7 @@ class AdversaryInsertion(object):
             # create descriptor
             hibernating = False
             family = {}
-            address = '10.'+str(num_adv_guards+i+1)+'.0.0' # avoid /16 conflicts
+            address = adv_address(num_adv_guards+i+1) # avoid /16 conflicts
             exit_policy = ExitPolicy('accept *:*')
             ntor_onion_key = num_str # indicate ntor support w/ val != None
             self.adv_descriptors[fingerprint] = pathsim.ServerDescriptor(fingerprint,
@@ -69,10 +88,12 @@ class AdversaryInsertion(object):
         # (cf. dirvote.c:networkstatus_compute_consensus())
         G = M = E = D = T = 0
         for fprint, rel_stat in cons_rel_stats.iteritems():
-            if (Flag.RUNNING not in rel_stat.flags):
+            flag_mask = rel_stat.flag_mask
+            if (not flag_mask & pathsim.RUNNING_MASK):
                 continue
-            is_guard = Flag.GUARD in rel_stat.flags
-            is_exit = (Flag.EXIT in rel_stat.flags) and (Flag.BADEXIT not in rel_stat.flags)
+            is_guard = bool(flag_mask & pathsim.GUARD_MASK)
+            is_exit = bool(flag_mask & pathsim.EXIT_MASK) and\
+                (not flag_mask & pathsim.BADEXIT_MASK)
 
             T += rel_stat.bandwidth            
             if (is_guard and not is_exit):
@@ -336,12 +357,18 @@ class RaiseGuardConsBWThreshold(object):
 
         num_guard_flags = 0
         num_guard_flags_removed = 0
-        for fprint, rel_stat in network_state.cons_rel_stats.iteritems():
-            if (Flag.GUARD in rel_stat.flags):
+        for fprint, rel_stat in network_state.cons_rel_stats.items():
+            if (rel_stat.flag_mask & pathsim.GUARD_MASK):
                 num_guard_flags += 1
                 if (rel_stat.bandwidth < self.guard_bw_threshold):
                     num_guard_flags_removed += 1
-                    rel_stat.flags = filter(lambda x: x != Flag.GUARD, rel_stat.flags)
+                    # replace rather than modify entry, which may be shared
+                    # with other network states
+                    network_state.cons_rel_stats[fprint] =\
+                        pathsim.RouterStatusEntry(fprint, rel_stat.nickname,
+                            filter(lambda x: x != Flag.GUARD, rel_stat.flags),
+                            rel_stat.bandwidth,
+                            rel_stat.flag_mask & ~pathsim.GUARD_MASK)
         if self.testing:
             print('Removed {} guard flags out of {}'.format(num_guard_flags_removed,
                 num_guard_flags))
@@ -0,0 +1,88 @@
+### Shared cache of decoded network states ###
+# Parallel simulations over the same network state files each unpickle every
+# hour (and apply delta files) themselves. A SharedNetworkStateCache instead
+# keeps each hour as a columnar network state file (see
+# network_state_formats.py) in a directory shared by the processes on a
+# host, ideally on a memory-backed filesystem such as /dev/shm. An hour is
+# decoded and written to the cache by the first process to need it, while
+# any others needing it wait on its lock, and every process then reads it
+# through a read-only memory map, so the file pages are shared among them.
+# The relays and descriptors of the network states read are views that read
+# their values from the mapped entry (see network_state_formats.py), so the
+# values are held once per host rather than decoded by every process, and no
+# process reads and unpickles the source files (and applies delta files)
+# once an hour is cached. Each process still holds a small view object and
+# its fingerprint for each relay.
+# Cache entries are named by the source file and its size and modification
+# time, so reprocessed files get new entries. The cache directory may be
+# deleted whenever no simulation is using it.
+
+import fcntl
+import hashlib
+import os
+import network_state_formats
+
+
+class SharedNetworkStateCache(object):
+    """Reads network state files through a shared cache directory of
+    columnar files. Used in place of a network_state_formats
+    NetworkStateReader."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if (not os.path.exists(cache_dir)):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # another process created it first
+                if (not os.path.isdir(cache_dir)):
+                    raise
+        # reads the network state files to be cached
+        self.reader = network_state_formats.NetworkStateReader()
+
+    def entry_path(self, ns_file):
+        """Returns path of cache entry for network state file ns_file."""
+        stat = os.stat(ns_file)
+        key = hashlib.md5('{0}:{1}:{2}'.format(os.path.realpath(ns_file),
+            stat.st_size, stat.st_mtime)).hexdigest()[:16]
+        return os.path.join(self.cache_dir, '{0}-{1}'.format(\
+            os.path.basename(ns_file), key))
+
+    def add(self, ns_file):
+        """Ensures network state file ns_file is in the cache.
+        Output:
+            path: path of cache entry, or ns_file itself if it is already
+                a columnar file
+        """
+        if network_state_formats.is_columnar_file(ns_file):
+            return ns_file
+        path = self.entry_path(ns_file)
+        if os.path.exists(path):
+            return path
+        lock_file = open(path + '.lock', 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # another process may have added it while we waited
+            if (not os.path.exists(path)):
+                network_state = self.reader.read(ns_file)
+                tmp_path = '{0}.tmp{1}'.format(path, os.getpid())
+                network_state_formats.write_columnar_network_state(tmp_path,
+                    network_state.cons_valid_after,
+                    network_state.cons_fresh_until,
+                    network_state.cons_bw_weights,
+                    network_state.cons_bwweightscale,
+                    network_state.cons_rel_stats,
+                    network_state.descriptors,
+                    network_state.hibernating_statuses)
+                os.rename(tmp_path, path)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        return path
+
+    def read(self, ns_file):
+        """Returns pathsim.NetworkState of network state file ns_file, read
+        from the cache after adding it if necessary, whose relays and
+        descriptors read their values from the mapped cache entry."""
+        return network_state_formats.read_columnar_network_state(\
+            self.add(ns_file))
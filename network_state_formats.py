@@ -0,0 +1,638 @@
+### Alternative on-disk formats for network state files ###
+# Columnar format:
+#   The default network state file is three back-to-back pickles (consensus,
+#   descriptors, hibernating statuses). A columnar file instead stores each
+#   relay attribute as a fixed-width column so that it can be decoded straight
+#   out of a memory-mapped file. Only relays with a descriptor are stored, as
+#   only those are used in simulation. Reading a file gives a network state
+#   whose relays and descriptors are views (ColumnarRelayStatus and
+#   ColumnarDescriptor) that read each value from the mapped columns when it
+#   is requested, so the values stay in the file pages, which are shared by
+#   all processes mapping the file, rather than being decoded into objects
+#   of each process. Layout (little-endian):
+#     header: magic, version, #relays, #bw weights, #hibernating statuses,
+#         #strings, valid_after, fresh_until, bwweightscale (-1 if absent)
+#     bw weights: (4-char name, value) pairs
+#     relay columns, one entry per relay, sorted by fingerprint:
+#         fingerprints (20 raw bytes), consensus nicknames (19 bytes),
+#         descriptor nicknames (19 bytes), consensus bandwidths (uint32),
+#         flag bitmasks (uint32, see pathsim.RELAY_FLAGS), IPv4 addresses
+#         (uint32), descriptor bits (uint8), and family, exit policy and ntor
+#         onion key references (uint32 into the string table)
+#     hibernating statuses: (time, relay index, hibernating) triples
+#     string table: (#strings+1) uint32 offsets, then the string bytes
+#   Exit policies are stored as pickled exit_policies.CompiledExitPolicy
+#   objects. Family and exit policy strings are interned, so each distinct
+#   value is stored once per file. Views return the same interned family
+#   and policy objects for equal strings, which are decoded once per file
+#   and once per process, respectively.
+#   A pickled view refers to its file by path (e.g. when a network state is
+#   sent to worker processes), so the file must exist when it is unpickled.
+# Delta format:
+#   Consecutive network states share nearly all relays and descriptors. A
+#   delta archive stores periodic keyframes, which are ordinary (pickle)
+#   network state files, and in between them delta files that hold only
+#   the changes from the network state file for the previous hour. A delta
+#   file is DELTA_MAGIC followed by a pickled NetworkStateDelta. Deltas are
+#   taken over the relays and descriptors used in simulation, i.e. relays
+#   with descriptors. The base of a delta is named by its filename and is
+#   in the same directory, which a keyframe at the start of each month
+#   ensures. NetworkStateReader applies deltas in place to the state it has
+#   already read, and otherwise reads back to the most recent keyframe.
+# Index:
+#   process writes an index of the network state files in each output
+#   directory, which lets simulate find the files in a period, and the
+#   period's start and end, without opening any network state file. Each
+#   hour has its own file, so entries give the filename rather than an
+#   offset. The index is INDEX_NAME in the directory and is a pickled list
+#   of (valid_after, fresh_until, number of relays, filename) entries in
+#   time order.
+
+import binascii
+import cPickle as pickle
+import mmap
+import os.path
+import socket
+import struct
+import pathsim
+
+COLUMNAR_MAGIC = 'TORPSCOL'
+COLUMNAR_VERSION = 2
+DELTA_MAGIC = 'TORPSDLT'
+INDEX_NAME = '.network_state_index'
+
+_header = struct.Struct('<8sIIIIIqqq')
+_weight = struct.Struct('<4sq')
+_status = struct.Struct('<qIB')
+_uint = struct.Struct('<I')
+
+# reference value for a missing string (i.e. no ntor onion key)
+NO_STRING = 0xFFFFFFFF
+
+# bits in the descriptor bits column
+DESC_HIBERNATING = 1
+
+# (name, width in bytes) of per-relay columns, in file order
+_relay_columns = (('fingerprints', 20), ('nicknames', 19),
+    ('desc_nicknames', 19), ('bandwidths', 4), ('flags', 4),
+    ('addresses', 4), ('desc_bits', 1), ('families', 4), ('policies', 4),
+    ('ntor_keys', 4))
+
+
+def _section_offsets(num_relays, num_weights, num_statuses, num_strings):
+    """Returns dict of byte offsets of each section of a columnar file."""
+    offsets = {}
+    offset = _header.size
+    offsets['weights'] = offset
+    offset += num_weights * _weight.size
+    for name, width in _relay_columns:
+        offsets[name] = offset
+        offset += num_relays * width
+    offsets['statuses'] = offset
+    offset += num_statuses * _status.size
+    offsets['string_offsets'] = offset
+    offset += (num_strings + 1) * _uint.size
+    offsets['strings'] = offset
+    return offsets
+
+
+def ip_to_int(address):
+    """Returns dotted-quad IPv4 address as an integer."""
+    return struct.unpack('>I', socket.inet_aton(address))[0]
+
+
+def int_to_ip(ip):
+    """Returns integer IPv4 address in dotted-quad form."""
+    return socket.inet_ntoa(struct.pack('>I', ip))
+
+
+def is_columnar_file(path):
+    """Returns if file at path is a columnar network state file."""
+    with open(path, 'rb') as f:
+        return (f.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC)
+
+
+def is_delta_file(path):
+    """Returns if file at path is a network state delta file."""
+    with open(path, 'rb') as f:
+        return (f.read(len(DELTA_MAGIC)) == DELTA_MAGIC)
+
+
+def write_columnar_network_state(path, valid_after, fresh_until, bw_weights,
+    bwweightscale, relays, descriptors, hibernating_statuses):
+    """Writes network state as columnar file.
+    Inputs:
+        path: output filename
+        valid_after: (int) timestamp of consensus valid_after
+        fresh_until: (int) timestamp of consensus fresh_until
+        bw_weights: (dict) consensus bandwidth weights
+        bwweightscale: (int) consensus bwweightscale, None if absent
+        relays: (dict) fingerprint keys and pathsim.RouterStatusEntry vals
+        descriptors: (dict) fingerprint keys and pathsim.ServerDescriptor vals
+        hibernating_statuses: list of (time, fingerprint, hibernating) triples
+    """
+    fprints = sorted(fprint for fprint in relays if fprint in descriptors)
+    relay_idx = dict((fprint, i) for i, fprint in enumerate(fprints))
+
+    # intern strings
+    strings = []
+    string_refs = {}
+    def string_ref(s):
+        if (s is None):
+            return NO_STRING
+        if (s not in string_refs):
+            string_refs[s] = len(strings)
+            strings.append(s)
+        return string_refs[s]
+
+    columns = dict((name, []) for name, width in _relay_columns)
+    for fprint in fprints:
+        rel_stat = relays[fprint]
+        desc = descriptors[fprint]
+        columns['fingerprints'].append(binascii.unhexlify(fprint))
+        columns['nicknames'].append(struct.pack('19s',
+            str(rel_stat.nickname)))
+        columns['desc_nicknames'].append(struct.pack('19s',
+            str(desc.nickname)))
+        columns['bandwidths'].append(_uint.pack(rel_stat.bandwidth))
+        columns['flags'].append(_uint.pack(
+            pathsim.flags_to_mask(rel_stat.flags)))
+        columns['addresses'].append(_uint.pack(
+            ip_to_int(str(desc.address))))
+        desc_bits = 0
+        if desc.hibernating:
+            desc_bits |= DESC_HIBERNATING
+        columns['desc_bits'].append(chr(desc_bits))
+        family = ' '.join(sorted(str(member) for member in desc.family))
+        columns['families'].append(_uint.pack(string_ref(family)))
+        columns['policies'].append(_uint.pack(string_ref(pickle.dumps(
+            desc.compiled_exit_policy, pickle.HIGHEST_PROTOCOL))))
+        if (desc.ntor_onion_key is None):
+            ntor_key = None
+        else:
+            ntor_key = str(desc.ntor_onion_key)
+        columns['ntor_keys'].append(_uint.pack(string_ref(ntor_key)))
+
+    statuses = []
+    for t, fprint, hibernating in hibernating_statuses:
+        if (fprint not in relay_idx):
+            raise ValueError('Hibernating status for relay without descriptor: {0}'.format(fprint))
+        statuses.append(_status.pack(t, relay_idx[fprint], hibernating))
+
+    string_offsets = [0]
+    for s in strings:
+        string_offsets.append(string_offsets[-1] + len(s))
+
+    if (bwweightscale is None):
+        bwweightscale = -1
+    with open(path, 'wb') as f:
+        f.write(_header.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, len(fprints),
+            len(bw_weights), len(statuses), len(strings), valid_after,
+            fresh_until, bwweightscale))
+        for name in sorted(bw_weights):
+            f.write(_weight.pack(str(name), bw_weights[name]))
+        for name, width in _relay_columns:
+            f.write(''.join(columns[name]))
+        f.write(''.join(statuses))
+        f.write(struct.pack('<{0}I'.format(len(string_offsets)),
+            *string_offsets))
+        f.write(''.join(strings))
+
+
+# compiled exit policies by their pickled form in columnar files, so that
+# each is unpickled once per process rather than once per file
+_policies_by_pickle = {}
+
+
+class ColumnarNetworkState(object):
+    """Read-only view of a memory-mapped columnar network state file.
+    Values are read directly from the mapping rather than from a copy of the
+    file contents. to_network_state() gives views of its relays."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.num_relays, self.num_weights,
+            self.num_statuses, self.num_strings, self.valid_after,
+            self.fresh_until, bwweightscale) = _header.unpack_from(self.mm, 0)
+        if (magic != COLUMNAR_MAGIC):
+            raise ValueError('Not a columnar network state file: {0}'.\
+                format(path))
+        if (version != COLUMNAR_VERSION):
+            raise ValueError('Unsupported columnar version {0} in {1}'.\
+                format(version, path))
+        if (bwweightscale < 0):
+            self.bwweightscale = None
+        else:
+            self.bwweightscale = bwweightscale
+        self.offsets = _section_offsets(self.num_relays, self.num_weights,
+            self.num_statuses, self.num_strings)
+        self.string_offsets = struct.unpack_from('<{0}I'.format(\
+            self.num_strings+1), self.mm, self.offsets['string_offsets'])
+        # decoded families and exit policies by string reference
+        self.families = {}
+        self.policies = {}
+
+    def __reduce__(self):
+        return (ColumnarNetworkState, (self.path,))
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def column(self, name):
+        """Returns tuple of values in the given relay column."""
+        width = dict(_relay_columns)[name]
+        offset = self.offsets[name]
+        if (width == 4):
+            return struct.unpack_from('<{0}I'.format(self.num_relays),
+                self.mm, offset)
+        elif (width == 1):
+            return struct.unpack_from('<{0}B'.format(self.num_relays),
+                self.mm, offset)
+        else:
+            return struct.unpack_from('<' + '{0}s'.format(width) *\
+                self.num_relays, self.mm, offset)
+
+    def fingerprints(self):
+        """Returns tuple of relay fingerprints in hex."""
+        return tuple(binascii.hexlify(fprint).upper() for fprint in\
+            self.column('fingerprints'))
+
+    def string(self, ref):
+        """Returns string from string table, None for NO_STRING."""
+        if (ref == NO_STRING):
+            return None
+        start = self.offsets['strings'] + self.string_offsets[ref]
+        end = self.offsets['strings'] + self.string_offsets[ref+1]
+        return self.mm[start:end]
+
+    def uint(self, name, i):
+        """Returns value of relay i in uint32 column name."""
+        return _uint.unpack_from(self.mm, self.offsets[name] + 4*i)[0]
+
+    def fingerprint(self, i):
+        """Returns fingerprint in hex of relay i."""
+        start = self.offsets['fingerprints'] + 20*i
+        return binascii.hexlify(self.mm[start:start+20]).upper()
+
+    def nickname(self, i, name='nicknames'):
+        """Returns nickname of relay i in nickname column name."""
+        start = self.offsets[name] + 19*i
+        return self.mm[start:start+19].rstrip('\0')
+
+    def hibernating(self, i):
+        """Returns if descriptor of relay i is hibernating."""
+        return bool(ord(self.mm[self.offsets['desc_bits'] + i]) &\
+            DESC_HIBERNATING)
+
+    def family(self, i):
+        """Returns frozenset of family entries of relay i."""
+        ref = self.uint('families', i)
+        family = self.families.get(ref)
+        if (family is None):
+            family = frozenset(self.string(ref).split())
+            self.families[ref] = family
+        return family
+
+    def compiled_exit_policy(self, i):
+        """Returns interned CompiledExitPolicy of relay i."""
+        ref = self.uint('policies', i)
+        policy = self.policies.get(ref)
+        if (policy is None):
+            policy_pickle = self.string(ref)
+            policy = _policies_by_pickle.get(policy_pickle)
+            if (policy is None):
+                policy = pickle.loads(policy_pickle)
+                _policies_by_pickle[policy_pickle] = policy
+            self.policies[ref] = policy
+        return policy
+
+    def bw_weights(self):
+        """Returns dict of consensus bandwidth weights."""
+        bw_weights = {}
+        for i in xrange(self.num_weights):
+            name, value = _weight.unpack_from(self.mm,
+                self.offsets['weights'] + i*_weight.size)
+            bw_weights[name.rstrip('\0')] = value
+        return bw_weights
+
+    def hibernating_statuses(self, fprints):
+        """Returns list of (time, fingerprint, hibernating) triples."""
+        statuses = []
+        for i in xrange(self.num_statuses):
+            t, idx, hibernating = _status.unpack_from(self.mm,
+                self.offsets['statuses'] + i*_status.size)
+            statuses.append((t, fprints[idx], bool(hibernating)))
+        return statuses
+
+    def to_network_state(self):
+        """Returns pathsim.NetworkState with views of the relays and
+        descriptors in the file, which keep it mapped."""
+        fprints = self.fingerprints()
+        cons_rel_stats = {}
+        descriptors = {}
+        for i in xrange(self.num_relays):
+            cons_rel_stats[fprints[i]] = ColumnarRelayStatus(self, i)
+            descriptors[fprints[i]] = ColumnarDescriptor(self, i)
+        if (self.bwweightscale is None):
+            bwweightscale = pathsim.TorOptions.default_bwweightscale
+        else:
+            bwweightscale = self.bwweightscale
+        return pathsim.NetworkState(self.valid_after, self.fresh_until,
+            self.bw_weights(), bwweightscale, cons_rel_stats,
+            self.hibernating_statuses(fprints), descriptors)
+
+
+class ColumnarRelayStatus(object):
+    """pathsim.RouterStatusEntry of relay index in a ColumnarNetworkState,
+    whose values are read from the mapped file when requested."""
+    __slots__ = ('state', 'index')
+
+    def __init__(self, state, index):
+        self.state = state
+        self.index = index
+
+    def __reduce__(self):
+        return (ColumnarRelayStatus, (self.state, self.index))
+
+    @property
+    def fingerprint(self):
+        return self.state.fingerprint(self.index)
+
+    @property
+    def nickname(self):
+        return self.state.nickname(self.index)
+
+    @property
+    def bandwidth(self):
+        return self.state.uint('bandwidths', self.index)
+
+    @property
+    def flag_mask(self):
+        return self.state.uint('flags', self.index)
+
+    @property
+    def flags(self):
+        return pathsim.mask_to_flags(self.flag_mask)
+
+
+class ColumnarDescriptor(object):
+    """pathsim.ServerDescriptor of relay index in a ColumnarNetworkState,
+    whose values are read from the mapped file when requested."""
+    __slots__ = ('state', 'index')
+
+    def __init__(self, state, index):
+        self.state = state
+        self.index = index
+
+    def __reduce__(self):
+        return (ColumnarDescriptor, (self.state, self.index))
+
+    def detach(self):
+        """Returns pathsim.ServerDescriptor copy, which doesn't keep the
+        file mapped."""
+        return pathsim.ServerDescriptor(self.fingerprint, self.hibernating,
+            self.nickname, self.family, self.address,
+            self.compiled_exit_policy, self.ntor_onion_key)
+
+    @property
+    def fingerprint(self):
+        return self.state.fingerprint(self.index)
+
+    @property
+    def hibernating(self):
+        return self.state.hibernating(self.index)
+
+    @property
+    def nickname(self):
+        return self.state.nickname(self.index, 'desc_nicknames')
+
+    @property
+    def family(self):
+        return self.state.family(self.index)
+
+    @property
+    def packed_address(self):
+        return self.state.uint('addresses', self.index)
+
+    @property
+    def address(self):
+        return int_to_ip(self.packed_address)
+
+    @property
+    def subnet_16(self):
+        return self.packed_address >> 16
+
+    @property
+    def compiled_exit_policy(self):
+        return self.state.compiled_exit_policy(self.index)
+
+    @property
+    def exit_policy(self):
+        return self.compiled_exit_policy.to_stem()
+
+    @property
+    def ntor_onion_key(self):
+        return self.state.string(self.state.uint('ntor_keys', self.index))
+
+
+def detach_descriptor(desc):
+    """Returns desc, or a copy not keeping its file mapped if it is a
+    ColumnarDescriptor."""
+    if isinstance(desc, ColumnarDescriptor):
+        return desc.detach()
+    return desc
+
+
+def read_columnar_period(path):
+    """Returns (valid_after, fresh_until) timestamps of columnar file."""
+    with ColumnarNetworkState(path) as ns:
+        return (ns.valid_after, ns.fresh_until)
+
+
+def read_columnar_network_state(path):
+    """Reads columnar network state file, returns pathsim.NetworkState whose
+    relays and descriptors are read from the mapped file."""
+    return ColumnarNetworkState(path).to_network_state()
+
+
+class NetworkStateDelta:
+    """
+    Changes to the simulated relays and descriptors from those of the
+    network state file named base, plus the consensus values of the hour.
+    """
+    def __init__(self, base, valid_after, fresh_until, bw_weights,
+        bwweightscale, removed_relays, relays, removed_descriptors,
+        descriptors, hibernating_statuses):
+        self.base = base
+        self.valid_after = valid_after
+        self.fresh_until = fresh_until
+        self.bw_weights = bw_weights
+        self.bwweightscale = bwweightscale
+        self.removed_relays = removed_relays
+        self.relays = relays
+        self.removed_descriptors = removed_descriptors
+        self.descriptors = descriptors
+        self.hibernating_statuses = hibernating_statuses
+
+
+def relay_changed(old_rel_stat, rel_stat):
+    """Returns if consensus entries differ in a value used in simulation."""
+    return (old_rel_stat.nickname != rel_stat.nickname) or\
+        (old_rel_stat.flags != rel_stat.flags) or\
+        (old_rel_stat.bandwidth != rel_stat.bandwidth)
+
+
+def descriptor_changed(old_desc, desc):
+    """Returns if descriptors differ in a value used in simulation."""
+    return (old_desc.hibernating != desc.hibernating) or\
+        (old_desc.nickname != desc.nickname) or\
+        (old_desc.family != desc.family) or\
+        (old_desc.address != desc.address) or\
+        (old_desc.compiled_exit_policy is not desc.compiled_exit_policy) or\
+        (old_desc.ntor_onion_key != desc.ntor_onion_key)
+
+
+def write_network_state_delta(path, base, valid_after, fresh_until,
+    bw_weights, bwweightscale, base_relays, base_descriptors, relays,
+    descriptors, hibernating_statuses):
+    """Writes network state as changes from that of file base.
+    Inputs:
+        path: output filename
+        base: filename (without directory) of network state file to which the
+            delta applies, which must be in the same directory as path
+        valid_after: (int) timestamp of consensus valid_after
+        fresh_until: (int) timestamp of consensus fresh_until
+        bw_weights: (dict) consensus bandwidth weights
+        bwweightscale: (int) consensus bwweightscale, None if absent
+        base_relays: (dict) simulated relays of base, fingerprint keys and
+            pathsim.RouterStatusEntry vals
+        base_descriptors: (dict) descriptors of base, fingerprint keys and
+            pathsim.ServerDescriptor vals
+        relays: (dict) simulated relays, i.e. those with descriptors
+        descriptors: (dict) fingerprint keys and pathsim.ServerDescriptor vals
+        hibernating_statuses: list of (time, fingerprint, hibernating) triples
+    """
+    removed_relays = [fprint for fprint in base_relays\
+        if (fprint not in relays)]
+    changed_relays = {}
+    for fprint, rel_stat in relays.iteritems():
+        if (fprint not in base_relays) or\
+            relay_changed(base_relays[fprint], rel_stat):
+            changed_relays[fprint] = rel_stat
+    removed_descriptors = [fprint for fprint in base_descriptors\
+        if (fprint not in descriptors)]
+    changed_descriptors = {}
+    for fprint, desc in descriptors.iteritems():
+        if (fprint not in base_descriptors) or\
+            descriptor_changed(base_descriptors[fprint], desc):
+            changed_descriptors[fprint] = desc
+
+    delta = NetworkStateDelta(base, valid_after, fresh_until, bw_weights,
+        bwweightscale, removed_relays, changed_relays, removed_descriptors,
+        changed_descriptors, hibernating_statuses)
+    with open(path, 'wb') as f:
+        f.write(DELTA_MAGIC)
+        pickle.dump(delta, f, pickle.HIGHEST_PROTOCOL)
+
+
+def read_network_state_delta(path):
+    """Returns NetworkStateDelta stored in delta file."""
+    with open(path, 'rb') as f:
+        if (f.read(len(DELTA_MAGIC)) != DELTA_MAGIC):
+            raise ValueError('Not a network state delta file: {0}'.\
+                format(path))
+        return pickle.load(f)
+
+
+def read_delta_period(path):
+    """Returns (valid_after, fresh_until) timestamps of delta file."""
+    delta = read_network_state_delta(path)
+    return (delta.valid_after, delta.fresh_until)
+
+
+class NetworkStateReader(object):
+    """Reads sequential network state files of any format. Keeps the
+    relays and descriptors of the last file read so that a delta file
+    encoded against it is applied in place rather than read from its
+    keyframe. Each returned NetworkState has its own dicts, so network
+    modifiers may change them freely."""
+
+    def __init__(self):
+        self.path = None
+        self.cons_rel_stats = None
+        self.descriptors = None
+
+    def is_current(self, path):
+        """Returns if path is the file whose state was last read."""
+        return (self.path is not None) and\
+            (os.path.abspath(self.path) == os.path.abspath(path))
+
+    def read(self, path):
+        """Returns pathsim.NetworkState for network state file at path."""
+        # find deltas back to the current state or to a keyframe
+        deltas = []
+        while is_delta_file(path):
+            delta = read_network_state_delta(path)
+            deltas.append((path, delta))
+            path = os.path.join(os.path.dirname(path), delta.base)
+            if self.is_current(path):
+                break
+        else:
+            network_state = pathsim.get_network_state(path)
+            self.path = path
+            self.cons_rel_stats = dict(network_state.cons_rel_stats)
+            self.descriptors = dict(network_state.descriptors)
+            if (not deltas):
+                return network_state
+
+        # apply deltas in place, oldest first
+        for delta_path, delta in reversed(deltas):
+            for fprint in delta.removed_relays:
+                del self.cons_rel_stats[fprint]
+            self.cons_rel_stats.update(delta.relays)
+            for fprint in delta.removed_descriptors:
+                del self.descriptors[fprint]
+            self.descriptors.update(delta.descriptors)
+            self.path = delta_path
+        delta = deltas[0][1]
+        if (delta.bwweightscale is None):
+            bwweightscale = pathsim.TorOptions.default_bwweightscale
+        else:
+            bwweightscale = delta.bwweightscale
+        return pathsim.NetworkState(delta.valid_after, delta.fresh_until,
+            delta.bw_weights, bwweightscale, dict(self.cons_rel_stats),
+            delta.hibernating_statuses, dict(self.descriptors))
+
+
+def write_network_state_index(dir, entries):
+    """Writes index of the network state files in dir, replacing any index
+    only once completely written.
+    Inputs:
+        dir: directory containing network state files
+        entries: list of (valid_after, fresh_until, number of relays,
+            filename) of the network state files in dir, in time order
+    """
+    path = os.path.join(dir, INDEX_NAME)
+    f = open(path + '.tmp', 'wb')
+    pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(path + '.tmp', path)
+
+
+def read_network_state_index(dir):
+    """Returns list of (valid_after, fresh_until, number of relays, path)
+    of the network state files in the index of dir, in time order."""
+    f = open(os.path.join(dir, INDEX_NAME), 'rb')
+    entries = pickle.load(f)
+    f.close()
+    return [(valid_after, fresh_until, num_relays, os.path.join(dir,
+        filename)) for valid_after, fresh_until, num_relays, filename in\
+        entries]
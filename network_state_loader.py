@@ -0,0 +1,90 @@
+### Background loading of network states ###
+# pathsim.get_network_states() reads each network state file and applies the
+# network modifiers only when the simulator asks for the next hour, so
+# loading never overlaps with simulation. prefetch() instead consumes the
+# network state iterator in a worker thread or process, which stays up to
+# lookahead network states ahead of the simulator through a bounded queue.
+
+import multiprocessing
+import Queue
+import sys
+import threading
+import traceback
+
+# message kinds sent from worker to consumer
+_ITEM = 0
+_DONE = 1
+_ERROR = 2
+
+
+def _thread_worker(items, queue):
+    """Puts items from iterator into queue, followed by done or error."""
+    try:
+        for item in items:
+            queue.put((_ITEM, item))
+        queue.put((_DONE, None))
+    except Exception:
+        queue.put((_ERROR, sys.exc_info()))
+
+
+def _process_worker(items, queue):
+    """Puts items from iterator into queue, followed by done or error.
+    Exceptions are sent as formatted tracebacks, which always pickle."""
+    try:
+        for item in items:
+            queue.put((_ITEM, item))
+        queue.put((_DONE, None))
+    except Exception:
+        queue.put((_ERROR, traceback.format_exc()))
+
+
+def prefetch(items, lookahead, mode='thread'):
+    """Generator yielding the items of iterator items, which are produced
+    ahead of time by a worker.
+    Inputs:
+        items: iterator to consume in the worker, e.g. the generator
+            returned by pathsim.get_network_states(), including any network
+            modifiers it applies
+        lookahead: (int) maximum number of produced items waiting to be
+            yielded
+        mode: 'thread' to use a worker thread, which overlaps file I/O with
+            simulation, or 'process' to use a forked worker process, which
+            also overlaps unpickling and network modification but sends
+            each item to this process by pickling it
+    Output:
+        items: iterator yielding the items of items, in order
+    """
+    if (lookahead < 1):
+        raise ValueError('Prefetch lookahead must be positive: {0}'.\
+            format(lookahead))
+    if (mode == 'thread'):
+        queue = Queue.Queue(lookahead)
+        worker = threading.Thread(target=_thread_worker, args=(items, queue))
+    elif (mode == 'process'):
+        queue = multiprocessing.Queue(lookahead)
+        worker = multiprocessing.Process(target=_process_worker,
+            args=(items, queue))
+    else:
+        raise ValueError('Unknown prefetch mode: {0}'.format(mode))
+    # don't let an abandoned worker blocked on a full queue prevent exit
+    worker.daemon = True
+    worker.start()
+
+    try:
+        while True:
+            kind, value = queue.get()
+            if (kind == _ITEM):
+                yield value
+            elif (kind == _DONE):
+                break
+            elif (mode == 'thread'):
+                raise value[0], value[1], value[2]
+            else:
+                raise RuntimeError('Network state loader process failed:\n{0}'.\
+                    format(value))
+    finally:
+        # an abandoned worker thread stays blocked until exit as a daemon
+        if (mode == 'process'):
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
@@ -0,0 +1,225 @@
+### Sharding the samples of a simulation among processes ###
+# The samples of a simulation are independent of each other apart from the
+# random draws that they share, and so simulate() divides them into
+# contiguous ranges of sample IDs, each simulated by its own forked worker
+# process running pathsim.create_circuits(). The parent process reads each
+# network state (applying any network modifiers) and pickles it once, and
+# then sends the same pickled network state to every worker. The workers get
+# the user model's streams by inheriting them when forked.
+# Each worker writes its output into a buffer, which create_circuits() cuts
+# into segments by calling start_segment(key) before every pass over the
+# clients (see event_callbacks.py), with keys that increase over the
+# simulation. After every network state, the workers send their segments to
+# the parent, which writes the segments of all workers ordered by key and
+# then by worker. Because every pass over the clients writes its output in
+# order of sample ID (batched passes included, see
+# pathsim.batch_timed_client_updates()), this gives the order in which a
+# single process would write the same output lines.
+# Each sample draws from its own random number generator derived from the
+# simulation seed (see pathsim.sample_rng()), and so the merged output is the
+# same as that of a single process. Each worker also reseeds the random
+# module with a seed drawn by the parent before forking, so that the workers
+# don't repeat each other's remaining draws (e.g. those of --batch).
+# If a worker exits without sending its output (e.g. it is killed), the
+# parent raises an error instead of waiting for it.
+
+import cPickle as pickle
+import heapq
+import multiprocessing
+import Queue
+import random
+import StringIO
+import traceback
+
+# message kinds sent from worker to parent
+_SEGMENTS = 0
+_DONE = 1
+_ERROR = 2
+
+# seconds between checks that a worker is still running while waiting for
+# its output
+WORKER_POLL_INTERVAL = 5
+
+
+class SegmentedCallbacks(object):
+    """Wraps callbacks object writing to a buffer, and cuts the output written
+    to the buffer into segments."""
+
+    def __init__(self, callbacks, buf):
+        self.callbacks = callbacks
+        self.buf = buf
+        self.key = None
+        self.segments = []
+
+    def start_segment(self, key):
+        """Ends current segment and starts segment with given key."""
+        self.end_segment()
+        self.key = key
+
+    def end_segment(self):
+        """Ends current segment, keeping it if it has any output."""
+        output = self.buf.getvalue()
+        if output:
+            self.segments.append((self.key, output))
+            self.buf.seek(0)
+            self.buf.truncate()
+
+    def take_segments(self):
+        """Returns and forgets the segments ended so far."""
+        segments = self.segments
+        self.segments = []
+        return segments
+
+    def set_network_state(self, cons_valid_after, cons_fresh_until,
+        cons_bw_weights, cons_bwweightscale, cons_rel_stats, descriptors):
+        self.callbacks.set_network_state(cons_valid_after, cons_fresh_until,
+            cons_bw_weights, cons_bwweightscale, cons_rel_stats, descriptors)
+
+    def set_sample_id(self, id):
+        self.callbacks.set_sample_id(id)
+
+    def circuit_creation(self, circuit):
+        self.callbacks.circuit_creation(circuit)
+
+    def stream_assignment(self, stream, circuit):
+        self.callbacks.stream_assignment(stream, circuit)
+
+
+def shard_samples(num_samples, num_workers, first_sample=0):
+    """Returns list of (first sample ID, number of samples) of contiguous
+    shards dividing num_samples samples with IDs from first_sample as evenly
+    as possible among at most num_workers workers."""
+    num_workers = max(min(num_workers, num_samples), 1)
+    shards = []
+    for i in xrange(num_workers):
+        first = (i * num_samples) // num_workers
+        last = ((i+1) * num_samples) // num_workers
+        shards.append((first_sample + first, last - first))
+    return shards
+
+
+def _received_network_states(state_queue, segmented, result_queue):
+    """Generator yielding network states received from the parent. Before
+    each network state after the first, sends the output segments of the
+    previous network state to the parent."""
+    first = True
+    while True:
+        state = state_queue.get()
+        if (not first):
+            segmented.end_segment()
+            result_queue.put((_SEGMENTS, segmented.take_segments()))
+        first = False
+        if (state is None):
+            break
+        yield pickle.loads(state)
+
+
+def _worker(create_circuits, state_queue, result_queue, streams, shard,
+    congmodel, pdelmodel, make_callbacks, seed, kwargs):
+    """Simulates the samples of shard, sending its output to the parent."""
+    try:
+        random.seed(seed)
+        buf = StringIO.StringIO()
+        segmented = SegmentedCallbacks(make_callbacks(buf), buf)
+        first_sample, num_samples = shard
+        network_states = _received_network_states(state_queue, segmented,
+            result_queue)
+        create_circuits(network_states, streams, num_samples, congmodel,
+            pdelmodel, segmented, first_sample=first_sample, **kwargs)
+        result_queue.put((_DONE, None))
+    except Exception:
+        result_queue.put((_ERROR, traceback.format_exc()))
+        # keep taking network states so that the parent isn't blocked
+        # sending them before it receives the error
+        while (state_queue.get() is not None):
+            pass
+
+
+def _get_result(worker, result_queue):
+    """Returns next message of worker from result_queue. Raises RuntimeError
+    if the worker exits without sending one, e.g. when it is killed."""
+    while True:
+        try:
+            return result_queue.get(timeout=WORKER_POLL_INTERVAL)
+        except Queue.Empty:
+            if (not worker.is_alive()):
+                break
+    # the worker may have sent a message just before exiting
+    try:
+        return result_queue.get(timeout=WORKER_POLL_INTERVAL)
+    except Queue.Empty:
+        raise RuntimeError('Simulation worker process exited with code {0} without sending its output'.format(worker.exitcode))
+
+
+def simulate(create_circuits, network_states, streams, num_samples,
+    congmodel, pdelmodel, make_callbacks, num_workers, out_file,
+    first_sample=0, **kwargs):
+    """Runs create_circuits() on shards of the samples in forked worker
+    processes and writes their merged output.
+    Inputs:
+        create_circuits: pathsim.create_circuits() or a function with the same
+            arguments, including first_sample
+        network_states: iterator yielding the network states to simulate, as
+            given to create_circuits()
+        streams: list of streams, as given to create_circuits()
+        num_samples: (int) total number of samples
+        congmodel: (CongestionModel) as given to create_circuits()
+        pdelmodel: (PropagationDelayModel) as given to create_circuits()
+        make_callbacks: function of a file returning a callbacks object
+            writing its output to the file, cf. event_callbacks module
+        num_workers: (int) number of worker processes
+        out_file: file to which to write the merged output
+        first_sample: (int) ID of the first sample
+        kwargs: other keyword arguments to create_circuits(), e.g. batch
+    """
+    shards = shard_samples(num_samples, num_workers, first_sample)
+    workers = []
+    for shard in shards:
+        state_queue = multiprocessing.Queue(2)
+        result_queue = multiprocessing.Queue()
+        seed = random.randint(0, 2**32-1)
+        worker = multiprocessing.Process(target=_worker,
+            args=(create_circuits, state_queue, result_queue, streams, shard,
+                congmodel, pdelmodel, make_callbacks, seed, kwargs))
+        worker.daemon = True
+        workers.append((worker, state_queue, result_queue))
+    for worker, state_queue, result_queue in workers:
+        worker.start()
+
+    def write_output():
+        """Receives the segments of the next network state from every
+        worker and writes them in order. Returns False if the workers are
+        done instead."""
+        results = []
+        for i, (worker, state_queue, result_queue) in enumerate(workers):
+            kind, value = _get_result(worker, result_queue)
+            if (kind == _ERROR):
+                raise RuntimeError('Simulation worker process failed:\n{0}'.\
+                    format(value))
+            results.append((kind, [(key, i, output) for key, output in\
+                (value or [])]))
+        for key, i, output in heapq.merge(*[segments for kind, segments in\
+            results]):
+            out_file.write(output)
+        return all(kind == _SEGMENTS for kind, segments in results)
+
+    try:
+        # send network states while the workers simulate, staying at most
+        # one network state ahead of the output written
+        num_sent = 0
+        for network_state in network_states:
+            state = pickle.dumps(network_state, pickle.HIGHEST_PROTOCOL)
+            for worker, state_queue, result_queue in workers:
+                state_queue.put(state)
+            num_sent += 1
+            if (num_sent > 1):
+                write_output()
+        for worker, state_queue, result_queue in workers:
+            state_queue.put(None)
+        while write_output():
+            pass
+    finally:
+        for worker, state_queue, result_queue in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
@@ -3,9 +3,11 @@ import os
 import os.path
 from stem import Flag
 from stem.exit_policy import ExitPolicy
-from random import random, randint, choice
+import random
 import sys
 import collections
+import heapq
+import hashlib
 import cPickle as pickle
 import argparse
 from models import *
@@ -14,6 +16,14 @@ import congestion_aware_pathsim
 import process_consensuses
 import re
 import network_modifiers
+import network_state_formats
+import network_state_loader
+import network_state_cache
+import parallel_simulation
+import exit_policies
+import weighted_sampling
+import batch_path_selection
+import relay_tables
 import event_callbacks
 import importlib
 import logging
@@ -82,16 +92,69 @@ class NetworkState:
         self.descriptors = descriptors
     
 
+# Relay flags that can be represented in a flag bitmask, in bit order.
+# Do not reorder: flag bitmasks are stored in columnar network state files.
+RELAY_FLAGS = (Flag.AUTHORITY, Flag.BADEXIT, Flag.BADDIRECTORY, Flag.EXIT,
+    Flag.FAST, Flag.GUARD, Flag.HSDIR, Flag.NAMED, Flag.RUNNING, Flag.STABLE,
+    Flag.UNNAMED, Flag.V2DIR, Flag.VALID)
+FLAG_BITS = dict((flag, 1 << i) for i, flag in enumerate(RELAY_FLAGS))
+# bitmasks of the flags tested in path selection
+BADEXIT_MASK = FLAG_BITS[Flag.BADEXIT]
+EXIT_MASK = FLAG_BITS[Flag.EXIT]
+FAST_MASK = FLAG_BITS[Flag.FAST]
+GUARD_MASK = FLAG_BITS[Flag.GUARD]
+RUNNING_MASK = FLAG_BITS[Flag.RUNNING]
+STABLE_MASK = FLAG_BITS[Flag.STABLE]
+VALID_MASK = FLAG_BITS[Flag.VALID]
+# flags that determine the bandwidth weight of a relay in a position
+WEIGHT_CLASS_MASK = GUARD_MASK | EXIT_MASK
+# names of bandwidth weights by position and weight class of relay flags
+BW_WEIGHT_NAMES = {
+    'g':{GUARD_MASK | EXIT_MASK:'Wgd', GUARD_MASK:'Wgg', EXIT_MASK:None,
+        0:'Wgm'},
+    'm':{GUARD_MASK | EXIT_MASK:'Wmd', GUARD_MASK:'Wmg', EXIT_MASK:'Wme',
+        0:'Wmm'},
+    'e':{GUARD_MASK | EXIT_MASK:'Wed', GUARD_MASK:'Weg', EXIT_MASK:'Wee',
+        0:'Wem'}}
+
+
+def flags_to_mask(flags):
+    """Returns bitmask for list of Flag values. Flags not in RELAY_FLAGS are
+    ignored."""
+    mask = 0
+    for flag in flags:
+        mask |= FLAG_BITS.get(flag, 0)
+    return mask
+
+
+def mask_to_flags(mask):
+    """Returns list of Flag values set in bitmask."""
+    return [flag for flag in RELAY_FLAGS if (mask & FLAG_BITS[flag])]
+
+
 class RouterStatusEntry:
     """
     Represents a relay entry in a consensus document.
     Slim version of stem.descriptor.router_status_entry.RouterStatusEntry.
     """
-    def __init__(self, fingerprint, nickname, flags, bandwidth):
+    def __init__(self, fingerprint, nickname, flags, bandwidth,
+        flag_mask=None):
         self.fingerprint = fingerprint
         self.nickname = nickname
         self.flags = flags
         self.bandwidth = bandwidth
+        if (flag_mask is not None):
+            self.flag_mask = flag_mask
+
+
+    def __getattr__(self, name):
+        """Computes flags as a bitmask, which path selection tests instead of
+        flags, only when flag_mask is requested. It is thus not pickled in
+        network state files."""
+        if (name == 'flag_mask'):
+            self.flag_mask = flags_to_mask(self.flags)
+            return self.flag_mask
+        raise AttributeError(name)
     
 
 class NetworkStatusDocument:
@@ -121,13 +184,30 @@ class ServerDescriptor:
         self.nickname = nickname
         self.family = family
         self.address = address
-        self.exit_policy = exit_policy
+        self.set_packed_address()
+        self.compiled_exit_policy = exit_policies.compile_exit_policy(\
+            exit_policy)
         self.ntor_onion_key = ntor_onion_key
 
 
+    def set_packed_address(self):
+        """Sets IPv4 address as an integer (packed_address) and its /16
+        prefix (subnet_16), which are not pickled."""
+        self.packed_address = network_state_formats.ip_to_int(self.address)
+        self.subnet_16 = self.packed_address >> 16
+
+
+    def __getattr__(self, name):
+        """Builds stem ExitPolicy only when exit_policy is requested."""
+        if (name == 'exit_policy'):
+            self.exit_policy = self.compiled_exit_policy.to_stem()
+            return self.exit_policy
+        raise AttributeError(name)
+
+
     def __getstate__(self):
-        """Used for headache-free pickling. Turns ExitPolicy into its string
-        representation, rather than using the repeatedly problematic object."""
+        """Used for headache-free pickling. Stores the compiled exit policy,
+        rather than using the repeatedly problematic stem object."""
 
         state = dict()
         state['fingerprint'] = self.fingerprint
@@ -135,22 +215,27 @@ class ServerDescriptor:
         state['nickname'] = self.nickname
         state['family'] = self.family
         state['address'] = self.address
-        state['exit_policy'] = str(self.exit_policy)
+        state['compiled_exit_policy'] = self.compiled_exit_policy
         state['ntor_onion_key'] = self.ntor_onion_key
         
         return state
 
 
     def __setstate__(self, state):
-        """Used for headache-free unpickling. Creates ExitPolicy from string
-        representation."""
+        """Used for headache-free unpickling. Files written before exit
+        policies were compiled store the ExitPolicy string representation."""
 
         self.fingerprint = state['fingerprint']
         self.hibernating = state['hibernating']
         self.nickname = state['nickname']
         self.family = state['family']
         self.address = state['address']
-        self.exit_policy = ExitPolicy(*state['exit_policy'].split(', '))
+        self.set_packed_address()
+        if ('compiled_exit_policy' in state):
+            self.compiled_exit_policy = state['compiled_exit_policy']
+        else:
+            self.compiled_exit_policy = exit_policies.compile_exit_policy(\
+                state['exit_policy'])
         self.ntor_onion_key = state['ntor_onion_key']
     
 
@@ -161,6 +246,59 @@ def timestamp(t):
     return ts
 
 
+def timestamp_from_string(s):
+    """Returns UNIX timestamp of UTC time s given as YYYY-MM-DD, optionally
+    followed by -HH, -HH-MM or -HH-MM-SS, as in network state filenames."""
+    fields = map(int, s.split('-'))
+    if (len(fields) < 3) or (len(fields) > 6):
+        raise ValueError('Time not YYYY-MM-DD[-HH[-MM[-SS]]]: {0}'.format(s))
+    return timestamp(datetime.datetime(*fields))
+
+
+def get_network_state_files(nsf_dir, start=None, end=None):
+    """Finds the network state files under nsf_dir whose valid_after is in
+    [start, end). The index written by process is used for each directory
+    that has one, and otherwise times are taken from the filenames.
+    Inputs:
+        nsf_dir: directory containing network state files, possibly in
+            subdirectories
+        start: UNIX timestamp of period start, None for no limit
+        end: UNIX timestamp of period end, None for no limit
+    Output:
+        network_state_files: list of network state files as produced by
+            pad_network_state_files()
+        start_time: valid_after of first network state file
+        end_time: fresh_until of last network state file
+    """
+    # (valid_after, fresh_until or None if unknown, path) of each file
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(nsf_dir, followlinks=True):
+        if (network_state_formats.INDEX_NAME in filenames):
+            for valid_after, fresh_until, num_relays, path in\
+                network_state_formats.read_network_state_index(dirpath):
+                entries.append((valid_after, fresh_until, path))
+        else:
+            for filename in filenames:
+                if (filename[0] != '.'):
+                    entries.append((timestamp_from_string(\
+                        filename.rsplit('-', 1)[0]), None,
+                        os.path.join(dirpath, filename)))
+    entries = [entry for entry in entries if\
+        ((start is None) or (entry[0] >= start)) and\
+        ((end is None) or (entry[0] < end))]
+    if (not entries):
+        raise ValueError('No network state files found in {0} for the given period.'.format(nsf_dir))
+    entries.sort(key = lambda x: os.path.basename(x[2]))
+    # insert gaps for missing time periods
+    network_state_files = pad_network_state_files([entry[2] for entry in\
+        entries])
+    start_time = entries[0][0]
+    end_time = entries[-1][1]
+    if (end_time is None):
+        end_time = get_network_state_period(entries[-1][2])[1]
+    return (network_state_files, start_time, end_time)
+
+
 def pad_network_state_files(network_state_files):
     """Add hour-long gaps into files list where gaps exist in file times."""
     nsf_date = None
@@ -196,73 +334,40 @@ def get_bw_weight(flags, position, bw_weights):
         bw_weights: bandwidth_weights from NetworkStatusDocumentV3 consensus
     """
     
-    if (position == 'g'):
-        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
-            return bw_weights['Wgd']
-        elif (Flag.GUARD in flags):
-            return bw_weights['Wgg']
-        elif (Flag.EXIT not in flags):
-            return bw_weights['Wgm']
-        else:
-            raise ValueError('Wge weight does not exist.')
-    elif (position == 'm'):
-        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
-            return bw_weights['Wmd']
-        elif (Flag.GUARD in flags):
-            return bw_weights['Wmg']
-        elif (Flag.EXIT in flags):
-            return bw_weights['Wme']
-        else:
-            return bw_weights['Wmm']
-    elif (position == 'e'):
-        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
-            return bw_weights['Wed']
-        elif (Flag.GUARD in flags):
-            return bw_weights['Weg']
-        elif (Flag.EXIT in flags):
-            return bw_weights['Wee']
-        else:
-            return bw_weights['Wem']    
-    else:
+    if (position not in BW_WEIGHT_NAMES):
+        raise ValueError('get_weight does not support position {0}.'.format(
+            position))
+    name = BW_WEIGHT_NAMES[position][flags_to_mask(flags) & WEIGHT_CLASS_MASK]
+    if (name == None):
+        raise ValueError('Wge weight does not exist.')
+    return bw_weights[name]
+
+
+def get_position_weight_table(position, bw_weights, bwweightscale):
+    """Returns dict mapping weight classes of relays (i.e. flag_mask &
+    WEIGHT_CLASS_MASK) to the weight of their bandwidth in position in a
+    consensus, omitting classes without weights."""
+    if (position not in BW_WEIGHT_NAMES):
         raise ValueError('get_weight does not support position {0}.'.format(
             position))
+    weight_table = {}
+    for weight_class, name in BW_WEIGHT_NAMES[position].items():
+        if (name != None) and (name in bw_weights):
+            weight_table[weight_class] = float(bw_weights[name]) /\
+                float(bwweightscale)
+    return weight_table
 
             
-def select_weighted_node(weighted_nodes):
-    """Takes (node,cum_weight) pairs where non-negative cum_weight increases,
-    ending at 1. Use cum_weights as cumulative probablity to select a node."""
-    r = random()
-    begin = 0
-    end = len(weighted_nodes)-1
-    mid = int((end+begin)/2)
-    while True:
-        if (r <= weighted_nodes[mid][1]):
-            if (mid == begin):
-                return weighted_nodes[mid][0]
-            else:
-                end = mid
-                mid = int((end+begin)/2)
-        else:
-            if (mid == end):
-                raise ValueError('Weights must sum to 1.')
-            else:
-                begin = mid+1
-                mid = int((end+begin)/2)
+def select_weighted_node(weighted_nodes, rng=random):
+    """Takes weighted nodes from get_weighted_nodes() and selects a node
+    randomly according to its weight, using random number generator rng."""
+    return weighted_nodes.sample(rng)
 
 
 def might_exit_to_port(descriptor, port):
     """Returns if will exit to port for *some* ip.
     Is conservative - never returns a false negative."""
-    for rule in descriptor.exit_policy:
-        if (port >= rule.min_port) and\
-                (port <= rule.max_port): # assumes full range for wildcard port
-            if rule.is_accept:
-                return True
-            else:
-                if (rule.is_address_wildcard()) or\
-                    (rule.get_masked_bits() == 0):
-                    return False
-    return True # default accept if no rule matches
+    return descriptor.compiled_exit_policy.might_exit_to_port(port)
 
 
 def can_exit_to_port(descriptor, port):
@@ -270,27 +375,12 @@ def can_exit_to_port(descriptor, port):
     That function returns ACCEPT, PROBABLY_ACCEPT, REJECT, and PROBABLY_REJECT.
     We ignore the PRABABLY status, as is done by Tor in the uses of
     compare_unknown_tor_addr_to_addr_policy() that we care about."""             
-    for rule in descriptor.exit_policy:
-        if (port >= rule.min_port) and\
-                (port <= rule.max_port): # assumes full range for wildcard port
-            if (rule.is_address_wildcard()) or\
-                (rule.get_masked_bits() == 0):
-                if rule.is_accept:
-                    return True
-                else:
-                    return False
-    return True # default accept if no rule matches
+    return descriptor.compiled_exit_policy.can_exit_to_port(port)
     
 def policy_is_reject_star(exit_policy):
-    """Replicates Tor function of same name in policies.c."""
-    for rule in exit_policy:
-        if rule.is_accept:
-            return False
-        elif (((rule.min_port <= 1) and (rule.max_port == 65535)) or\
-                (rule.is_port_wildcard())) and\
-            ((rule.is_address_wildcard()) or (rule.get_masked_bits == 0)):
-            return True
-    return True
+    """Replicates Tor function of same name in policies.c.
+    exit_policy may be compiled or a stem ExitPolicy."""
+    return exit_policies.compile_exit_policy(exit_policy).is_reject_star()
         
 
 def exit_filter(exit, cons_rel_stats, descriptors, fast, stable, internal, ip,\
@@ -302,31 +392,67 @@ def exit_filter(exit, cons_rel_stats, descriptors, fast, stable, internal, ip,\
     loose than Tor and avoid false negatives (via loose=True).
     If IP and port not given, check policy for any allowed exiting. This
     behavior is for SOCKS RESOLVE requests in particular."""
-    rel_stat = cons_rel_stats[exit]
+    flag_mask = cons_rel_stats[exit].flag_mask
     desc = descriptors[exit]
-    if (Flag.BADEXIT not in rel_stat.flags) and\
-        (Flag.RUNNING in rel_stat.flags) and\
-        (Flag.VALID in rel_stat.flags) and\
-        ((not fast) or (Flag.FAST in rel_stat.flags)) and\
-        ((not stable) or (Flag.STABLE in rel_stat.flags)):
+    if ((flag_mask & (BADEXIT_MASK | RUNNING_MASK | VALID_MASK)) ==\
+            (RUNNING_MASK | VALID_MASK)) and\
+        ((not fast) or (flag_mask & FAST_MASK)) and\
+        ((not stable) or (flag_mask & STABLE_MASK)):
         if (internal):
             # In an "internal" circuit final node is chosen just like a
             # middle node (ignoring its exit policy).
             return True
         elif (ip != None):
-            return desc.exit_policy.can_exit_to(ip, port)
+            return desc.compiled_exit_policy.can_exit_to(ip, port)
         elif (port != None):
             if (not loose):
                 return can_exit_to_port(desc, port)
             else:
                 return might_exit_to_port(desc, port)
         else:
-            return (not policy_is_reject_star(desc.exit_policy))
+            return (not desc.compiled_exit_policy.is_reject_star())
+
+
+def filter_exits_by_port(cons_rel_stats, descriptors, fast, stable, port,
+    loose):
+    """Applies exit filter to relays for a port without an IP, as
+    exit_filter() does for non-internal circuits. Relays with the same exit
+    policy share its policy_id, and the policy is checked once per ID.
+    Output:
+        exits: list of relays passing the filter, in the order of
+            cons_rel_stats
+    """
+    required_mask = RUNNING_MASK | VALID_MASK
+    if fast:
+        required_mask |= FAST_MASK
+    if stable:
+        required_mask |= STABLE_MASK
+    checked_mask = required_mask | BADEXIT_MASK
+    candidates = [relay for relay in cons_rel_stats\
+        if ((cons_rel_stats[relay].flag_mask & checked_mask) ==\
+            required_mask)]
+    policies = [descriptors[relay].compiled_exit_policy\
+        for relay in candidates]
+    # check each class of relays with the same policy once
+    policy_answers = {}
+    for policy in policies:
+        if (policy.policy_id not in policy_answers):
+            if loose:
+                policy_answers[policy.policy_id] =\
+                    policy.might_exit_to_port(port)
+            else:
+                policy_answers[policy.policy_id] =\
+                    policy.can_exit_to_port(port)
+    return [relay for relay, policy in zip(candidates, policies)\
+        if policy_answers[policy.policy_id]]
 
 
 def filter_exits(cons_rel_stats, descriptors, fast, stable, internal, ip,\
     port):
     """Applies exit filter to relays."""
+    if (not internal) and (ip == None) and (port != None):
+        return filter_exits_by_port(cons_rel_stats, descriptors, fast, stable,
+            port, False)
     exits = []
     for fprint in cons_rel_stats:
         if exit_filter(fprint, cons_rel_stats, descriptors, fast, stable,\
@@ -338,6 +464,9 @@ def filter_exits(cons_rel_stats, descriptors, fast, stable, internal, ip,\
 def filter_exits_loose(cons_rel_stats, descriptors, fast, stable, internal,\
     ip, port):
     """Applies loose exit filter to relays."""    
+    if (not internal) and (ip == None) and (port != None):
+        return filter_exits_by_port(cons_rel_stats, descriptors, fast, stable,
+            port, True)
     exits = []
     for fprint in cons_rel_stats:
         if exit_filter(fprint, cons_rel_stats, descriptors, fast, stable,\
@@ -349,40 +478,38 @@ def filter_exits_loose(cons_rel_stats, descriptors, fast, stable, internal,\
 def get_position_weights(nodes, cons_rel_stats, position, bw_weights,\
     bwweightscale):
     """Computes the consensus "bandwidth" weighted by position weights."""
+    weight_table = get_position_weight_table(position, bw_weights,
+        bwweightscale)
     weights = {}
     for node in nodes:
-        bw = float(cons_rel_stats[node].bandwidth)
-        weight = float(get_bw_weight(cons_rel_stats[node].flags,\
-            position,bw_weights)) / float(bwweightscale)
-        weights[node] = bw * weight
+        rel_stat = cons_rel_stats[node]
+        try:
+            weight = weight_table[rel_stat.flag_mask & WEIGHT_CLASS_MASK]
+        except KeyError:
+            # raises the error for the missing weight
+            get_bw_weight(rel_stat.flags, position, bw_weights)
+        weights[node] = float(rel_stat.bandwidth) * weight
     return weights 
     
                         
 def get_weighted_nodes(nodes, weights):
     """Takes list of nodes (rel_stats) and weights (as a dict) and outputs
-    a list of (node, cum_weight) pairs, where cum_weight is the cumulative
-    probability of the nodes weighted by weights.
+    a weighted_sampling.AliasSampler that selects nodes with probability
+    proportional to their weights.
     """
-    # compute total weight
-    total_weight = 0
-    for node in nodes:
-        total_weight += weights[node]
-    if (total_weight == 0):
+    node_weights = [weights[node] for node in nodes]
+    if (sum(node_weights) == 0):
         raise ValueError('ERROR: Node list has total weight zero.')
-    # create cumulative weights
-    weighted_nodes = []
-    cum_weight = 0
-    for node in nodes:
-        cum_weight += weights[node]/total_weight
-        weighted_nodes.append((node, cum_weight))
-    
-    return weighted_nodes         
+    return weighted_sampling.AliasSampler(nodes, node_weights)
 
     
 def in_same_family(descriptors, node1, node2):
     """Takes list of descriptors and two node fingerprints,
     checks if nodes list each other as in the same family."""
 
+    if isinstance(descriptors, relay_tables.DescriptorTable):
+        return (node2 in descriptors.families.get(node1, ()))
+
     desc1 = descriptors[node1]
     desc2 = descriptors[node2]
     fprint1 = desc1.fingerprint
@@ -407,21 +534,10 @@ def in_same_family(descriptors, node1, node2):
     
 def in_same_16_subnet(address1, address2):
     """Takes IPv4 addresses as strings and checks if the first two bytes
-    are equal."""
-    # check first octet
-    i = 0
-    while (address1[i] != '.'):
-        if (address1[i] != address2[i]):
-            return False
-        i += 1
-        
-    i += 1
-    while (address1[i] != '.'):
-        if (address1[i] != address2[i]):
-            return False
-        i += 1
-        
-    return True
+    are equal. Relays with descriptors can be compared with the subnet_16
+    of their descriptors instead."""
+    return ((network_state_formats.ip_to_int(address1) >> 16) ==\
+        (network_state_formats.ip_to_int(address2) >> 16))
 
 
 def middle_filter(node, cons_rel_stats, descriptors, fast=None,\
@@ -432,27 +548,150 @@ def middle_filter(node, cons_rel_stats, descriptors, fast=None,\
     unknown."""
     # Note that we intentionally allow non-Valid routers for middle
     # as per path-spec.txt default config    
-    rel_stat = cons_rel_stats[node]
-    return (Flag.RUNNING in rel_stat.flags) and\
+    flag_mask = cons_rel_stats[node].flag_mask
+    return bool(flag_mask & RUNNING_MASK) and\
             ((fast==None) or (not fast) or\
-                (Flag.FAST in rel_stat.flags)) and\
+                bool(flag_mask & FAST_MASK)) and\
             ((stable==None) or (not stable) or\
-                (Flag.STABLE in rel_stat.flags)) and\
+                bool(flag_mask & STABLE_MASK)) and\
             ((exit_node==None) or\
                 ((exit_node != node) and\
                     (not in_same_family(descriptors, exit_node, node)) and\
-                    (not in_same_16_subnet(descriptors[exit_node].address,\
-                        descriptors[node].address)))) and\
+                    (descriptors[exit_node].subnet_16 !=\
+                        descriptors[node].subnet_16))) and\
             ((guard_node==None) or\
                 ((guard_node != node) and\
                     (not in_same_family(descriptors, guard_node, node)) and\
-                    (not in_same_16_subnet(descriptors[guard_node].address,\
-                        descriptors[node].address))))
+                    (descriptors[guard_node].subnet_16 !=\
+                        descriptors[node].subnet_16)))
                         
 
+def get_subnet_relays(relays, descriptors):
+    """Returns dict from /16 prefix (as in ServerDescriptor.subnet_16) to
+    list of the relays with addresses in that subnet."""
+    subnet_relays = collections.defaultdict(list)
+    for relay in relays:
+        subnet_relays[descriptors[relay].subnet_16].append(relay)
+    return dict(subnet_relays)
+
+
+class WeightedMiddles(weighted_sampling.ConditionalSampler):
+    """Weighted middles of a consensus, which can be drawn conditioned on
+    passing middle_filter() for a given circuit. The middles excluded for a
+    circuit are cached by its exit and guard."""
+
+    # maximum number of cached exclusions
+    max_exclusions = 10000
+
+    def __init__(self, middles, weights, cons_rel_stats, descriptors):
+        """
+        Inputs:
+            middles: list of middles
+            weights: list of weight of each middle
+            cons_rel_stats: (dict) relay keys and relay status vals
+            descriptors: (dict or RelayTable) relay keys and descriptor vals,
+                including those of any guards not in the consensus
+        """
+        weighted_sampling.ConditionalSampler.__init__(self, middles, weights)
+        self.cons_rel_stats = cons_rel_stats
+        self.descriptors = descriptors
+        # middles by fingerprint and nickname, to find family members
+        self.fingerprints = {}
+        self.nicknames = collections.defaultdict(list)
+        for middle in self.items:
+            self.fingerprints[descriptors[middle].fingerprint] = middle
+            self.nicknames[descriptors[middle].nickname].append(middle)
+        # middles by the /16 prefix of their addresses
+        self.subnets = get_subnet_relays(self.items, descriptors)
+        # samplers of middles with flags needed, by (fast, stable)
+        self.flag_samplers = {}
+        # flag sampler and exclusion by (fast, stable, exit_node, guard_node)
+        self.exclusions = {}
+
+    def flag_sampler(self, fast, stable):
+        """Returns ConditionalSampler of the middles that pass middle_filter()
+        for the fast and stable requirements."""
+        key = (bool(fast), bool(stable))
+        if (key not in self.flag_samplers):
+            positions = [i for i, middle in enumerate(self.items)\
+                if middle_filter(middle, self.cons_rel_stats,
+                    self.descriptors, fast, stable)]
+            if (len(positions) == self.n):
+                self.flag_samplers[key] = self
+            else:
+                self.flag_samplers[key] = weighted_sampling.ConditionalSampler(\
+                    [self.items[i] for i in positions],
+                    [self.weights[i] for i in positions])
+        return self.flag_samplers[key]
+
+    def family(self, node):
+        """Returns middles in the same family as relay node."""
+        if isinstance(self.descriptors, relay_tables.DescriptorTable):
+            return [member for member in\
+                self.descriptors.families.get(node, ())\
+                if (member in self.index)]
+        members = set()
+        for member in self.descriptors[node].family:
+            if (member[0] == '$'):
+                if (member[1:] in self.fingerprints):
+                    members.add(self.fingerprints[member[1:]])
+            else:
+                members.update(self.nicknames.get(member, []))
+        return [member for member in members if (member in self.index) and\
+            in_same_family(self.descriptors, node, member)]
+
+    def subnet(self, node):
+        """Returns middles in the same /16 subnet as relay node."""
+        return self.subnets.get(self.descriptors[node].subnet_16, [])
+
+    def circuit_exclusion(self, fast, stable, exit_node, guard_node):
+        """Returns (sampler, exclusion) of flag_sampler() and its exclusion of
+        the middles that fail middle_filter() for the circuit."""
+        key = (bool(fast), bool(stable), exit_node, guard_node)
+        sampler_exclusion = self.exclusions.get(key)
+        if (sampler_exclusion is None):
+            excluded = set()
+            for node in (exit_node, guard_node):
+                if (node != None):
+                    excluded.add(node)
+                    excluded.update(self.family(node))
+                    excluded.update(self.subnet(node))
+            sampler = self.flag_sampler(fast, stable)
+            sampler_exclusion = (sampler, sampler.exclusion(excluded))
+            if (len(self.exclusions) >= self.max_exclusions):
+                self.exclusions.clear()
+            self.exclusions[key] = sampler_exclusion
+        return sampler_exclusion
+
+    def sample_middle(self, fast, stable, exit_node, guard_node,
+        rng=random):
+        """Returns random middle that passes middle_filter() for the
+        circuit, drawn using random number generator rng."""
+        sampler, exclusion = self.circuit_exclusion(fast, stable, exit_node,
+            guard_node)
+        return sampler.sample_excluding(exclusion, rng)
+
+
+def get_weighted_middles(middles, weights, cons_rel_stats, descriptors):
+    """Takes list of middles and weights (as a dict) and outputs a
+    WeightedMiddles that selects middles with probability proportional to
+    their weights."""
+    middle_weights = [weights[middle] for middle in middles]
+    if (sum(middle_weights) == 0):
+        raise ValueError('ERROR: Node list has total weight zero.')
+    return WeightedMiddles(middles, middle_weights, cons_rel_stats,
+        descriptors)
+
+
 def select_middle_node(bw_weights, bwweightscale, cons_rel_stats, descriptors,\
-    fast, stable, exit_node, guard_node, weighted_middles=None):
-    """Chooses a valid middle node by selecting randomly until one is found."""
+    fast, stable, exit_node, guard_node, weighted_middles=None, rng=random):
+    """Chooses a valid middle node. If weighted_middles is a WeightedMiddles,
+    it is drawn from the valid middles, and otherwise by selecting randomly
+    until one is found. Draws use random number generator rng."""
+
+    if (isinstance(weighted_middles, WeightedMiddles)):
+        return weighted_middles.sample_middle(fast, stable, exit_node,
+            guard_node, rng)
 
     # create weighted middles if not given
     if (weighted_middles == None):
@@ -465,7 +704,7 @@ def select_middle_node(bw_weights, bwweightscale, cons_rel_stats, descriptors,\
     # select randomly until acceptable middle node is found
     i = 1
     while True:
-        middle_node = select_weighted_node(weighted_middles)
+        middle_node = select_weighted_node(weighted_middles, rng)
         if _testing:
             print('select_middle_node() made choice #{0}.'.format(i))
         i += 1
@@ -510,15 +749,14 @@ def guard_filter_for_circ(guard, cons_rel_stats, descriptors, fast,\
     
     if (guards[guard]['bad_since'] == None):
         if (guard in cons_rel_stats) and (guard in descriptors):
-            rel_stat = cons_rel_stats[guard]
-            return ((not fast) or (Flag.FAST in rel_stat.flags)) and\
-                ((not stable) or (Flag.STABLE in rel_stat.flags)) and\
+            flag_mask = cons_rel_stats[guard].flag_mask
+            return ((not fast) or bool(flag_mask & FAST_MASK)) and\
+                ((not stable) or bool(flag_mask & STABLE_MASK)) and\
                 ((guards[guard]['unreachable_since'] == None) or\
                     guard_is_time_to_retry(guards[guard],circ_time)) and\
                 (exit != guard) and\
                 (not in_same_family(descriptors, exit, guard)) and\
-                (not in_same_16_subnet(descriptors[exit].address,\
-                    descriptors[guard].address))
+                (descriptors[exit].subnet_16 != descriptors[guard].subnet_16)
         else:
             raise ValueError('Guard {0} not present in consensus or\ descriptors but wasn\'t marked bad.'.format(guard))
     else:
@@ -530,11 +768,9 @@ def filter_guards(cons_rel_stats, descriptors):
     In particular, omits checks for IP/family/subnet conflicts within list.
     """
     guards = []
+    guard_mask = RUNNING_MASK | VALID_MASK | GUARD_MASK
     for fprint in cons_rel_stats:
-        rel_stat = cons_rel_stats[fprint]
-        if (Flag.RUNNING in rel_stat.flags) and\
-            (Flag.VALID in rel_stat.flags) and\
-            (Flag.GUARD in rel_stat.flags) and\
+        if ((cons_rel_stats[fprint].flag_mask & guard_mask) == guard_mask) and\
             (fprint in descriptors):
             guards.append(fprint)   
     
@@ -542,8 +778,9 @@ def filter_guards(cons_rel_stats, descriptors):
     
 
 def get_new_guard(bw_weights, bwweightscale, cons_rel_stats, descriptors,\
-    client_guards, weighted_guards=None):
-    """Selects a new guard that doesn't conflict with the existing list."""
+    client_guards, weighted_guards=None, rng=random):
+    """Selects a new guard that doesn't conflict with the existing list,
+    using random number generator rng."""
     # - doesn't conflict with current guards
     # - running
     # - valid
@@ -563,7 +800,7 @@ def get_new_guard(bw_weights, bwweightscale, cons_rel_stats, descriptors,\
     # randomly select a guard, test, and repeat if necessary
     i = 1
     while True:
-        guard_node = select_weighted_node(weighted_guards)
+        guard_node = select_weighted_node(weighted_guards, rng)
         if _testing:
             print('get_new_guard() made choice #{0}.'.format(i))
         i += 1
@@ -572,8 +809,8 @@ def get_new_guard(bw_weights, bwweightscale, cons_rel_stats, descriptors,\
         for client_guard in client_guards:
             if (client_guard == guard_node) or\
                 (in_same_family(descriptors, client_guard, guard_node)) or\
-                (in_same_16_subnet(descriptors[client_guard].address,\
-                   descriptors[guard_node].address)):
+                (descriptors[client_guard].subnet_16 ==\
+                   descriptors[guard_node].subnet_16):
                 guard_conflict = True
                 break
         if (not guard_conflict):
@@ -584,9 +821,10 @@ def get_new_guard(bw_weights, bwweightscale, cons_rel_stats, descriptors,\
 def get_guards_for_circ(bw_weights, bwweightscale, cons_rel_stats,\
     descriptors, fast, stable, guards,\
     exit,\
-    circ_time, weighted_guards=None):
+    circ_time, weighted_guards=None, rng=random):
     """Obtains needed number of live guards that will work for circuit.
-    Chooses new guards if needed, and *modifies* guard list by adding them."""
+    Chooses new guards if needed, and *modifies* guard list by adding them.
+    Random choices use random number generator rng."""
     # Get live guards then add new ones until TorOptions.num_guards reached,
     # where live is
     #  - bad_since isn't set
@@ -614,11 +852,11 @@ def get_guards_for_circ(bw_weights, bwweightscale, cons_rel_stats,\
         for i in range(TorOptions.num_guards - len(live_guards)):
             new_guard = get_new_guard(bw_weights, bwweightscale,\
                 cons_rel_stats, descriptors, guards,\
-                weighted_guards)
+                weighted_guards, rng)
             if _testing:                
                 print('Need guard. Adding {0} [{1}]'.format(\
                     cons_rel_stats[new_guard].nickname, new_guard))
-            expiration = randint(TorOptions.guard_expiration_min,\
+            expiration = rng.randint(TorOptions.guard_expiration_min,\
                 TorOptions.guard_expiration_max)
             guards[new_guard] = {'expires':(expiration+\
                 circ_time), 'bad_since':None, 'unreachable_since':None,\
@@ -633,11 +871,11 @@ def get_guards_for_circ(bw_weights, bwweightscale, cons_rel_stats,\
     while (len(guards_for_circ) < TorOptions.min_num_guards):
             new_guard = get_new_guard(bw_weights, bwweightscale,\
                 cons_rel_stats, descriptors, guards,\
-                weighted_guards)
+                weighted_guards, rng)
             if _testing:                
                 print('Need guard for circuit. Adding {0} [{1}]'.format(\
                     cons_rel_stats[new_guard].nickname, new_guard))
-            expiration = randint(TorOptions.guard_expiration_min,\
+            expiration = rng.randint(TorOptions.guard_expiration_min,\
                 TorOptions.guard_expiration_max)
             guards[new_guard] = {'expires':(expiration+\
                 circ_time), 'bad_since':None, 'unreachable_since':None,\
@@ -668,7 +906,8 @@ def circuit_supports_stream(circuit, stream, descriptors):
             raise ValueError('Stream must have port.')
     
         desc = descriptors[circuit['path'][-1]]
-        if (desc.exit_policy.can_exit_to(stream['ip'], stream['port'])) and\
+        if (desc.compiled_exit_policy.can_exit_to(stream['ip'],\
+            stream['port'])) and\
             (not circuit['internal']) and\
             ((circuit['stable']) or\
                 (stream['port'] not in TorOptions.long_lived_ports)):
@@ -677,7 +916,7 @@ def circuit_supports_stream(circuit, stream, descriptors):
             return False
     elif (stream['type'] == 'resolve'):
         desc = descriptors[circuit['path'][-1]]
-        if (not policy_is_reject_star(desc.exit_policy)) and\
+        if (not desc.compiled_exit_policy.is_reject_star()) and\
             (not circuit['internal']):
             return True
         else:
@@ -739,11 +978,27 @@ def kill_circuits_by_relay(client_state, relay_down_fn, msg):
     client_state['clean_exit_circuits'] = new_clean_exit_circuits
 
 
+def get_network_state_period(ns_file):
+    """Returns (valid_after, fresh_until) timestamps of network state file."""
+    if network_state_formats.is_columnar_file(ns_file):
+        return network_state_formats.read_columnar_period(ns_file)
+    if network_state_formats.is_delta_file(ns_file):
+        return network_state_formats.read_delta_period(ns_file)
+    with open(ns_file, 'rb') as nsf:
+        consensus = pickle.load(nsf)
+    return (timestamp(consensus.valid_after), timestamp(consensus.fresh_until))
+
+
 def get_network_state(ns_file):
     """Reads in network state file, returns NetworkState object."""
     if _testing:
         print('Using file {0}'.format(ns_file))
 
+    if network_state_formats.is_columnar_file(ns_file):
+        return network_state_formats.read_columnar_network_state(ns_file)
+    if network_state_formats.is_delta_file(ns_file):
+        return network_state_formats.NetworkStateReader().read(ns_file)
+
     cons_rel_stats = {}
     with open(ns_file, 'r') as nsf:
         consensus = pickle.load(nsf)
@@ -767,7 +1022,8 @@ def get_network_state(ns_file):
         new_descriptors)
 
 
-def get_network_states(network_state_files, network_modifiers):
+def get_network_states(network_state_files, network_modifiers,
+    cache_dir=None):
     """Generator that yields NetworkState object produced from
     list of network state files and modifiers to apply.
     Input:
@@ -776,15 +1032,22 @@ def get_network_states(network_state_files, network_modifiers):
             as indicated by None entries
         network_modifiers: (list) contains objects to modify to network state in
             order via modify_network_state() method
+        cache_dir: directory of network_state_cache shared cache to read
+            network state files through, None to read them directly
     Output:
         network_states: iterator yielding sequential NetworkState objects or
             None
     """
 
+    if (cache_dir is not None):
+        reader = network_state_cache.SharedNetworkStateCache(cache_dir)
+    else:
+        # applies delta files to the previous state instead of rereading it
+        reader = network_state_formats.NetworkStateReader()
     for ns_file in network_state_files:
         if (ns_file is not None):
             # get network state variables from file    
-            network_state = get_network_state(ns_file)
+            network_state = reader.read(ns_file)
             # apply network modifications
             for network_modifier in network_modifiers:
                 network_modifier.modify_network_state(network_state)
@@ -834,19 +1097,17 @@ def period_client_update(client_state, cons_rel_stats, cons_fresh_until,\
         # note that hibernating *not* considered here
         if (guard_props['bad_since'] == None):
             if (guard not in cons_rel_stats) or\
-                (Flag.RUNNING not in\
-                 cons_rel_stats[guard].flags) or\
-                (Flag.GUARD not in\
-                 cons_rel_stats[guard].flags):
+                ((cons_rel_stats[guard].flag_mask &\
+                    (RUNNING_MASK | GUARD_MASK)) !=\
+                    (RUNNING_MASK | GUARD_MASK)):
                 if _testing:
                     print('Putting down guard {0}'.format(guard))
                 guard_props['bad_since'] = cons_valid_after
         else:
             if (guard in cons_rel_stats) and\
-                (Flag.RUNNING in\
-                 cons_rel_stats[guard].flags) and\
-                (Flag.GUARD in\
-                 cons_rel_stats[guard].flags):
+                ((cons_rel_stats[guard].flag_mask &\
+                    (RUNNING_MASK | GUARD_MASK)) ==\
+                    (RUNNING_MASK | GUARD_MASK)):
                 if _testing:
                     print('Bringing up guard {0}'.format(guard))
                 guard_props['bad_since'] = None
@@ -869,7 +1130,7 @@ def period_client_update(client_state, cons_rel_stats, cons_fresh_until,\
     #  down is not in consensus or without Running flag.            
     kill_circuits_by_relay(client_state, \
         lambda r: (r not in cons_rel_stats) or \
-            (Flag.RUNNING not in cons_rel_stats[r].flags),\
+            (not (cons_rel_stats[r].flag_mask & RUNNING_MASK)),\
             'is down')
             
             
@@ -905,15 +1166,11 @@ def timed_updates(cur_time, port_needs_global, client_states,
         hibernating_status[hs[1]] = hs[2]
             
 
-def timed_client_updates(cur_time, client_state, port_needs_global,
-    cons_rel_stats, cons_valid_after,
-    cons_fresh_until, cons_bw_weights, cons_bwweightscale, descriptors,
-    hibernating_status, port_need_weighted_exits, weighted_middles,
-    weighted_guards, congmodel, pdelmodel, callbacks=None):
-    """Performs updates to client state that occur on a time schedule."""
-    
-    guards = client_state['guards']
-            
+def kill_client_circuits(cur_time, client_state, hibernating_status,
+    kill_hibernating=True):
+    """Kills client circuits that are too old or, if kill_hibernating, use
+    hibernating relays. Hibernating relays only need checking when their
+    status has changed, as new circuits don't use hibernating relays."""
     # kill old dirty circuits
     while (len(client_state['dirty_exit_circuits'])>0) and\
             (client_state['dirty_exit_circuits'][-1]['dirty_time'] <=\
@@ -935,8 +1192,37 @@ def timed_client_updates(cur_time, client_state, port_needs_global,
         client_state['clean_exit_circuits'].pop()
         
     # kill circuits with relays that have gone into hibernation
-    kill_circuits_by_relay(client_state, \
-        lambda r: hibernating_status[r], 'is hibernating')
+    if (kill_hibernating):
+        kill_circuits_by_relay(client_state, \
+            lambda r: hibernating_status[r], 'is hibernating')
+
+
+def cover_port_needs(client_state, new_circ, port, port_needs_global,
+    descriptors):
+    """Counts clean circuit new_circ, created for port, as covering port and
+    any other port needs that it covers."""
+    client_state['port_needs_covered'][port] += 1
+    new_circ['covering'].add(port)
+    for pt, nd in port_needs_global.items():
+        if (pt != port) and\
+            (circuit_covers_port_need(new_circ,
+                descriptors, pt, nd)):
+            client_state['port_needs_covered'][pt] += 1
+            new_circ['covering'].add(pt)
+
+
+def timed_client_updates(cur_time, client_state, port_needs_global,
+    cons_rel_stats, cons_valid_after,
+    cons_fresh_until, cons_bw_weights, cons_bwweightscale, descriptors,
+    hibernating_status, port_need_weighted_exits, weighted_middles,
+    weighted_guards, congmodel, pdelmodel, callbacks=None,
+    kill_hibernating=True):
+    """Performs updates to client state that occur on a time schedule."""
+    
+    guards = client_state['guards']
+
+    kill_client_circuits(cur_time, client_state, hibernating_status,
+        kill_hibernating)
                   
     # cover uncovered ports while fewer than
     # TorOptions.max_unused_open_circuits clean
@@ -961,20 +1247,132 @@ def timed_client_updates(cur_time, client_state, port_needs_global,
                     need['fast'], need['stable'], False, None, port,
                     congmodel, pdelmodel,
                     port_need_weighted_exits[port],
-                    True, weighted_middles, weighted_guards, callbacks)
+                    True, weighted_middles, weighted_guards, callbacks,
+                    client_state['rng'])
                 client_state['clean_exit_circuits'].appendleft(new_circ)
                 
                 # cover this port and any others
-                client_state['port_needs_covered'][port] += 1
-                new_circ['covering'].add(port)
-                for pt, nd in port_needs_global.items():
-                    if (pt != port) and\
-                        (circuit_covers_port_need(new_circ,
-                            descriptors, pt, nd)):
-                        client_state['port_needs_covered'][pt] += 1
-                        new_circ['covering'].add(pt)
+                cover_port_needs(client_state, new_circ, port,
+                    port_needs_global, descriptors)
                         
                         
+class TimedEvents(object):
+    """Priority queue of the minutes of a consensus period at which timed
+    updates or streams may change client state. Client state is updated one
+    minute at a time, as by stepping through the period, but minutes without
+    events are skipped, during which the updates would change nothing.
+    Each client also has a wake-up minute, at which timed_client_updates()
+    may next change its state, and only clients whose wake-up minute has
+    come are updated at a minute without global events."""
+
+    def __init__(self, period_start, period_end, time_step):
+        self.period_start = period_start
+        self.period_end = period_end
+        self.time_step = time_step
+        self.minutes = []
+        self.scheduled = set()
+        # heap of (minute, client id), with wake-up minutes by client id
+        self.client_wakeups = []
+        self.client_minutes = {}
+
+    def add_minute(self, minute):
+        """Schedules updates at minute if it is within the period."""
+        if (minute < self.period_end) and (minute not in self.scheduled):
+            self.scheduled.add(minute)
+            heapq.heappush(self.minutes, minute)
+
+    def minute_at_or_after(self, event_time):
+        """Returns the first minute at or after event_time, which is when
+        timed updates act on an event at that time."""
+        steps = -((self.period_start - event_time) // self.time_step)
+        return self.period_start + max(steps, 0) * self.time_step
+
+    def add_at_or_after(self, event_time):
+        """Schedules updates at the first minute at or after event_time."""
+        self.add_minute(self.minute_at_or_after(event_time))
+
+    def wake_client(self, client_state, wake_time):
+        """Sets client to be updated at the first minute at or after
+        wake_time, or not to be updated before the period ends if wake_time
+        is None."""
+        if (wake_time == None):
+            self.client_minutes.pop(client_state['id'], None)
+            return
+        minute = self.minute_at_or_after(wake_time)
+        if (minute >= self.period_end):
+            self.client_minutes.pop(client_state['id'], None)
+        elif (self.client_minutes.get(client_state['id']) != minute):
+            self.client_minutes[client_state['id']] = minute
+            heapq.heappush(self.client_wakeups, (minute, client_state['id']))
+            self.add_minute(minute)
+
+    def due_clients(self, cur_time, client_states):
+        """Returns client states, in client order, of the clients whose
+        wake-up minute is at or before cur_time, clearing their wake-up.
+        Client IDs are consecutive from that of the first client state."""
+        client_ids = set()
+        while (self.client_wakeups) and\
+            (self.client_wakeups[0][0] <= cur_time):
+            minute, client_id = heapq.heappop(self.client_wakeups)
+            if (self.client_minutes.get(client_id) == minute):
+                del self.client_minutes[client_id]
+                client_ids.add(client_id)
+        if (not client_ids):
+            return []
+        first_id = client_states[0]['id']
+        return [client_states[client_id - first_id]\
+            for client_id in sorted(client_ids)]
+
+    def add_stream(self, stream_time):
+        """Schedules updates at the minute in which streams at stream_time
+        are assigned."""
+        steps = (stream_time - self.period_start) // self.time_step
+        self.add_minute(self.period_start + max(steps, 0) * self.time_step)
+
+    def next_minute(self, cur_time):
+        """Returns first scheduled minute after cur_time, or the period end
+        if there is none."""
+        while (self.minutes) and (self.minutes[0] <= cur_time):
+            self.scheduled.discard(heapq.heappop(self.minutes))
+        if (self.minutes):
+            return self.minutes[0]
+        return self.period_end
+
+
+def schedule_timed_events(timed_events, port_needs_global,
+    hibernating_statuses):
+    """Adds to timed_events the times of the next port need expirations and
+    hibernating status change (see timed_updates())."""
+    for need in port_needs_global.itervalues():
+        if (need['expires'] != None):
+            timed_events.add_at_or_after(need['expires'])
+    if (hibernating_statuses):
+        timed_events.add_at_or_after(hibernating_statuses[-1][0])
+
+
+def client_wake_time(cur_time, time_step, client_state, port_needs_global):
+    """Returns the earliest time after cur_time at which
+    timed_client_updates() may change client state, or None if it won't
+    unless the client is otherwise changed. This is when its oldest dirty or
+    clean circuit is killed for age (see kill_client_circuits()), or the next
+    minute if it has a port need to cover."""
+    wake_times = []
+    # circuits are ordered by time, so the last are killed first
+    if (client_state['dirty_exit_circuits']):
+        wake_times.append(\
+            client_state['dirty_exit_circuits'][-1]['dirty_time'] +\
+            TorOptions.max_circuit_dirtiness)
+    if (client_state['clean_exit_circuits']):
+        wake_times.append(\
+            client_state['clean_exit_circuits'][-1]['time'] +\
+            TorOptions.circuit_idle_timeout)
+    if (next_port_need(client_state, port_needs_global) != None):
+        wake_times.append(cur_time + time_step)
+    if (wake_times):
+        return min(wake_times)
+    return None
+
+
 def stream_update_port_needs(stream, port_needs_global,
     port_need_weighted_exits, client_states,
     descriptors, cons_rel_stats, cons_bw_weights, cons_bwweightscale):
@@ -1054,15 +1452,76 @@ def get_stream_port_weighted_exits(stream_port, stream,
     stream_weighted_exits = get_weighted_nodes(\
         stream_exits, stream_exit_weights)
     return stream_weighted_exits                               
+
+
+class ExactExitsCache(object):
+    """Least-recently-used cache of the exact weighted exits of CONNECT
+    streams in a consensus, by (ip, port, fast, stable)."""
+
+    # maximum number of cached weighted exits
+    max_size = 1000
+
+    def __init__(self):
+        self.weighted_exits = collections.OrderedDict()
+
+    def get(self, key):
+        """Returns weighted exits cached under key, or None if not cached."""
+        weighted_exits = self.weighted_exits.pop(key, None)
+        if (weighted_exits is not None):
+            self.weighted_exits[key] = weighted_exits
+        return weighted_exits
+
+    def add(self, key, weighted_exits):
+        """Caches weighted exits under key, evicting the least recently used
+        weighted exits if the cache is full."""
+        if (len(self.weighted_exits) >= self.max_size):
+            self.weighted_exits.popitem(last=False)
+        self.weighted_exits[key] = weighted_exits
+
+
+def get_stream_weighted_exits(stream, port_weighted_exits, exact_exits_cache,
+    cons_rel_stats, descriptors, cons_bw_weights, cons_bwweightscale):
+    """Returns weighted exit list of the exits that can carry stream.
+    Inputs:
+        stream: stream to select exits for
+        port_weighted_exits: weighted exits for port of stream from
+            get_stream_port_weighted_exits()
+        exact_exits_cache: (ExactExitsCache) weighted exits for CONNECT
+            streams in consensus
+        cons_rel_stats, descriptors, cons_bw_weights, cons_bwweightscale: 
+            consensus and descriptors for exit weights
+    """
+    if (stream['type'] != 'connect'):
+        # RESOLVE streams use exits allowing any exiting
+        return port_weighted_exits
+    stable = (stream['port'] in TorOptions.long_lived_ports)
+    key = (stream['ip'], stream['port'], True, stable)
+    weighted_exits = exact_exits_cache.get(key)
+    if (weighted_exits is None):
+        # the loose port exits have the flags needed, so check address only,
+        # evaluating each distinct exit policy once
+        policy_answers = {}
+        exits = []
+        for exit in port_weighted_exits.items:
+            policy = descriptors[exit].compiled_exit_policy
+            if (policy.policy_id not in policy_answers):
+                policy_answers[policy.policy_id] =\
+                    policy.can_exit_to(stream['ip'], stream['port'])
+            if policy_answers[policy.policy_id]:
+                exits.append(exit)
+        if _testing:
+            print('# exits for stream to {0}:{1}: {2}'.format(stream['ip'],
+                stream['port'], len(exits)))
+        weights = get_position_weights(exits, cons_rel_stats, 'e',
+            cons_bw_weights, cons_bwweightscale)
+        weighted_exits = get_weighted_nodes(exits, weights)
+        exact_exits_cache.add(key, weighted_exits)
+    return weighted_exits
         
         
-def client_assign_stream(client_state, stream, cons_rel_stats,
-    cons_valid_after, cons_fresh_until, cons_bw_weights, cons_bwweightscale,
-    descriptors, hibernating_status, stream_weighted_exits,
-    weighted_middles, weighted_guards, congmodel, pdelmodel, callbacks=None):
-    """Assigns a stream to a circuit for a given client."""
-        
-    guards = client_state['guards']
+def find_stream_circuit(client_state, stream, descriptors):
+    """Returns existing client circuit to assign stream to, dirtying it if
+    it was clean, or None if a new circuit is needed."""
     stream_assigned = None
 
     # try to use a dirty circuit
@@ -1112,44 +1571,65 @@ at {0}'.format(stream['time']))
                 new_clean_exit_circuits.append(circuit)
         client_state['clean_exit_circuits'] =\
             new_clean_exit_circuits
-    # if stream still unassigned we must make new circuit
-    if (stream_assigned == None):
-        new_circ = None
-        if (stream['type'] == 'connect'):
-            stable = (stream['port'] in TorOptions.long_lived_ports)
-            new_circ = create_circuit(cons_rel_stats,
-                cons_valid_after, cons_fresh_until,
-                cons_bw_weights, cons_bwweightscale,
-                descriptors, hibernating_status, guards, stream['time'], True,
-                stable, False, stream['ip'], stream['port'],
-                congmodel, pdelmodel, stream_weighted_exits, False,
-                weighted_middles, weighted_guards, callbacks)
-        elif (stream['type'] == 'resolve'):
-            new_circ = create_circuit(cons_rel_stats,
-                cons_valid_after, cons_fresh_until,
-                cons_bw_weights, cons_bwweightscale,
-                descriptors, hibernating_status, guards, stream['time'], True,
-                False, False, None, None, congmodel, pdelmodel,
-                stream_weighted_exits, True,
-                weighted_middles, weighted_guards, callbacks)
-        else:
-            raise ValueError('Unrecognized stream in client_assign_stream(): \
-{0}'.format(stream['type']))        
-        new_circ['dirty_time'] = stream['time']
-        stream_assigned = new_circ
-        client_state['dirty_exit_circuits'].appendleft(new_circ)
-        if _testing: 
-            if (stream['type'] == 'connect'):                           
-                print('Created circuit at time {0} to cover CONNECT \
+    return stream_assigned
+
+
+def stream_circuit_options(stream):
+    """Returns options (fast, stable, ip, port, exits_exact) of the circuit
+    to create for a stream, where exits_exact indicates if the weighted exits
+    for the stream (see get_stream_weighted_exits()) need no rechecking."""
+    if (stream['type'] == 'connect'):
+        stable = (stream['port'] in TorOptions.long_lived_ports)
+        return (True, stable, stream['ip'], stream['port'], True)
+    elif (stream['type'] == 'resolve'):
+        return (True, False, None, None, True)
+    else:
+        raise ValueError('Unrecognized stream in client_assign_stream(): \
+{0}'.format(stream['type']))
+
+
+def use_new_stream_circuit(client_state, stream, new_circ):
+    """Dirties circuit new_circ, created for stream, and adds it to the
+    client circuits."""
+    new_circ['dirty_time'] = stream['time']
+    client_state['dirty_exit_circuits'].appendleft(new_circ)
+    if _testing: 
+        if (stream['type'] == 'connect'):                           
+            print('Created circuit at time {0} to cover CONNECT \
 stream to ip {1} and port {2}.'.format(stream['time'], stream['ip'],\
 stream['port'])) 
-            elif (stream['type'] == 'resolve'):
-                print('Created circuit at time {0} to cover RESOLVE \
+        elif (stream['type'] == 'resolve'):
+            print('Created circuit at time {0} to cover RESOLVE \
 stream.'.format(stream['time']))
-            else: 
-                print('Created circuit at time {0} to cover unrecognized \
+        else: 
+            print('Created circuit at time {0} to cover unrecognized \
 stream.'.format(stream['time']))
 
+
+def client_assign_stream(client_state, stream, cons_rel_stats,
+    cons_valid_after, cons_fresh_until, cons_bw_weights, cons_bwweightscale,
+    descriptors, hibernating_status, stream_weighted_exits,
+    weighted_middles, weighted_guards, congmodel, pdelmodel, callbacks=None):
+    """Assigns a stream to a circuit for a given client."""
+        
+    guards = client_state['guards']
+
+    # try to use a dirty circuit, and next a clean circuit
+    stream_assigned = find_stream_circuit(client_state, stream, descriptors)
+    # if stream still unassigned we must make new circuit
+    if (stream_assigned == None):
+        circ_fast, circ_stable, circ_ip, circ_port, exits_exact =\
+            stream_circuit_options(stream)
+        new_circ = create_circuit(cons_rel_stats,
+            cons_valid_after, cons_fresh_until,
+            cons_bw_weights, cons_bwweightscale,
+            descriptors, hibernating_status, guards, stream['time'],
+            circ_fast, circ_stable, False, circ_ip, circ_port,
+            congmodel, pdelmodel, stream_weighted_exits, exits_exact,
+            weighted_middles, weighted_guards, callbacks, client_state['rng'])
+        use_new_stream_circuit(client_state, stream, new_circ)
+        stream_assigned = new_circ
+
     if (callbacks is not None):
         callbacks.stream_assignment(stream, stream_assigned)
 
@@ -1157,13 +1637,14 @@ stream.'.format(stream['time']))
 
     
 def select_exit_node(bw_weights, bwweightscale, cons_rel_stats, descriptors,\
-    fast, stable, internal, ip, port, weighted_exits=None, exits_exact=False):
+    fast, stable, internal, ip, port, weighted_exits=None, exits_exact=False,
+    rng=random):
     """Chooses a valid exit node. To improve performance when simulating many
     streams, we allow any input weighted_exits list to possibly include
     relays that are invalid for the current circuit (thus we can create
     weighted_exits less often by only considering the port instead of the
     ip/port). Then we randomly select from that list until a suitable exit is
-    found.
+    found. Draws use random number generator rng.
     """
     if (weighted_exits == None):    
         # filter exit list
@@ -1181,12 +1662,12 @@ def select_exit_node(bw_weights, bwweightscale, cons_rel_stats, descriptors,\
         exits_exact = True
     
     if (exits_exact):
-        return select_weighted_node(weighted_exits)
+        return select_weighted_node(weighted_exits, rng)
     else:
         # select randomly until acceptable exit node is found
         i = 1
         while True:
-            exit_node = select_weighted_node(weighted_exits)
+            exit_node = select_weighted_node(weighted_exits, rng)
             if _testing:
                 print('select_exit_node() made choice #{0}.'.format(i))
             i += 1
@@ -1203,21 +1684,89 @@ def circuit_supports_ntor(guard_node, middle_node, exit_node, descriptors):
             return True
     return False
 
+def select_guard_node(cons_bw_weights, cons_bwweightscale, cons_rel_stats,
+    descriptors, hibernating_status, guards, circ_time, circ_fast,
+    circ_stable, exit_node, weighted_guards=None, rng=random):
+    """Chooses a guard from client guards for circuit with exit_node,
+    updating the guards for any chosen guard that is hibernating. Random
+    choices use random number generator rng."""
+    # Hibernation status again checked here to reflect how in Tor
+    # new guards would be chosen and added to the list prior to a circuit-
+    # creation attempt. If the circuit fails at a new guard, that guard
+    # gets removed from the list.
+    while True:
+        # get first <= TorOptions.num_guards guards suitable for circuit
+        circ_guards = get_guards_for_circ(cons_bw_weights,\
+            cons_bwweightscale, cons_rel_stats, descriptors,\
+            circ_fast, circ_stable, guards,\
+            exit_node,\
+            circ_time, weighted_guards, rng)
+        guard_node = rng.choice(circ_guards)
+        if (hibernating_status[guard_node]):
+            if (not guards[guard_node]['made_contact']):
+                del guards[guard_node]
+                if _testing:
+                    print('[Time {0}]: Removed new hibernating guard: {1}.'\
+                        .format(circ_time,
+                            cons_rel_stats[guard_node].nickname))
+            elif (guards[guard_node]['unreachable_since'] != None):
+                guards[guard_node]['last_attempted'] = circ_time
+                if _testing:
+                    print('[Time {0}]: Guard retried but hibernating: {1}'.\
+                        format(circ_time,
+                            cons_rel_stats[guard_node].nickname))
+            else:
+                guards[guard_node]['unreachable_since'] = circ_time
+                guards[guard_node]['last_attempted'] = circ_time
+                if _testing:
+                    print('[Time {0}]: Guard newly hibernating: {1}'.\
+                        format(circ_time,
+                            cons_rel_stats[guard_node].nickname))
+        else:
+            guards[guard_node]['unreachable_since'] = None
+            guards[guard_node]['made_contact'] = True
+            break
+    if _testing:
+        print('Guard node: {0} [{1}]'.format(
+            cons_rel_stats[guard_node].nickname,
+            cons_rel_stats[guard_node].fingerprint))
+    return guard_node
+
+
+def new_circuit(circ_time, circ_fast, circ_stable, circ_internal, path,
+    callbacks=None):
+    """Returns new clean circuit with (guard, middle, exit) path, as output
+    by create_circuit(), and executes the circuit creation callback."""
+    circuit = {'time':circ_time,
+            'fast':circ_fast,
+            'stable':circ_stable,
+            'internal':circ_internal,
+            'dirty_time':None,
+            'path':path,
+            'covering':set()}
+
+    # execute callback to allow logging on circuit creation
+    if (callbacks is not None):
+        callbacks.circuit_creation(circuit)
+
+    return circuit
+
+
 def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
     cons_bw_weights, cons_bwweightscale, descriptors, hibernating_status,
     guards, circ_time, circ_fast, circ_stable, circ_internal, circ_ip,
     circ_port, congmodel, pdelmodel, weighted_exits=None,
     exits_exact=False, weighted_middles=None, weighted_guards=None,
-    callbacks=None):
+    callbacks=None, rng=random):
     """Creates path for requested circuit based on the input consensus
     statuses and descriptors.
     Inputs:
-        cons_rel_stats: (dict) relay fingerprint keys and relay status vals
+        cons_rel_stats: (dict) relay keys and relay status vals
         cons_valid_after: (int) timestamp of valid_after for consensus
         cons_fresh_until: (int) timestamp of fresh_until for consensus
         cons_bw_weights: (dict) bw_weights of consensus
         cons_bwweightscale: (should be float()able) bwweightscale of consensus
-        descriptors: (dict) relay fingerprint keys and descriptor vals
+        descriptors: (dict or RelayTable) relay keys and descriptor vals
         hibernating_status: (dict) indicates hibernating relays
         guards: (dict) contains guards of requesting client
         circ_time: (int) timestamp of circuit request
@@ -1228,14 +1777,16 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
         circ_port: (int) desired TCP port (None if not known)
         congmodel: congestion model
         pdelmodel: propagation delay model
-        weighted_exits: (list) (middle, cum_weight) pairs for exit position
+        weighted_exits: (AliasSampler) weighted exits, see get_weighted_nodes()
         exits_exact: (bool) Is weighted_exits exact or does it need rechecking?
             weighed_exits is special because exits are chosen first and thus
             don't depend on the other circuit positions, and so potentially are        
             precomputed exactly.
-        weighted_middles: (list) (middle, cum_weight) pairs for middle position
-        weighted_guards: (list) (middle, cum_weight) pairs for middle position
+        weighted_middles: (WeightedMiddles or AliasSampler) weighted middles
+        weighted_guards: (AliasSampler) weighted guards
         callbacks: object w/ method circuit_creation(circuit)
+        rng: (random.Random) random number generator of the requesting
+            client, see sample_rng()
     Output:
         circuit: (dict) a newly created circuit with keys
             'time': (int) seconds from time zero
@@ -1243,7 +1794,7 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
             'stable': (bool) relays must have Stable flag
             'internal': (bool) is internal (e.g. for hidden service)
             'dirty_time': (int) timestamp of time dirtied, None if clean
-            'path': (tuple) list in-order fingerprints for path's nodes
+            'path': (tuple) list in-order relays for path's nodes
             'covering': (set) ports with needs covered by circuit        
     """
     
@@ -1260,7 +1811,8 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
         while (True):
             exit_node = select_exit_node(cons_bw_weights, cons_bwweightscale,\
                 cons_rel_stats, descriptors, circ_fast, circ_stable,\
-                circ_internal, circ_ip, circ_port, weighted_exits, exits_exact)
+                circ_internal, circ_ip, circ_port, weighted_exits, exits_exact,
+                rng)
     #        exit_node = select_weighted_node(weighted_exits)
             if (not hibernating_status[exit_node]):
                 break
@@ -1274,46 +1826,9 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
                 cons_rel_stats[exit_node].fingerprint))
 
         # select guard node
-        # Hibernation status again checked here to reflect how in Tor
-        # new guards would be chosen and added to the list prior to a circuit-
-        # creation attempt. If the circuit fails at a new guard, that guard
-        # gets removed from the list.
-        while True:
-            # get first <= TorOptions.num_guards guards suitable for circuit
-            circ_guards = get_guards_for_circ(cons_bw_weights,\
-                cons_bwweightscale, cons_rel_stats, descriptors,\
-                circ_fast, circ_stable, guards,\
-                exit_node,\
-                circ_time, weighted_guards)   
-            guard_node = choice(circ_guards)
-            if (hibernating_status[guard_node]):
-                if (not guards[guard_node]['made_contact']):
-                    del guards[guard_node]
-                    if _testing:
-                        print('[Time {0}]: Removed new hibernating guard: {1}.'\
-                            .format(circ_time,
-                                cons_rel_stats[guard_node].nickname))
-                elif (guards[guard_node]['unreachable_since'] != None):
-                    guards[guard_node]['last_attempted'] = circ_time
-                    if _testing:
-                        print('[Time {0}]: Guard retried but hibernating: {1}'.\
-                            format(circ_time,
-                                cons_rel_stats[guard_node].nickname))
-                else:
-                    guards[guard_node]['unreachable_since'] = circ_time
-                    guards[guard_node]['last_attempted'] = circ_time
-                    if _testing:
-                        print('[Time {0}]: Guard newly hibernating: {1}'.\
-                            format(circ_time,
-                                cons_rel_stats[guard_node].nickname))
-            else:
-                guards[guard_node]['unreachable_since'] = None
-                guards[guard_node]['made_contact'] = True
-                break
-        if _testing:
-            print('Guard node: {0} [{1}]'.format(
-                cons_rel_stats[guard_node].nickname,
-                cons_rel_stats[guard_node].fingerprint))
+        guard_node = select_guard_node(cons_bw_weights, cons_bwweightscale,
+            cons_rel_stats, descriptors, hibernating_status, guards,
+            circ_time, circ_fast, circ_stable, exit_node, weighted_guards, rng)
 
         # select middle node
         # As with exit selection, hibernating status checked here to mirror Tor
@@ -1323,7 +1838,7 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
         while (True):
             middle_node = select_middle_node(cons_bw_weights,
                 cons_bwweightscale, cons_rel_stats, descriptors, circ_fast,
-                circ_stable, exit_node, guard_node, weighted_middles)
+                circ_stable, exit_node, guard_node, weighted_middles, rng)
             if (not hibernating_status[middle_node]):
                 break
             if _testing:
@@ -1347,22 +1862,186 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
         raise ValueError('ntor-compatible circuit not found in {} tries'.\
             format(num_attempts))
 
-    circuit = {'time':circ_time,
-            'fast':circ_fast,
-            'stable':circ_stable,
-            'internal':circ_internal,
-            'dirty_time':None,
-            'path':(guard_node, middle_node, exit_node),
-            'covering':set()}
+    return new_circuit(circ_time, circ_fast, circ_stable, circ_internal,
+        (guard_node, middle_node, exit_node), callbacks)
 
-    # execute callback to allow logging on circuit creation
+def select_batch_paths(selector, client_states, circ_time, circ_fast,
+    circ_stable, circ_internal, circ_ip, circ_port, weighted_exits,
+    exits_exact, cons_rel_stats, cons_bw_weights, cons_bwweightscale,
+    descriptors, hibernating_status, weighted_middles, weighted_guards):
+    """Chooses paths as create_circuit() does for the clients, which all need
+    a circuit with the same options, selecting the exits and middles together.
+    Inputs:
+        selector: (BatchPathSelector) selector for the network state
+        client_states: list of states of clients needing a circuit
+        (others): see create_circuit()
+    Output:
+        paths: list of (guard, middle, exit) path of each client
+    """
+    if (exits_exact):
+        accept = None
+        accept_key = None
+    else:
+        accept = lambda exit: exit_filter(exit, cons_rel_stats, descriptors,
+            circ_fast, circ_stable, circ_internal, circ_ip, circ_port, False)
+        accept_key = (circ_fast, circ_stable, circ_internal, circ_ip,
+            circ_port)
+    same_family = lambda node1, node2: in_same_family(descriptors, node1,
+        node2)
+
+    paths = [None] * len(client_states)
+    pending = range(len(client_states))
+    num_attempts = 0
+    while (num_attempts < TorOptions.max_populate_attempts) and (pending):
+        exits = selector.select_exits(weighted_exits, len(pending), accept,
+            accept_key)
+        exit_nodes = [selector.relays[i] for i in exits]
+        # guards are selected from each client's own guards
+        guard_nodes = []
+        for j, exit_node in zip(pending, exit_nodes):
+            guard_nodes.append(select_guard_node(cons_bw_weights,
+                cons_bwweightscale, cons_rel_stats, descriptors,
+                hibernating_status, client_states[j]['guards'], circ_time,
+                circ_fast, circ_stable, exit_node, weighted_guards,
+                client_states[j]['rng']))
+        middles = selector.select_middles(weighted_middles, circ_fast,
+            circ_stable, exits, guard_nodes, same_family)
+        # retry circuits without a relay supporting the ntor handshake
+        unsupported = []
+        for j, guard_node, i, exit_node in zip(pending, guard_nodes, middles,
+            exit_nodes):
+            middle_node = selector.relays[i]
+            if circuit_supports_ntor(guard_node, middle_node, exit_node,
+                descriptors):
+                paths[j] = (guard_node, middle_node, exit_node)
+            else:
+                unsupported.append(j)
+        pending = unsupported
+        num_attempts += 1
+    if (pending):
+        raise ValueError('ntor-compatible circuit not found in {} tries'.\
+            format(num_attempts))
+    return paths
+
+
+def next_port_need(client_state, port_needs_global):
+    """Returns port of next need that client must cover with a new clean
+    circuit, or None if it needs no new circuits."""
+    if (len(client_state['clean_exit_circuits']) >=\
+            TorOptions.max_unused_open_circuits):
+        return None
+    for port, need in port_needs_global.iteritems():
+        if (client_state['port_needs_covered'][port] < need['cover_num']):
+            return port
+    return None
+
+
+def batch_timed_client_updates(cur_time, client_states, port_needs_global,
+    cons_rel_stats, cons_bw_weights, cons_bwweightscale, descriptors,
+    hibernating_status, port_need_weighted_exits, weighted_middles,
+    weighted_guards, selector, callbacks=None, kill_hibernating=True):
+    """Performs timed_client_updates() for all clients, selecting the paths
+    of the circuits covering the same port need together."""
+    for client_state in client_states:
+        kill_client_circuits(cur_time, client_state, hibernating_status,
+            kill_hibernating)
+
+    # each round gives every client needing one a new circuit for its next
+    # port need, so each client covers its needs in the same order as in
+    # timed_client_updates()
+    new_circuits = collections.defaultdict(list)
+    while True:
+        port_client_states = collections.defaultdict(list)
+        for client_state in client_states:
+            port = next_port_need(client_state, port_needs_global)
+            if (port is not None):
+                port_client_states[port].append(client_state)
+        if (not port_client_states):
+            break
+        for port, need in port_needs_global.items():
+            if (port not in port_client_states):
+                continue
+            if _testing:
+                print('Creating {0} circuit(s) at time {1} to cover port \
+{2}.'.format(len(port_client_states[port]), cur_time, port))
+            paths = select_batch_paths(selector, port_client_states[port],
+                cur_time, need['fast'], need['stable'], False, None, port,
+                port_need_weighted_exits[port], True, cons_rel_stats,
+                cons_bw_weights, cons_bwweightscale, descriptors,
+                hibernating_status, weighted_middles, weighted_guards)
+            for client_state, path in zip(port_client_states[port], paths):
+                new_circ = new_circuit(cur_time, need['fast'],
+                    need['stable'], False, path)
+                new_circuits[client_state['id']].append(new_circ)
+                client_state['clean_exit_circuits'].appendleft(new_circ)
+                cover_port_needs(client_state, new_circ, port,
+                    port_needs_global, descriptors)
+
+    # produce output in client order, as timed_client_updates() does
     if (callbacks is not None):
-        callbacks.circuit_creation(circuit)
+        for client_state in client_states:
+            if (client_state['id'] in new_circuits):
+                callbacks.set_sample_id(client_state['id'])
+                for new_circ in new_circuits[client_state['id']]:
+                    callbacks.circuit_creation(new_circ)
+
+
+def batch_assign_stream(client_states, stream, cons_rel_stats,
+    cons_bw_weights, cons_bwweightscale, descriptors, hibernating_status,
+    stream_weighted_exits, weighted_middles, weighted_guards, selector,
+    callbacks=None):
+    """Performs client_assign_stream() for all clients, selecting the paths
+    of the new circuits needed for the stream together."""
+    stream_circuits = [find_stream_circuit(client_state, stream, descriptors)\
+        for client_state in client_states]
+    new_paths = {}
+    new_clients = [i for i, circuit in enumerate(stream_circuits)\
+        if (circuit == None)]
+    if (new_clients):
+        circ_fast, circ_stable, circ_ip, circ_port, exits_exact =\
+            stream_circuit_options(stream)
+        paths = select_batch_paths(selector,
+            [client_states[i] for i in new_clients], stream['time'],
+            circ_fast, circ_stable, False, circ_ip, circ_port,
+            stream_weighted_exits, exits_exact, cons_rel_stats,
+            cons_bw_weights, cons_bwweightscale, descriptors,
+            hibernating_status, weighted_middles, weighted_guards)
+        new_paths = dict(zip(new_clients, paths))
+
+    # create circuits and produce output in client order
+    for i, client_state in enumerate(client_states):
+        if (callbacks is not None):
+            callbacks.set_sample_id(client_state['id'])
+        stream_assigned = stream_circuits[i]
+        if (stream_assigned == None):
+            stream_assigned = new_circuit(stream['time'], circ_fast,
+                circ_stable, False, new_paths[i], callbacks)
+            use_new_stream_circuit(client_state, stream, stream_assigned)
+        if (callbacks is not None):
+            callbacks.stream_assignment(stream, stream_assigned)
+
+
+def sample_rng(seed, sample_id):
+    """Returns random number generator of sample with sample_id in simulation
+    with seed. Every sample has its own generator, so that its draws don't
+    depend on which other samples are simulated, or in which process."""
+    digest = hashlib.sha256('{0}:{1}'.format(seed, sample_id)).hexdigest()
+    return random.Random(long(digest, 16))
+
+
+def batch_seed(seed, first_sample, cons_valid_after):
+    """Returns seed of the BatchPathSelector of the consensus valid after
+    cons_valid_after in simulation with seed of the samples from
+    first_sample. The batched draws are shared by the samples simulated
+    together, and so are reproduced by simulating the same samples with the
+    same seed."""
+    digest = hashlib.sha256('{0}:batch:{1}:{2}'.format(seed, first_sample,
+        cons_valid_after)).hexdigest()
+    return long(digest, 16) % (2**32)
 
-    return circuit
 
 def create_circuits(network_states, streams, num_samples, congmodel,
-    pdelmodel, callbacks=None):
+    pdelmodel, callbacks=None, batch=False, first_sample=0, seed=None):
     """Takes streams over time and creates circuits by interaction
     with create_circuit().
       Input:
@@ -1379,8 +2058,18 @@ def create_circuits(network_states, streams, num_samples, congmodel,
         congmodel: (CongestionModel) outputs congestion used by some path algs
         pdelmodel: (PropagationDelayModel) outputs prop delay
         callbacks: obj providing callback interface, cf. event_callbacks module
+        batch: (bool) select the paths of clients needing circuits for the
+            same port need or stream together, see batch_path_selection
+        first_sample: (int) ID of first sample, the samples taking the
+            num_samples IDs from it, e.g. for a shard of the samples (see
+            parallel_simulation)
+        seed: (int) seed from which the random number generator of each
+            sample is derived (see sample_rng()), None to draw one from the
+            random module
     Output:
-        Uses callbacks to produce any desired output.
+        Uses callbacks to produce any desired output. Relays are identified
+        by ID (see relay_tables) in the circuits and relay data given to the
+        callbacks.
     """
     
     ### Simulation variables ###
@@ -1390,21 +2079,34 @@ def create_circuits(network_states, streams, num_samples, congmodel,
     stream_end = 0
     init = True
 
+    # relays are identified by IDs for the whole simulation
+    relay_ids = relay_tables.RelayIds()
+
     # store old descriptors (for entry guards that leave consensus)
     # initialize with add_descriptors 
-    descriptors = {}
+    descriptors = relay_tables.DescriptorTable()
+    new_descriptors = {}
     
     port_needs_global = {}
 
+    # optional callback marking each pass over the clients
+    start_segment = getattr(callbacks, 'start_segment', None)
+
     # client states for each sample
+    if (seed == None):
+        seed = random.randint(0, 2**32-1)
     client_states = []
-    for i in range(num_samples):
-        # guard is dict with client guard state (expiration, bad_since, etc.)
+    for i in range(first_sample, first_sample+num_samples):
+        # rng is random number generator used for all of the sample's draws
+        # guards is dict with client guard state (expiration, bad_since, etc.)
+        #   in order of addition, as in Tor's guard list, so that the guards
+        #   chosen for a circuit don't depend on the relay IDs
         # port_needs are ports that must be covered by existing circuits        
         # circuit vars are ordered by increasing time since create or dirty
         port_needs_covered = {}
         client_states.append({'id':i,
-                            'guards':{},
+                            'rng':sample_rng(seed, i),
+                            'guards':collections.OrderedDict(),
                             'port_needs_covered':port_needs_covered,
                             'clean_exit_circuits':collections.deque(),
                             'dirty_exit_circuits':collections.deque()})
@@ -1417,15 +2119,26 @@ def create_circuits(network_states, streams, num_samples, congmodel,
             cons_fresh_until = network_state.cons_fresh_until
             cons_bw_weights = network_state.cons_bw_weights
             cons_bwweightscale = network_state.cons_bwweightscale
-            cons_rel_stats = network_state.cons_rel_stats
-            hibernating_statuses = network_state.hibernating_statuses
-            new_descriptors = network_state.descriptors
+            cons_rel_stats = relay_ids.intern_keys(\
+                network_state.cons_rel_stats)
+            hibernating_statuses = relay_ids.intern_hibernating_statuses(\
+                network_state.hibernating_statuses)
+            old_descriptors = new_descriptors
+            new_descriptors = relay_ids.intern_keys(network_state.descriptors)
 
             # clear hibernating status to ensure updates come from ns_file
-            hibernating_status = {}
+            hibernating_status = relay_tables.RelayTable(\
+                [None] * len(relay_ids))
                         
             # update descriptors
             descriptors.update(new_descriptors)
+            # descriptors kept for relays that left are copied out of any
+            # columnar file, so that it isn't kept mapped
+            for relay_id in old_descriptors:
+                if (relay_id not in new_descriptors):
+                    descriptors[relay_id] =\
+                        network_state_formats.detach_descriptor(\
+                            descriptors[relay_id])
 
         else:
             # gap in consensuses, just advance an hour, keeping network state            
@@ -1493,6 +2206,8 @@ def create_circuits(network_states, streams, num_samples, congmodel,
         # Conservative - never excludes a relay that exits to port for some ip.
         # Use port of None to store exits for resolve circuits.
         stream_port_weighted_exits = {}
+        # exact exits for CONNECT streams, filtered from the port exits
+        exact_exits_cache = ExactExitsCache()
 
         # filter middles and precompute cumulative weights
         potential_middles = filter(lambda x: middle_filter(x, cons_rel_stats,\
@@ -1501,8 +2216,8 @@ def create_circuits(network_states, streams, num_samples, congmodel,
             print('# potential middles: {0}'.format(len(potential_middles)))                
         potential_middle_weights = get_position_weights(potential_middles,\
             cons_rel_stats, 'm', cons_bw_weights, cons_bwweightscale)
-        weighted_middles = get_weighted_nodes(potential_middles,\
-            potential_middle_weights)
+        weighted_middles = get_weighted_middles(potential_middles,\
+            potential_middle_weights, cons_rel_stats, descriptors)
             
         # filter guards and precompute cumulative weights
         # New guards are selected infrequently after the experiment start
@@ -1515,25 +2230,58 @@ def create_circuits(network_states, streams, num_samples, congmodel,
             cons_rel_stats, 'g', cons_bw_weights, cons_bwweightscale)
         weighted_guards = get_weighted_nodes(potential_guards,\
             potential_guard_weights)
+
+        if (batch):
+            selector = batch_path_selection.BatchPathSelector(cons_rel_stats,
+                descriptors, batch_seed(seed, first_sample, cons_valid_after))
+            selector.set_hibernating(hibernating_status)
        
-        # for simplicity, step through time one minute at a time
+        # step through time one minute at a time, skipping minutes without
+        # timed events or streams
         time_step = 60
+        timed_events = TimedEvents(cur_period_start, cur_period_end,
+            time_step)
         cur_time = cur_period_start
         while (cur_time < cur_period_end):
             # do updates that apply to all clients    
+            num_hibernating_statuses = len(hibernating_statuses)
             timed_updates(cur_time, port_needs_global, client_states,
                 hibernating_statuses, hibernating_status, cons_rel_stats)
+            hibernating_changed =\
+                (len(hibernating_statuses) != num_hibernating_statuses)
+
+            # update clients whose wake-up time has come, or all clients
+            # after a new consensus or hibernating status change, which are
+            # the only times that circuits can have hibernating relays
+            update_client_states = timed_events.due_clients(cur_time,
+                client_states)
+            kill_hibernating = (cur_time == cur_period_start) or\
+                (hibernating_changed)
+            if (kill_hibernating):
+                update_client_states = client_states
 
             # do timed individual client updates
-            for client_state in client_states:
-                if (callbacks is not None):
-                    callbacks.set_sample_id(client_state['id'])
-                timed_client_updates(cur_time, client_state,
-                    port_needs_global, cons_rel_stats,
-                    cons_valid_after, cons_fresh_until, cons_bw_weights,
+            if (start_segment is not None):
+                start_segment((cur_time, -1))
+            if (batch):
+                if (hibernating_changed):
+                    selector.set_hibernating(hibernating_status)
+                batch_timed_client_updates(cur_time, update_client_states,
+                    port_needs_global, cons_rel_stats, cons_bw_weights,
                     cons_bwweightscale, descriptors, hibernating_status,
                     port_need_weighted_exits, weighted_middles,
-                    weighted_guards, congmodel, pdelmodel, callbacks)
+                    weighted_guards, selector, callbacks, kill_hibernating)
+            else:
+                for client_state in update_client_states:
+                    if (callbacks is not None):
+                        callbacks.set_sample_id(client_state['id'])
+                    timed_client_updates(cur_time, client_state,
+                        port_needs_global, cons_rel_stats,
+                        cons_valid_after, cons_fresh_until, cons_bw_weights,
+                        cons_bwweightscale, descriptors, hibernating_status,
+                        port_need_weighted_exits, weighted_middles,
+                        weighted_guards, congmodel, pdelmodel, callbacks,
+                        kill_hibernating)
                     
             # collect streams that occur during current period
             while (stream_start < len(streams)) and\
@@ -1564,26 +2312,52 @@ def create_circuits(network_states, streams, num_samples, congmodel,
                         get_stream_port_weighted_exits(stream_port, stream,
                         cons_rel_stats, descriptors,
                         cons_bw_weights, cons_bwweightscale)
+                stream_weighted_exits = get_stream_weighted_exits(stream,
+                    stream_port_weighted_exits[stream_port],
+                    exact_exits_cache, cons_rel_stats, descriptors,
+                    cons_bw_weights, cons_bwweightscale)
                 
                 # do client stream assignment
-                for client_state in client_states:
-                    if (callbacks is not None):
-                        callbacks.set_sample_id(client_state['id'])                
-                    if _testing:                
-                        print('Client {0} stream assignment.'.\
-                            format(client_state['id']))
-                    guards = client_state['guards']
-                 
-                    stream_assigned = client_assign_stream(\
-                        client_state, stream, cons_rel_stats,
-                        cons_valid_after, cons_fresh_until,
-                        cons_bw_weights, cons_bwweightscale,
+                if (start_segment is not None):
+                    start_segment((cur_time, stream_idx))
+                if (batch):
+                    batch_assign_stream(client_states, stream,
+                        cons_rel_stats, cons_bw_weights, cons_bwweightscale,
                         descriptors, hibernating_status,
-                        stream_port_weighted_exits[stream_port],
-                        weighted_middles, weighted_guards,
-                        congmodel, pdelmodel, callbacks)
-            
-            cur_time += time_step
+                        stream_weighted_exits,
+                        weighted_middles, weighted_guards, selector,
+                        callbacks)
+                else:
+                    for client_state in client_states:
+                        if (callbacks is not None):
+                            callbacks.set_sample_id(client_state['id'])
+                        if _testing:                
+                            print('Client {0} stream assignment.'.\
+                                format(client_state['id']))
+                        guards = client_state['guards']
+                 
+                        stream_assigned = client_assign_stream(\
+                            client_state, stream, cons_rel_stats,
+                            cons_valid_after, cons_fresh_until,
+                            cons_bw_weights, cons_bwweightscale,
+                            descriptors, hibernating_status,
+                            stream_weighted_exits,
+                            weighted_middles, weighted_guards,
+                            congmodel, pdelmodel, callbacks)
+
+            # schedule the next minute with timed events or streams
+            if (stream_end > stream_start):
+                # streams may have changed the circuits of any client
+                update_client_states = client_states
+            for client_state in update_client_states:
+                timed_events.wake_client(client_state,
+                    client_wake_time(cur_time, time_step, client_state,
+                        port_needs_global))
+            if (stream_end < len(streams)):
+                timed_events.add_stream(streams[stream_end]['time'])
+            schedule_timed_events(timed_events, port_needs_global,
+                hibernating_statuses)
+            cur_time = timed_events.next_minute(cur_time)
 
 
 def get_user_model(start_time, end_time, tracefilename=None,
@@ -1636,6 +2410,15 @@ directories are located')
         help='directory in which to locate output network state files')
     process_parser.add_argument('--fat', action='store_true',
         help='Output the "fat" representation instead of TorPS classes, which TorPS cannot use for simulation')
+    process_parser.add_argument('--format',
+        choices=['pickle', 'columnar', 'delta'], default='pickle',
+        help='format of output network state files: "pickle" writes pickled TorPS classes, "columnar" writes fixed-width relay columns that simulate reads from a memory-mapped file, "delta" writes pickled keyframes with files in between holding only changes from the previous hour')
+    process_parser.add_argument('--keyframe_interval', type=int, default=24,
+        help='number of consensuses per keyframe with --format delta, a keyframe also starts each month')
+    process_parser.add_argument('--workers', type=int, default=1,
+        help='number of processes among which to divide the consensuses of each month')
+    process_parser.add_argument('--force', action='store_true',
+        help='process every consensus, even those whose network state files are recorded as up to date in the output directory')
     process_parser.add_argument('--initial_descriptor_dir', default=None,
         help='Directory containing descriptors to initialize consensus processing. Needed to provide first consensuses in a month with descriptors only contained in archive from previous month. If omitted, first 24 hours of network state files will likely omit relays due to missing descriptors.')
 
@@ -1644,8 +2427,14 @@ directories are located')
         help='Do simulated path selections.')
     simulate_parser.add_argument('--nsf_dir', default='out/network-state-files',
         help='stores the network state files to use')
+    simulate_parser.add_argument('--start', default=None,
+        help='simulate from this UTC time, given as YYYY-MM-DD[-HH[-MM[-SS]]], using the network state files in --nsf_dir valid after it')
+    simulate_parser.add_argument('--end', default=None,
+        help='simulate until this UTC time, given as YYYY-MM-DD[-HH[-MM[-SS]]], using the network state files in --nsf_dir valid before it')
     simulate_parser.add_argument('--num_samples', type=int, default=1,
         help='number of simulations to execute')
+    simulate_parser.add_argument('--first_sample', type=int, default=0,
+        help='ID of the first sample, the samples taking the next num_samples IDs, e.g. to simulate one part of a larger simulation with the same seed (see job_runner.py)')
     simulate_parser.add_argument('--trace_file', default="in/users2-processed.traces.pickle",
         help='name of files containing the user traces')
     simulate_parser.add_argument('--user_model', default='simple=600',
@@ -1675,6 +2464,17 @@ consensuses')
     simulate_parser.add_argument('--guard_expiration', type=int, default=60,
         help='indicates time in days until one-month period during which guard\
 may expire, with 0 indicating no guard expiration')
+    simulate_parser.add_argument('--prefetch', type=int, default=0,
+        help='number of network states to load and modify in the background ahead of simulation, with 0 loading each only when needed')
+    simulate_parser.add_argument('--prefetch_mode', choices=['thread',
+        'process'], default='thread',
+        help='load network states in a background thread, or in a background process that also takes unpickling and network modification off the simulation process')
+    simulate_parser.add_argument('--seed', type=int, default=None,
+        help='seed from which the random number generator of each sample is derived, so that a sample gives the same output however the samples are divided among processes; drawn at random if omitted')
+    simulate_parser.add_argument('--workers', type=int, default=1,
+        help='number of processes among which to divide the samples, whose output is merged into the order of a single process')
+    simulate_parser.add_argument('--shared_cache', default=None,
+        help='directory, ideally on a memory-backed filesystem such as /dev/shm, of a network state cache shared by simulations on this host, which decodes each network state once and reads it through a memory map')
     simulate_parser.add_argument('--loglevel', choices=['DEBUG', 'INFO',
         'WARNING', 'ERROR', 'CRITICAL'],
         help='set level of log messages to send to stdout, DEBUG produces testing output, quiet at all other levels', default='INFO')
@@ -1683,6 +2483,8 @@ may expire, with 0 indicating no guard expiration')
 commands', dest='pathalg_subparser')
     tor_simulate_parser = pathalg_subparsers.add_parser('tor',
         help='use vanilla Tor path selection')    
+    tor_simulate_parser.add_argument('--batch', action='store_true',
+        help='select the paths of all samples needing a circuit for the same port or stream together, which requires NumPy')
     cat_simulate_parser = pathalg_subparsers.add_parser('cat',
         help='use congestion-aware tor (Wang et al., FC12)')
     cat_simulate_parser.add_argument('--congfile', default=None,
@@ -1717,6 +2519,18 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
         default='bittorrent.log',
         help='name of file with BitTorrent trace')
 
+    cache_parser = subparsers.add_parser('cache',
+        help='Add network state files to a shared cache for simulations run \
+with --shared_cache, so that they need not decode them.')
+    cache_parser.add_argument('--nsf_dir', default='out/network-state-files',
+        help='stores the network state files to add')
+    cache_parser.add_argument('--cache_dir',
+        help='directory of shared network state cache')
+    cache_parser.add_argument('--start', default=None,
+        help='add network state files valid after this UTC time, given as YYYY-MM-DD[-HH[-MM[-SS]]]')
+    cache_parser.add_argument('--end', default=None,
+        help='add network state files valid before this UTC time, given as YYYY-MM-DD[-HH[-MM[-SS]]]')
+
     args = parser.parse_args()
 
     if (args.subparser == 'process'):
@@ -1742,8 +2556,15 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
                 in_dirs.append((cons_dir, desc_dir, desc_out_dir))
                 month += 1
             month = 1
+        if args.fat and (args.format != 'pickle'):
+            process_parser.error('--fat is only supported with --format pickle')
+        if (args.keyframe_interval < 1):
+            process_parser.error('--keyframe_interval must be positive')
+        if (args.workers < 1):
+            process_parser.error('--workers must be positive')
         process_consensuses.process_consensuses(in_dirs, args.fat,
-            args.initial_descriptor_dir)
+            args.initial_descriptor_dir, args.format, args.keyframe_interval,
+            args.workers, args.force)
     elif (args.subparser == 'simulate'):
         logging.basicConfig(stream=sys.stdout, level=getattr(logging,
             args.loglevel))    
@@ -1753,6 +2574,16 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
         else:
             _testing = False
 
+        if (args.pathalg_subparser == 'tor') and (args.batch) and\
+            (batch_path_selection.numpy is None):
+            tor_simulate_parser.error('--batch requires NumPy')
+        if (args.workers < 1):
+            simulate_parser.error('--workers must be positive')
+        if (args.first_sample < 0):
+            simulate_parser.error('--first_sample must be non-negative')
+        if (args.workers > 1) and (args.pathalg_subparser == 'vcs'):
+            simulate_parser.error('--workers is not supported with vcs')
+
         if (args.guard_expiration > 0):
             guard_expiration_min = args.guard_expiration*24*60*60
         else:
@@ -1766,16 +2597,20 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
         TorOptions.guard_expiration_max = guard_expiration_min + 30*24*3600
         
         ## create iterator producing sequence of simulation network states ##
-        # obtain list of network state files contained in nsf_dir
-        network_state_files = []
-        for dirpath, dirnames, filenames in os.walk(args.nsf_dir,
-            followlinks=True):
-            for filename in filenames:
-                if (filename[0] != '.'):
-                    network_state_files.append(os.path.join(dirpath,filename))
-        # insert gaps for missing time periods
-        network_state_files.sort(key = lambda x: os.path.basename(x))
-        network_state_files = pad_network_state_files(network_state_files)
+        # obtain list of network state files in period contained in nsf_dir
+        try:
+            if (args.start is not None):
+                start = timestamp_from_string(args.start)
+            else:
+                start = None
+            if (args.end is not None):
+                end = timestamp_from_string(args.end)
+            else:
+                end = None
+            network_state_files, start_time, end_time =\
+                get_network_state_files(args.nsf_dir, start, end)
+        except ValueError as e:
+            simulate_parser.error(str(e))
         # create object that will add adversarial relays into network
         adv_insertion = network_modifiers.AdversaryInsertion(args.adv_time,
             args.num_adv_guards, args.adv_guard_cons_bw, args.num_adv_exits,
@@ -1795,17 +2630,10 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
             network_modifiers.append(other_network_modifier)
         # create iterator that applies network modifiers to nsf list
         network_states = get_network_states(network_state_files,
-            network_modifiers)
-
-        # determine start and end times
-        start_time = None
-        with open(network_state_files[0]) as nsf:
-            consensus = pickle.load(nsf)
-            start_time = timestamp(consensus.valid_after)
-        end_time = None
-        with open(network_state_files[-1]) as nsf:
-            consensus = pickle.load(nsf)
-            end_time = timestamp(consensus.fresh_until)
+            network_modifiers, args.shared_cache)
+        if (args.prefetch > 0):
+            network_states = network_state_loader.prefetch(network_states,
+                args.prefetch, args.prefetch_mode)
 
         # get our stream creation model from our user traces
         # available sessions:
@@ -1845,8 +2673,51 @@ pathsim, and pickle it. The pickled object is input to the simulate command')
         callbacks.start()
 
         # simulate circuit creation and stream assignment
-        create_circuits(network_states, streams, args.num_samples, congmodel,
-            pdelmodel, callbacks)
+        if (args.seed is not None):
+            seed = args.seed
+        else:
+            seed = random.randint(0, 2**32-1)
+        if (args.pathalg_subparser == 'tor') and (args.batch):
+            batch = True
+        else:
+            batch = False
+        if (args.workers > 1):
+            # each worker writes to its own buffer, without a header
+            make_callbacks = lambda out_file: output_class(args.format,
+                _testing, file=out_file)
+            parallel_simulation.simulate(create_circuits, network_states,
+                streams, args.num_samples, congmodel, pdelmodel,
+                make_callbacks, args.workers, sys.stdout, args.first_sample,
+                batch=batch, seed=seed)
+        elif (batch):
+            create_circuits(network_states, streams, args.num_samples,
+                congmodel, pdelmodel, callbacks, batch=True,
+                first_sample=args.first_sample, seed=seed)
+        else:
+            create_circuits(network_states, streams, args.num_samples,
+                congmodel, pdelmodel, callbacks,
+                first_sample=args.first_sample, seed=seed)
+    elif (args.subparser == 'cache'):
+        if (args.cache_dir is None):
+            cache_parser.error('--cache_dir is required')
+        try:
+            if (args.start is not None):
+                start = timestamp_from_string(args.start)
+            else:
+                start = None
+            if (args.end is not None):
+                end = timestamp_from_string(args.end)
+            else:
+                end = None
+            network_state_files, start_time, end_time =\
+                get_network_state_files(args.nsf_dir, start, end)
+        except ValueError as e:
+            cache_parser.error(str(e))
+        cache = network_state_cache.SharedNetworkStateCache(args.cache_dir)
+        for ns_file in network_state_files:
+            if (ns_file is not None):
+                print('Cached {0} as {1}'.format(ns_file,
+                    cache.add(ns_file)))
     elif (args.subparser == 'concattraces'):
         ut = UserTraces(args.facebook_filename, args.gmailchat_filename,
             args.gcalgdocs_filename, args.websearch_filename,
@@ -5,10 +5,408 @@ import stem
 import os
 import os.path
 import cPickle as pickle
+import datetime
+import hashlib
+import heapq
+from bisect import bisect_left, bisect_right, insort
+import multiprocessing
+import tempfile
+import network_state_formats
+
+
+class DescriptorIndex(object):
+    """Descriptors by relay fingerprint and publication time. Keeps the
+    publication times of each relay sorted so that matching descriptors
+    to a consensus takes logarithmic rather than linear time per relay.
+    If slim, descriptors are stored as pathsim.ServerDescriptor objects
+    rather than full stem descriptors."""
+
+    def __init__(self, slim):
+        self.slim = slim
+        # fingerprint keys and dicts of descriptors by publication time vals
+        self.descriptors = {}
+        # fingerprint keys and sorted lists of publication times vals
+        self.times = {}
+
+    def __contains__(self, fprint):
+        return (fprint in self.descriptors)
+
+    def add(self, fprint, t, desc):
+        """Stores descriptor of relay fprint published at time t."""
+        if (fprint not in self.descriptors):
+            self.descriptors[fprint] = {}
+            self.times[fprint] = []
+        if (t not in self.descriptors[fprint]):
+            insort(self.times[fprint], t)
+        self.descriptors[fprint][t] = desc
+
+    def get(self, fprint, t):
+        """Returns descriptor of relay fprint published at time t."""
+        return self.descriptors[fprint][t]
+
+    def latest(self, fprint, min_time, max_time):
+        """Returns latest publication time t of relay fprint with
+        min_time < t <= max_time, or None if none exists."""
+        times = self.times[fprint]
+        i = bisect_right(times, max_time)
+        if (i > 0) and (times[i-1] > min_time):
+            return times[i-1]
+        return None
+
+    def latest_else_earliest(self, fprint, t):
+        """Returns latest publication time of relay fprint before t, or the
+        earliest if none are before t."""
+        times = self.times[fprint]
+        i = bisect_left(times, t)
+        if (i > 0):
+            return times[i-1]
+        return times[0]
+
+    def evict(self, cutoff):
+        """Removes descriptors that no consensus valid after
+        cutoff+router_max_age can use. For each relay, those published at
+        or before cutoff are removed except the latest, which may still
+        give the initial hibernation status.
+        Output:
+            num_evicted: number of descriptors removed
+        """
+        num_evicted = 0
+        for fprint, times in self.times.iteritems():
+            i = bisect_right(times, cutoff)
+            if (i > 1):
+                descriptors = self.descriptors[fprint]
+                for t in times[:i-1]:
+                    del descriptors[t]
+                del times[:i-1]
+                num_evicted += i-1
+        return num_evicted
+
+    def between(self, fprint, start, end):
+        """Returns list of (time, descriptor) pairs of relay fprint with
+        start <= time <= end, in time order."""
+        times = self.times[fprint]
+        descriptors = self.descriptors[fprint]
+        return [(t, descriptors[t]) for t in\
+            times[bisect_left(times, start):bisect_right(times, end)]]
+
+
+# number of descriptors a DescriptorSpool sorts in memory before writing
+# them to a temporary file
+DESCRIPTOR_RUN_SIZE = 50000
+
+
+def _read_run(f):
+    """Generator yielding the records pickled to run file f, closing it
+    once they are read."""
+    try:
+        while True:
+            yield pickle.load(f)
+    except EOFError:
+        pass
+    f.close()
+
+
+class DescriptorSpool(object):
+    """Descriptors read from archives, which are in no particular time
+    order, to be added to a DescriptorIndex in order of publication time as
+    processing advances through the consensuses. Descriptors are sorted in
+    runs of run_size, each written to a temporary file, and the runs are
+    merged as the descriptors are added, so only one run is held in memory
+    rather than all of the descriptors read."""
+
+    def __init__(self, slim, run_size=DESCRIPTOR_RUN_SIZE):
+        self.slim = slim
+        self.run_size = run_size
+        self.fingerprints = set()
+        # (time, sequence number, fingerprint, descriptor) records of the
+        # current run, and the files of the runs written out
+        self.run = []
+        self.run_files = []
+        self.num_descriptors = 0
+        # merged records, once advance() has been called
+        self.records = None
+        self.next_record = None
+
+    def __contains__(self, fprint):
+        return (fprint in self.fingerprints)
+
+    def add(self, fprint, t, desc):
+        """Stores descriptor of relay fprint published at time t."""
+        if (self.records is not None):
+            raise ValueError('Descriptors cannot be added to a DescriptorSpool being advanced.')
+        # the sequence number keeps descriptors of equal time in the order
+        # read, so that the last read of any duplicates is kept as before
+        self.run.append((t, self.num_descriptors, fprint, desc))
+        self.num_descriptors += 1
+        self.fingerprints.add(fprint)
+        if (len(self.run) >= self.run_size):
+            self.spill()
+
+    def spill(self):
+        """Writes the current run, sorted, to a temporary file."""
+        self.run.sort()
+        f = tempfile.TemporaryFile()
+        for record in self.run:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+        f.seek(0)
+        self.run_files.append(f)
+        self.run = []
+
+    def advance(self, descriptors, max_time=None):
+        """Adds to DescriptorIndex descriptors those not yet added that were
+        published at or before max_time, or all of them if None, in time
+        order."""
+        if (self.records is None):
+            self.run.sort()
+            self.records = heapq.merge(self.run,
+                *[_read_run(f) for f in self.run_files])
+            self.next_record = next(self.records, None)
+        while (self.next_record is not None) and\
+            ((max_time is None) or (self.next_record[0] <= max_time)):
+            t, seq, fprint, desc = self.next_record
+            descriptors.add(fprint, t, desc)
+            self.next_record = next(self.records, None)
+
+
+def read_consensus_period(pathname):
+    """Returns (valid_after, fresh_until) timestamps from the header of
+    consensus file pathname, or None if they aren't found."""
+    times = {}
+    f = open(pathname, 'rb')
+    for line in f:
+        if (line.startswith('valid-after ')) or\
+            (line.startswith('fresh-until ')):
+            keyword, value = line.strip().split(' ', 1)
+            try:
+                times[keyword] = pathsim.timestamp(\
+                    datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S'))
+            except ValueError:
+                break
+            if (len(times) == 2):
+                break
+        elif (line.startswith('dir-source ')) or\
+            (line.startswith('r ')):
+            # past the header
+            break
+    f.close()
+    if (len(times) < 2):
+        return None
+    return (times['valid-after'], times['fresh-until'])
+
+
+# files kept in each network state directory to make processing incremental
+MANIFEST_NAME = '.process_manifest'
+CHECKPOINT_NAME = '.descriptor_index'
+MANIFEST_VERSION = 2
+
+
+def file_state(path, old_state=None):
+    """Returns (size, mtime, md5 hex digest) of file at path. The digest of
+    old_state is reused if the size and mtime are unchanged."""
+    stat = os.stat(path)
+    if (old_state is not None) and (old_state[0] == stat.st_size) and\
+        (old_state[1] == stat.st_mtime):
+        return old_state
+    md5 = hashlib.md5()
+    f = open(path, 'rb')
+    while True:
+        block = f.read(1 << 20)
+        if (not block):
+            break
+        md5.update(block)
+    f.close()
+    return (stat.st_size, stat.st_mtime, md5.hexdigest())
+
+
+def same_contents(state1, state2):
+    """Returns if file states from file_state() have the same contents."""
+    return (state1 is not None) and (state2 is not None) and\
+        (state1[0] == state2[0]) and (state1[2] == state2[2])
+
+
+def file_states(paths, old_states):
+    """Returns dict of file_state() of each file at or under paths, using
+    digests of the file states in dict old_states where unchanged."""
+    states = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, fnames in os.walk(path):
+                for fname in fnames:
+                    pathname = os.path.join(dirpath, fname)
+                    states[pathname] = file_state(pathname,
+                        old_states.get(pathname))
+        elif os.path.exists(path):
+            states[path] = file_state(path, old_states.get(path))
+    return states
+
+
+def output_state(path):
+    """Returns (size, mtime) of output file at path, or None if missing."""
+    if (not os.path.exists(path)):
+        return None
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime)
+
+
+class ProcessManifest(object):
+    """Record of processing the consensuses of one month, kept in the
+    month's network state directory. The file holds a pickled header of the
+    options and descriptor inputs, followed by a pickled record appended as
+    each network state file is written, and one appended once the
+    descriptors carried over to the next month are saved. A record cut
+    short by a crash is dropped, so an interrupted run resumes with the
+    consensuses not yet recorded."""
+
+    def __init__(self, desc_out_dir):
+        self.desc_out_dir = desc_out_dir
+        self.path = os.path.join(desc_out_dir, MANIFEST_NAME)
+        self.header = None
+        # consensus pathname keys and (input state, output filename,
+        # output state, (valid_after, fresh_until, number of relays)) vals
+        self.consensuses = {}
+        # file state of descriptor checkpoint, None if not yet saved
+        self.checkpoint_state = None
+
+    def load(self):
+        """Reads the manifest file, if any."""
+        if (not os.path.exists(self.path)):
+            return
+        f = open(self.path, 'rb')
+        end = 0
+        try:
+            header = pickle.load(f)
+            if (header.get('version') == MANIFEST_VERSION):
+                self.header = header
+                end = f.tell()
+                while True:
+                    record = pickle.load(f)
+                    if (record[0] == 'consensus'):
+                        self.consensuses[record[1]] = record[2:]
+                    else:
+                        self.checkpoint_state = record[1]
+                    end = f.tell()
+        except (EOFError, ValueError, IndexError, AttributeError,
+            pickle.UnpicklingError):
+            # end of records, possibly with one cut short
+            pass
+        f.close()
+        if (self.header is not None) and\
+            (end < os.path.getsize(self.path)):
+            f = open(self.path, 'r+b')
+            f.truncate(end)
+            f.close()
+
+    def matches(self, header, same_consensus_files):
+        """Returns if header has the options and descriptor inputs of the
+        stored header and, if same_consensus_files, the consensus files."""
+        if (self.header is None) or\
+            (self.header['options'] != header['options']) or\
+            (same_consensus_files and (self.header['consensus_files'] !=\
+                header['consensus_files'])):
+            return False
+        old_inputs = self.header['descriptor_inputs']
+        new_inputs = header['descriptor_inputs']
+        if (len(old_inputs) != len(new_inputs)):
+            return False
+        for path, state in new_inputs.iteritems():
+            if (not same_contents(old_inputs.get(path), state)):
+                return False
+        return True
+
+    def write(self, header, keep_records):
+        """Replaces the manifest file with header, followed by the current
+        records if keep_records and no records otherwise."""
+        if (not keep_records):
+            self.consensuses = {}
+            self.checkpoint_state = None
+        self.header = header
+        tmp_path = self.path + '.tmp'
+        f = open(tmp_path, 'wb')
+        pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+        for pathname, record in self.consensuses.iteritems():
+            pickle.dump(('consensus', pathname) + record, f,
+                pickle.HIGHEST_PROTOCOL)
+        if (self.checkpoint_state is not None):
+            pickle.dump(('checkpoint', self.checkpoint_state), f,
+                pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp_path, self.path)
+
+    def append(self, record):
+        f = open(self.path, 'ab')
+        pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def input_state(self, pathname):
+        """Returns recorded file state of consensus file, or None."""
+        if (pathname in self.consensuses):
+            return self.consensuses[pathname][0]
+        return None
+
+    def is_current(self, pathname, input_state):
+        """Returns if the output of consensus file pathname with input_state
+        was recorded and is unchanged."""
+        if (pathname not in self.consensuses):
+            return False
+        old_input_state, outname, out_state, period =\
+            self.consensuses[pathname]
+        if (not same_contents(old_input_state, input_state)):
+            return False
+        return (outname is None) or (output_state(os.path.join(\
+            self.desc_out_dir, outname)) == out_state)
+
+    def index_entries(self, pathnames):
+        """Returns network_state_formats index entries of the recorded
+        output files of consensus files pathnames, in order."""
+        entries = []
+        for pathname in pathnames:
+            input_state, outname, out_state, period =\
+                self.consensuses[pathname]
+            if (outname is not None):
+                entries.append(period + (outname,))
+        return entries
+
+    def record_consensus(self, pathname, input_state, outpath, period):
+        """Records output file outpath of consensus file pathname, with its
+        (valid_after, fresh_until, number of relays) period. outpath and
+        period are None if the consensus could not be parsed."""
+        if (outpath is None):
+            record = (input_state, None, None, None)
+        else:
+            record = (input_state, os.path.basename(outpath),
+                output_state(outpath), period)
+        self.consensuses[pathname] = record
+        self.append(('consensus', pathname) + record)
+
+    def record_checkpoint(self, state):
+        """Records file state of the saved descriptor checkpoint."""
+        self.checkpoint_state = state
+        self.append(('checkpoint', state))
+
+
+def write_descriptor_index(descriptors, path):
+    """Pickles DescriptorIndex to path, replacing any file there only once
+    completely written."""
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    pickle.dump(descriptors, f, pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(tmp_path, path)
+
+
+def read_descriptor_index(path):
+    """Returns DescriptorIndex pickled to path."""
+    print('Reading carried-over descriptors from: {0}'.format(path))
+    f = open(path, 'rb')
+    descriptors = pickle.load(f)
+    f.close()
+    return descriptors
 
 
 def read_descriptors(descriptors, descriptor_dir, skip_listener):
-	"""Add to descriptors contents of descriptor archive in descriptor_dir."""
+	"""Add to DescriptorIndex or DescriptorSpool descriptors contents of descriptor archive in descriptor_dir."""
 
         num_descriptors = 0    
         num_relays = 0
@@ -36,215 +434,429 @@ def read_descriptors(descriptors, descriptor_dir, skip_listener):
                     print('{0} descriptors processed.'.format(num_descriptors))
                 num_descriptors += 1
                 if (desc.fingerprint not in descriptors):
-                    descriptors[desc.fingerprint] = {}
                     num_relays += 1
                     # stuff type annotation into stem object
-                desc.type_annotation = cur_type_annotation[0]
-                descriptors[desc.fingerprint]\
-                    [pathsim.timestamp(desc.published)] = desc
+                desc_time = pathsim.timestamp(desc.published)
+                if descriptors.slim:
+                    # keep only the fields used in simulation
+                    desc = pathsim.ServerDescriptor(desc.fingerprint,
+                        desc.hibernating, desc.nickname, desc.family,
+                        desc.address, desc.exit_policy, desc.ntor_onion_key)
+                else:
+                    desc.type_annotation = cur_type_annotation[0]
+                descriptors.add(desc.fingerprint, desc_time, desc)
         print('#descriptors: {0}; #relays:{1}'.\
             format(num_descriptors,num_relays)) 
 
 
-def process_consensuses(in_dirs, fat, initial_descriptor_dir):
+# descriptors read by pool workers, which inherit them when forked
+_worker_descriptors = None
+
+
+def process_consensus_files(pathnames, descriptors, fat, desc_out_dir,
+    out_format, keyframe_interval, log):
+    """Processes consecutive consensus files, writing a network state file
+    for each. With 'delta' out_format, a keyframe is written for the first
+    file and every keyframe_interval files after it.
+        Inputs:
+            pathnames: list of consensus filenames *in order*
+            descriptors: DescriptorIndex of descriptors to match, only read
+            fat: Whether to use "fat" (aka full) representation or custom slim classes
+            desc_out_dir: directory to write network state files into
+            out_format: see process_consensuses()
+            keyframe_interval: see process_consensuses()
+            log: function called with each line of progress output
+        Output:
+            outputs: list with (network state file path, (valid_after,
+                fresh_until, number of relays)) for each consensus file, or
+                (None, None) if it could not be parsed
+    """
+    outputs = []
+    # previous output file, which delta files are encoded against
+    prev_outname = None
+    prev_rel_stats = None
+    prev_descriptors = None
+    for file_index, pathname in enumerate(pathnames):
+        filename = os.path.basename(pathname)
+        log('Processing consensus file {0}'.format(filename))
+        cons_f = open(pathname, 'rb')
+
+        # store metrics type annotation line
+        initial_position = cons_f.tell()
+        first_line = cons_f.readline()
+        if (first_line[0:5] == '@type'):
+            type_annotation = first_line
+        else:
+            type_annotation = None
+        cons_f.seek(initial_position)
+
+        descriptors_out = dict()
+        hibernating_statuses = [] # (time, fprint, hibernating)
+        cons_valid_after = None
+        cons_fresh_until = None
+        if not fat:
+            cons_bw_weights = None
+            cons_bwweightscale = None
+            relays = {}
+        num_not_found = 0
+        num_found = 0
+        # read in consensus document
+        i = 0
+        for document in stem.descriptor.parse_file(cons_f, validate=True,
+            document_handler='DOCUMENT'):
+            if (i > 0):
+                raise ValueError('Unexpectedly found more than one consensus in file: {}'.\
+                    format(pathname))
+            if (cons_valid_after == None):
+                cons_valid_after = document.valid_after
+                # compute timestamp version once here
+                valid_after_ts = pathsim.timestamp(cons_valid_after)
+            if (cons_fresh_until == None):
+                cons_fresh_until = document.fresh_until
+                # compute timestamp version once here
+                fresh_until_ts = pathsim.timestamp(cons_fresh_until)
+            if not fat:
+                if (cons_bw_weights == None):
+                    cons_bw_weights = document.bandwidth_weights
+                if (cons_bwweightscale == None) and \
+                    ('bwweightscale' in document.params):
+                    cons_bwweightscale = document.params[\
+                            'bwweightscale']
+                for fprint, r_stat in document.routers.iteritems():
+                    relays[fprint] = pathsim.RouterStatusEntry(fprint, r_stat.nickname,
+                        r_stat.flags, r_stat.bandwidth)
+            consensus = document
+            i += 1
+                        
+
+        # find relays' most recent unexpired descriptor published
+        # before the publication time in the consensus
+        # and status changes in fresh period (i.e. hibernation)
+        for fprint, r_stat in consensus.routers.iteritems():
+            pub_time = pathsim.timestamp(r_stat.published)
+            desc_time = 0
+            descs_while_fresh = []
+            desc_time_fresh = None
+            # get all descriptors with this fingerprint
+            if (r_stat.fingerprint in descriptors):
+                # most recent unexpired desc published before cons pubtime
+                # allow pubtime after valid_after but not fresh_until
+                t = descriptors.latest(r_stat.fingerprint,
+                    max(valid_after_ts-pathsim.TorOptions.router_max_age, 0),
+                    min(pub_time, fresh_until_ts))
+                if (t is not None):
+                    desc_time = t
+                # store fresh-period descs for hibernation tracking
+                descs_while_fresh = descriptors.between(r_stat.fingerprint,
+                    valid_after_ts, fresh_until_ts)
+                # find most recent hibernating stat before fresh period
+                # prefer most-recent descriptor before fresh period
+                # but use oldest at or after valid_after if necessary
+                desc_time_fresh = descriptors.latest_else_earliest(\
+                    r_stat.fingerprint, valid_after_ts)
+
+            # output best descriptor if found
+            if (desc_time != 0):
+                num_found += 1
+                # store discovered recent descriptor
+                desc = descriptors.get(r_stat.fingerprint, desc_time)
+                if not fat:
+                    # descriptors are slim when not fat
+                    descriptors_out[r_stat.fingerprint] = desc
+                else:
+                    if (desc.type_annotation is not None):
+                        descriptors_out[r_stat.fingerprint] = desc.type_annotation + str(desc)
+                    else:
+                        descriptors_out[r_stat.fingerprint] = str(desc)
+                 
+                # store hibernating statuses
+                if (desc_time_fresh == None):
+                    raise ValueError('Descriptor error for {0}:{1}.\n Found  descriptor before published date {2}: {3}\nDid not find descriptor for initial hibernation status for fresh period starting {4}.'.format(r_stat.nickname, r_stat.fingerprint, pub_time, desc_time, valid_after_ts))
+                desc = descriptors.get(r_stat.fingerprint, desc_time_fresh)
+                cur_hibernating = desc.hibernating
+                # setting initial status
+                hibernating_statuses.append((0, desc.fingerprint,\
+                    cur_hibernating))
+                if (cur_hibernating):
+                    log('{0}:{1} was hibernating at consenses period start'.format(desc.nickname, desc.fingerprint))
+                for (t,d) in descs_while_fresh:
+                    if (d.hibernating != cur_hibernating):
+                        cur_hibernating = d.hibernating                                   
+                        hibernating_statuses.append(\
+                            (t, d.fingerprint, cur_hibernating))
+                        if (cur_hibernating):
+                            log('{0}:{1} started hibernating at {2}'\
+                                .format(d.nickname, d.fingerprint, t))
+                        else:
+                            log('{0}:{1} stopped hibernating at {2}'\
+                                .format(d.nickname, d.fingerprint, t))                   
+            else:
+#                            log(\
+#                            'Descriptor not found for {0}:{1}:{2}'.format(\
+#                                r_stat.nickname,r_stat.fingerprint, pub_time))
+                num_not_found += 1
+                
+        # output pickled consensus, recent descriptors, and
+        # hibernating status changes
+        if (cons_valid_after != None) and\
+            (cons_fresh_until != None):
+            if not fat:
+                consensus_out = pathsim.NetworkStatusDocument(\
+                    cons_valid_after, cons_fresh_until, cons_bw_weights,\
+                    cons_bwweightscale, relays)
+            else:
+                if (type_annotation is not None):
+                    consensus_out = type_annotation + str(consensus)
+                else:
+                    consensus_out = str(consensus)
+            hibernating_statuses.sort(key = lambda x: x[0],\
+                reverse=True)
+            outpath = os.path.join(desc_out_dir,\
+                cons_valid_after.strftime(\
+                    '%Y-%m-%d-%H-%M-%S-network_state'))
+            if (out_format == 'delta'):
+                rel_stats_out = dict((fprint, relays[fprint]) for\
+                    fprint in descriptors_out)
+            if (out_format == 'columnar'):
+                network_state_formats.write_columnar_network_state(\
+                    outpath, valid_after_ts, fresh_until_ts,
+                    cons_bw_weights, cons_bwweightscale, relays,
+                    descriptors_out, hibernating_statuses)
+            elif (out_format == 'delta') and\
+                (prev_outname != None) and\
+                (file_index % keyframe_interval != 0):
+                network_state_formats.write_network_state_delta(\
+                    outpath, prev_outname, valid_after_ts,
+                    fresh_until_ts, cons_bw_weights, cons_bwweightscale,
+                    prev_rel_stats, prev_descriptors, rel_stats_out,
+                    descriptors_out, hibernating_statuses)
+            else:
+                f = open(outpath, 'wb')
+                pickle.dump(consensus_out, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(descriptors_out,f,pickle.HIGHEST_PROTOCOL)
+                pickle.dump(hibernating_statuses,f,pickle.HIGHEST_PROTOCOL)
+                f.close()
+            if (out_format == 'delta'):
+                prev_outname = os.path.basename(outpath)
+                prev_rel_stats = rel_stats_out
+                prev_descriptors = descriptors_out
+
+            outputs.append((outpath, (valid_after_ts, fresh_until_ts,
+                num_found)))
+            log('Wrote descriptors for {0} relays.'.\
+                format(num_found))
+            log('Did not find descriptors for {0} relays\n'.\
+                format(num_not_found))
+        else:
+            log('Problem parsing {0}.'.format(filename))             
+            outputs.append((None, None))
+        
+        cons_f.close()
+
+    return outputs
+
+
+def _process_consensus_files_worker(args):
+    """Pool worker running process_consensus_files() on inherited
+    descriptors. Returns its output followed by lines of progress."""
+    pathnames, fat, desc_out_dir, out_format, keyframe_interval = args
+    lines = []
+    outputs = process_consensus_files(pathnames, _worker_descriptors, fat,
+        desc_out_dir, out_format, keyframe_interval, lines.append)
+    return (outputs, lines)
+
+
+def print_line(line):
+    print(line)
+
+
+def process_consensuses(in_dirs, fat, initial_descriptor_dir,
+    out_format='pickle', keyframe_interval=24, workers=1, force=False):
     """For every input consensus, finds the descriptors published most recently before the descriptor times listed for the relays in that consensus, records state changes indicated by descriptors published during the consensus fresh period, and writes out pickled consensus and descriptor objects with the relevant information.
+    Processing is incremental: a ProcessManifest in each output directory
+    records the input and output files, and consensuses whose network state
+    files are recorded and unchanged are skipped. The descriptors carried
+    over from each month are saved, so a month can be processed without
+    reading the descriptors of earlier months. Descriptors are added to the
+    index in time order as the consensuses are processed, and evicted once
+    no later consensus can use them (see DescriptorSpool).
         Inputs:
             in_dirs: list of (consensus in dir, descriptor in dir,
                 processed descriptor out dir) triples *in order*
             fat: Whether to use "fat" (aka full) representation or custom slim classes
             initial_descriptor_dir: Contains descriptors to initialize processing.
+            out_format: 'pickle' for pickled objects, 'columnar' for
+                network_state_formats columnar files, or 'delta' for pickled
+                keyframes and network_state_formats delta files in between
+                (columnar and delta not usable with fat)
+            keyframe_interval: number of consensuses per keyframe for 'delta'
+                format, a keyframe always starts a month
+            workers: number of processes among which to divide the
+                consensuses of a month, which share the descriptors read
+            force: if True, ignore manifests and process every consensus
     """
-    descriptors = {}
+    global _worker_descriptors
     def skip_listener(path, exception):
         print('ERROR [{0}]: {1}'.format(path.encode('ascii', 'ignore'), exception.__unicode__().encode('ascii','ignore')))
         
     if fat:
         print('Outputting fat classes.')
-        
-    # initialize descriptors
-    if (initial_descriptor_dir is not None):
-    	read_descriptors(descriptors, initial_descriptor_dir, skip_listener)
-        
-    for in_consensuses_dir, in_descriptors, desc_out_dir in in_dirs:
-		# read all descriptors into memory        
-    	read_descriptors(descriptors, in_descriptors, skip_listener)
 
-        # output pickled consensuses, dict of most recent descriptors, and 
-        # list of hibernation status changes
-        num_consensuses = 0
+    # descriptors as of the end of the previous month, read only once a
+    # month has consensuses to process
+    descriptors = None
+    prev_checkpoint_path = None
+    for in_consensuses_dir, in_descriptors, desc_out_dir in in_dirs:
         pathnames = []
         for dirpath, dirnames, fnames in os.walk(in_consensuses_dir):
             for fname in fnames:
-                pathnames.append(os.path.join(dirpath,fname))
+                if (fname[0] != '.'):
+                    pathnames.append(os.path.join(dirpath,fname))
         pathnames.sort()
-        for pathname in pathnames:
-            filename = os.path.basename(pathname)
-            if (filename[0] == '.'):
-                continue
-            
-            print('Processing consensus file {0}'.format(filename))
-            cons_f = open(pathname, 'rb')
-
-            # store metrics type annotation line
-            initial_position = cons_f.tell()
-            first_line = cons_f.readline()
-            if (first_line[0:5] == '@type'):
-                type_annotation = first_line
-            else:
-                type_annotation = None
-            cons_f.seek(initial_position)
 
-            descriptors_out = dict()
-            hibernating_statuses = [] # (time, fprint, hibernating)
-            cons_valid_after = None
-            cons_fresh_until = None
-            if not fat:
-                cons_bw_weights = None
-                cons_bwweightscale = None
-                relays = {}
-            num_not_found = 0
-            num_found = 0
-            # read in consensus document
-            i = 0
-            for document in stem.descriptor.parse_file(cons_f, validate=True,
-                document_handler='DOCUMENT'):
-                if (i > 0):
-                    raise ValueError('Unexpectedly found more than one consensus in file: {}'.\
-                        format(pathname))
-                if (cons_valid_after == None):
-                    cons_valid_after = document.valid_after
-                    # compute timestamp version once here
-                    valid_after_ts = pathsim.timestamp(cons_valid_after)
-                if (cons_fresh_until == None):
-                    cons_fresh_until = document.fresh_until
-                    # compute timestamp version once here
-                    fresh_until_ts = pathsim.timestamp(cons_fresh_until)
-                if not fat:
-                    if (cons_bw_weights == None):
-                        cons_bw_weights = document.bandwidth_weights
-                    if (cons_bwweightscale == None) and \
-                        ('bwweightscale' in document.params):
-                        cons_bwweightscale = document.params[\
-                                'bwweightscale']
-                    for fprint, r_stat in document.routers.iteritems():
-                        relays[fprint] = pathsim.RouterStatusEntry(fprint, r_stat.nickname,
-                            r_stat.flags, r_stat.bandwidth)
-                consensus = document
-                i += 1
-                            
-
-            # find relays' most recent unexpired descriptor published
-            # before the publication time in the consensus
-            # and status changes in fresh period (i.e. hibernation)
-            for fprint, r_stat in consensus.routers.iteritems():
-                pub_time = pathsim.timestamp(r_stat.published)
-                desc_time = 0
-                descs_while_fresh = []
-                desc_time_fresh = None
-                # get all descriptors with this fingerprint
-                if (r_stat.fingerprint in descriptors):
-                    for t,d in descriptors[r_stat.fingerprint].items():
-                        # update most recent desc seen before cons pubtime
-                        # allow pubtime after valid_after but not fresh_until
-                        if (valid_after_ts-t <\
-                            pathsim.TorOptions.router_max_age) and\
-                            (t <= pub_time) and (t > desc_time) and\
-                            (t <= fresh_until_ts):
-                            desc_time = t
-                        # store fresh-period descs for hibernation tracking
-                        if (t >= valid_after_ts) and \
-                            (t <= fresh_until_ts):
-                            descs_while_fresh.append((t,d))                                
-                        # find most recent hibernating stat before fresh period
-                        # prefer most-recent descriptor before fresh period
-                        # but use oldest after valid_after if necessary
-                        if (desc_time_fresh == None):
-                            desc_time_fresh = t
-                        elif (desc_time_fresh < valid_after_ts):
-                            if (t > desc_time_fresh) and\
-                                (t <= valid_after_ts):
-                                desc_time_fresh = t
-                        else:
-                            if (t < desc_time_fresh):
-                                desc_time_fresh = t
-
-                # output best descriptor if found
-                if (desc_time != 0):
-                    num_found += 1
-                    # store discovered recent descriptor
-                    desc = descriptors[r_stat.fingerprint][desc_time]
-                    if not fat:
-                        descriptors_out[r_stat.fingerprint] = \
-                            pathsim.ServerDescriptor(desc.fingerprint, \
-                                desc.hibernating, desc.nickname, \
-                                desc.family, desc.address, \
-                                desc.exit_policy, desc.ntor_onion_key)
-                    else:
-                        if (desc.type_annotation is not None):
-                            descriptors_out[r_stat.fingerprint] = desc.type_annotation + str(desc)
-                        else:
-                            descriptors_out[r_stat.fingerprint] = str(desc)
-                     
-                    # store hibernating statuses
-                    if (desc_time_fresh == None):
-                        raise ValueError('Descriptor error for {0}:{1}.\n Found  descriptor before published date {2}: {3}\nDid not find descriptor for initial hibernation status for fresh period starting {4}.'.format(r_stat.nickname, r_stat.fingerprint, pub_time, desc_time, valid_after_ts))
-                    desc = descriptors[r_stat.fingerprint][desc_time_fresh]
-                    cur_hibernating = desc.hibernating
-                    # setting initial status
-                    hibernating_statuses.append((0, desc.fingerprint,\
-                        cur_hibernating))
-                    if (cur_hibernating):
-                        print('{0}:{1} was hibernating at consenses period start'.format(desc.nickname, desc.fingerprint))
-                    descs_while_fresh.sort(key = lambda x: x[0])
-                    for (t,d) in descs_while_fresh:
-                        if (d.hibernating != cur_hibernating):
-                            cur_hibernating = d.hibernating                                   
-                            hibernating_statuses.append(\
-                                (t, d.fingerprint, cur_hibernating))
-                            if (cur_hibernating):
-                                print('{0}:{1} started hibernating at {2}'\
-                                    .format(d.nickname, d.fingerprint, t))
-                            else:
-                                print('{0}:{1} stopped hibernating at {2}'\
-                                    .format(d.nickname, d.fingerprint, t))                   
-                else:
-#                            print(\
-#                            'Descriptor not found for {0}:{1}:{2}'.format(\
-#                                r_stat.nickname,r_stat.fingerprint, pub_time))
-                    num_not_found += 1
-                    
-            # output pickled consensus, recent descriptors, and
-            # hibernating status changes
-            if (cons_valid_after != None) and\
-                (cons_fresh_until != None):
-                if not fat:
-                    consensus_out = pathsim.NetworkStatusDocument(\
-                        cons_valid_after, cons_fresh_until, cons_bw_weights,\
-                        cons_bwweightscale, relays)
-                else:
-                    if (type_annotation is not None):
-                        consensus_out = type_annotation + str(consensus)
-                    else:
-                        consensus_out = str(consensus)
-                hibernating_statuses.sort(key = lambda x: x[0],\
-                    reverse=True)
-                outpath = os.path.join(desc_out_dir,\
-                    cons_valid_after.strftime(\
-                        '%Y-%m-%d-%H-%M-%S-network_state'))
-                f = open(outpath, 'wb')
-                pickle.dump(consensus_out, f, pickle.HIGHEST_PROTOCOL)
-                pickle.dump(descriptors_out,f,pickle.HIGHEST_PROTOCOL)
-                pickle.dump(hibernating_statuses,f,pickle.HIGHEST_PROTOCOL)
-                f.close()
+        # compare the inputs with those recorded in the manifest
+        manifest = ProcessManifest(desc_out_dir)
+        if (not force):
+            manifest.load()
+        if (prev_checkpoint_path is not None):
+            carry_over = [prev_checkpoint_path]
+        elif (initial_descriptor_dir is not None):
+            carry_over = [initial_descriptor_dir]
+        else:
+            carry_over = []
+        if (manifest.header is not None):
+            old_inputs = manifest.header['descriptor_inputs']
+        else:
+            old_inputs = {}
+        header = {'version':MANIFEST_VERSION,
+            'options':(fat, out_format, keyframe_interval),
+            'descriptor_inputs':file_states(carry_over + [in_descriptors],
+                old_inputs),
+            'consensus_files':pathnames}
+        # delta files depend on the files before them in the month
+        if manifest.matches(header, out_format == 'delta'):
+            if (header != manifest.header):
+                manifest.write(header, True)
+        else:
+            manifest.write(header, False)
+        input_states = dict((pathname, file_state(pathname,
+            manifest.input_state(pathname))) for pathname in pathnames)
 
-                print('Wrote descriptors for {0} relays.'.\
-                    format(num_found))
-                print('Did not find descriptors for {0} relays\n'.\
-                    format(num_not_found))
+        # divide into runs, each starting with a keyframe for delta format,
+        # and find those with any consensus not yet processed
+        if (out_format == 'delta'):
+            run_length = keyframe_interval
+        else:
+            run_length = 1
+        runs = [pathnames[i:i+run_length] for i in\
+            xrange(0, len(pathnames), run_length)]
+        stale_runs = []
+        for run in runs:
+            for pathname in run:
+                if (not manifest.is_current(pathname,
+                    input_states[pathname])):
+                    stale_runs.append(run)
+                    break
+        checkpoint_path = os.path.join(desc_out_dir, CHECKPOINT_NAME)
+        if (not stale_runs) and (os.path.exists(checkpoint_path)) and\
+            (same_contents(manifest.checkpoint_state,
+                file_state(checkpoint_path, manifest.checkpoint_state))):
+            print('Network state files in {0} are up to date.'.\
+                format(desc_out_dir))
+            if (not os.path.exists(os.path.join(desc_out_dir,
+                network_state_formats.INDEX_NAME))):
+                network_state_formats.write_network_state_index(\
+                    desc_out_dir, manifest.index_entries(pathnames))
+            descriptors = None
+            prev_checkpoint_path = checkpoint_path
+            continue
+
+        # descriptors are read into a spool and added to the index in time
+        # order as processing advances through the month
+        spool = DescriptorSpool(not fat)
+        if (descriptors is None):
+            if (prev_checkpoint_path is not None):
+                descriptors = read_descriptor_index(prev_checkpoint_path)
             else:
-                print('Problem parsing {0}.'.format(filename))             
-            num_consensuses += 1
-            
-            cons_f.close()
+                # only the slim descriptor fields are needed unless
+                # outputting fat
+                descriptors = DescriptorIndex(not fat)
+                # initialize descriptors
+                if (initial_descriptor_dir is not None):
+                    read_descriptors(spool, initial_descriptor_dir,
+                        skip_listener)
+        read_descriptors(spool, in_descriptors, skip_listener)
+
+        # the index is rewritten once the month is complete
+        index_path = os.path.join(desc_out_dir,
+            network_state_formats.INDEX_NAME)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        # output pickled consensuses, dict of most recent descriptors, and 
+        # list of hibernation status changes
+        num_consensuses = 0
+        num_skipped = len(pathnames) - sum(len(run) for run in stale_runs)
+        if (num_skipped > 0):
+            print('Skipping {0} up-to-date consensus files.'.\
+                format(num_skipped))
+        # process the runs in groups of one per worker. Before each group,
+        # the descriptors its consensuses can use are added to the index,
+        # i.e. those published by the last fresh_until, and those that none
+        # of them can use are evicted, so that the index holds the
+        # descriptors of about router_max_age rather than of the month.
+        for group_start in xrange(0, len(stale_runs), workers):
+            group = stale_runs[group_start:group_start+workers]
+            periods = [read_consensus_period(pathname) for run in group\
+                for pathname in run]
+            periods = [period for period in periods if (period is not None)]
+            if periods:
+                spool.advance(descriptors, max(fresh_until\
+                    for valid_after, fresh_until in periods))
+                descriptors.evict(min(valid_after\
+                    for valid_after, fresh_until in periods) -\
+                    pathsim.TorOptions.router_max_age)
+            if (workers > 1):
+                # print the output of each run in order
+                tasks = [(run, fat, desc_out_dir, out_format,
+                    keyframe_interval) for run in group]
+                _worker_descriptors = descriptors
+                pool = multiprocessing.Pool(min(workers, len(group)))
+                try:
+                    for run, (outputs, lines) in zip(group,
+                        pool.imap(_process_consensus_files_worker, tasks)):
+                        for line in lines:
+                            print(line)
+                        for pathname, (outpath, period) in zip(run, outputs):
+                            manifest.record_consensus(pathname,
+                                input_states[pathname], outpath, period)
+                        num_consensuses += len(run)
+                    pool.close()
+                finally:
+                    pool.terminate()
+                    pool.join()
+                    _worker_descriptors = None
+            else:
+                for run in group:
+                    outputs = process_consensus_files(run, descriptors, fat,
+                        desc_out_dir, out_format, keyframe_interval,
+                        print_line)
+                    for pathname, (outpath, period) in zip(run, outputs):
+                        manifest.record_consensus(pathname,
+                            input_states[pathname], outpath, period)
+                    num_consensuses += len(run)
                 
         print('# consensuses: {0}'.format(num_consensuses))
+
+        # later consensuses are valid after this month's, so they cannot
+        # use descriptors that have expired by the last of them
+        spool.advance(descriptors)
+        index_entries = manifest.index_entries(pathnames)
+        if index_entries:
+            descriptors.evict(index_entries[-1][0] -\
+                pathsim.TorOptions.router_max_age)
+        network_state_formats.write_network_state_index(desc_out_dir,
+            index_entries)
+        # save descriptors carried over to the next month
+        write_descriptor_index(descriptors, checkpoint_path)
+        manifest.record_checkpoint(file_state(checkpoint_path))
+        prev_checkpoint_path = checkpoint_path
@@ -0,0 +1,160 @@
+### Dense integer relay IDs ###
+# Network state files identify relays by their 40-character fingerprints.
+# During a simulation, create_circuits() instead gives each fingerprint a small
+# integer ID when it is first seen, which stays the same for the whole
+# simulation, and keys its relay data, client guards and circuit paths by
+# these IDs. Descriptors and hibernating statuses, which are looked up for
+# every relay considered when building circuits and assigning streams, are
+# kept in RelayTables, which are lists indexed by ID rather than dicts.
+# The fingerprint and address of a relay are available from its descriptor
+# (i.e. descriptors[relay].fingerprint and descriptors[relay].address), which
+# is how the output callbacks map IDs back when writing output.
+# A DescriptorTable also keeps an index of the families of its relays, with
+# the "$fingerprint" and nickname entries of each family resolved to IDs and
+# only mutual declarations kept, so that family checks are set lookups. As
+# new relays appear in most consensuses, the index is updated only for the
+# relays whose nickname or family changed and the relays that list them.
+
+import collections
+
+
+class RelayIds(object):
+    """Assigns dense integer IDs to relay fingerprints."""
+
+    def __init__(self):
+        self.ids = {}
+        self.fingerprints = []
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def intern(self, fingerprint):
+        """Returns ID of fingerprint, assigning it the next ID if it has
+        none."""
+        relay_id = self.ids.get(fingerprint)
+        if (relay_id is None):
+            relay_id = len(self.fingerprints)
+            self.ids[fingerprint] = relay_id
+            self.fingerprints.append(fingerprint)
+        return relay_id
+
+    def intern_keys(self, relays):
+        """Returns copy of dict relays keyed by fingerprint, keyed by ID
+        instead. New fingerprints are given IDs in sorted order, and the copy
+        is built in that order, so that the IDs and the iteration order of the
+        copy don't depend on the iteration order of relays, which can change
+        when it is pickled (e.g. to send it to another process)."""
+        return dict((self.intern(fingerprint), relays[fingerprint])\
+            for fingerprint in sorted(relays))
+
+    def intern_hibernating_statuses(self, hibernating_statuses):
+        """Returns copy of list of (time, fingerprint, hibernating) statuses
+        with relays given by ID."""
+        return [(hs_time, self.intern(fingerprint), hibernating)\
+            for hs_time, fingerprint, hibernating in hibernating_statuses]
+
+
+class RelayTable(list):
+    """List of values of relays by ID, with None for relays without a value.
+    Supports the dict operations used on relay dicts keyed by fingerprint, so
+    that it can replace them."""
+
+    def __contains__(self, relay_id):
+        return (relay_id < len(self)) and\
+            (list.__getitem__(self, relay_id) is not None)
+
+    def __setitem__(self, relay_id, value):
+        if (relay_id >= len(self)):
+            self.extend([None] * (relay_id + 1 - len(self)))
+        list.__setitem__(self, relay_id, value)
+
+    def get(self, relay_id, default=None):
+        if (relay_id in self):
+            return list.__getitem__(self, relay_id)
+        return default
+
+    def update(self, values):
+        """Sets values of relays from dict values keyed by ID."""
+        for relay_id, value in values.iteritems():
+            self[relay_id] = value
+
+
+class DescriptorTable(RelayTable):
+    """RelayTable of descriptors that keeps the index of relay families
+    needed by pathsim.in_same_family(). Descriptors must be added with
+    update() for the index to be kept up to date."""
+
+    def __init__(self, *args):
+        RelayTable.__init__(self, *args)
+        self.ids_by_fingerprint = {}
+        self.ids_by_nickname = collections.defaultdict(set)
+        # relays whose families have each "$fingerprint" or nickname entry
+        self.listers = collections.defaultdict(set)
+        # relays listed by each relay, by "$fingerprint" or nickname
+        self.listed = {}
+        self.families = {}
+        self.update_families([relay_id for relay_id, desc in enumerate(self)\
+            if (desc is not None)], {})
+
+    def update(self, values):
+        """Sets descriptors of relays from dict values keyed by ID, and
+        updates the family index for relays whose nickname or family
+        changed."""
+        old_descs = {}
+        for relay_id, desc in values.iteritems():
+            old_desc = self.get(relay_id)
+            if (old_desc is None) or (old_desc.nickname != desc.nickname) or\
+                (old_desc.family != desc.family):
+                old_descs[relay_id] = old_desc
+            self[relay_id] = desc
+        if old_descs:
+            self.update_families(sorted(old_descs), old_descs)
+
+    def update_families(self, relay_ids, old_descs):
+        """Updates family index for relays in relay_ids, whose nickname or
+        family may have changed from that of their descriptor in dict
+        old_descs (if any). Only the relays that list or are listed by them
+        are looked at again."""
+        # relays whose listed relays may have changed: the relays themselves
+        # and the relays listing their old or new nicknames or new
+        # fingerprints
+        relisted = set(relay_ids)
+        for relay_id in relay_ids:
+            desc = self[relay_id]
+            old_desc = old_descs.get(relay_id)
+            if (old_desc is None):
+                self.ids_by_fingerprint[desc.fingerprint] = relay_id
+                relisted.update(self.listers.get('$' + desc.fingerprint, ()))
+            else:
+                self.ids_by_nickname[old_desc.nickname].discard(relay_id)
+                relisted.update(self.listers.get(old_desc.nickname, ()))
+                for member in old_desc.family:
+                    self.listers[member].discard(relay_id)
+            self.ids_by_nickname[desc.nickname].add(relay_id)
+            relisted.update(self.listers.get(desc.nickname, ()))
+            for member in desc.family:
+                self.listers[member].add(relay_id)
+        # relays whose families may have changed: the relisted relays and
+        # the relays they listed before or list now
+        refamilied = set(relisted)
+        for relay_id in relisted:
+            refamilied.update(self.listed.get(relay_id, ()))
+            members = set()
+            for member in self[relay_id].family:
+                if (member[0] == '$') and\
+                    (member[1:] in self.ids_by_fingerprint):
+                    members.add(self.ids_by_fingerprint[member[1:]])
+                members.update(self.ids_by_nickname.get(member, ()))
+            if members:
+                self.listed[relay_id] = members
+                refamilied.update(members)
+            else:
+                self.listed.pop(relay_id, None)
+        for relay_id in refamilied:
+            family = frozenset(member for member in\
+                self.listed.get(relay_id, ())\
+                if (relay_id in self.listed.get(member, ())))
+            if family:
+                self.families[relay_id] = family
+            else:
+                self.families.pop(relay_id, None)
@@ -41,7 +41,8 @@
 
 BASE_DIR=/home/ajohnson/research/torps.git
 
-NUM_PROCESSES=20
+TOT_PROCESSES=20
+PARALLEL_PROCESSES=20
 DATE_RANGE=$1
 NSF_TYPE=$2
 OUTPUT="relay-adv"
@@ -59,13 +60,29 @@ PATH_ALG=tor
 EXP_NAME=$USERMODEL.$DATE_RANGE.$ADV_GUARD_BW-$ADV_EXIT_BW-$ADV_TIM-adv
 NSF_DIR=$BASE_DIR/out/network-state/$NSF_TYPE/ns-$DATE_RANGE
 
-# make output directory
 OUT_DIR=$BASE_DIR/out/simulate/$EXP_NAME
+
+# simulate TOT_PROCESSES work units of NUM_SAMPLES samples each, running
+# PARALLEL_PROCESSES at a time (see job_runner.py)
 mkdir -p $OUT_DIR
- 
-i=1
-while [ $i -le $NUM_PROCESSES ]
-do
-    (time pypy pathsim.py simulate --nsf_dir $NSF_DIR --num_samples $NUM_SAMPLES --trace_file $TRACEFILE --user_model $USERMODEL --format $OUTPUT --adv_guard_cons_bw $ADV_GUARD_BW --adv_exit_cons_bw $ADV_EXIT_BW --adv_time $ADV_TIME --num_adv_guards $NUM_ADV_GUARDS --num_adv_exits $NUM_ADV_EXITS --loglevel $LOGLEVEL $PATH_ALG) 2> $OUT_DIR/simulate.$EXP_NAME.$NUM_SAMPLES-samples.$i.time 1> $OUT_DIR/simulate.$EXP_NAME.$NUM_SAMPLES-samples.$i.out &
-    i=$(($i+1))
-done
\ No newline at end of file
+SPEC_FILE=$OUT_DIR/spec.in.json
+cat > $SPEC_FILE <<EOF
+{"name": "$EXP_NAME",
+ "nsf_dir": "$NSF_DIR",
+ "num_samples": $(($TOT_PROCESSES*$NUM_SAMPLES)),
+ "samples_per_unit": $NUM_SAMPLES,
+ "trace_file": "$TRACEFILE",
+ "user_model": "$USERMODEL",
+ "format": "$OUTPUT",
+ "adv_guard_cons_bw": $ADV_GUARD_BW,
+ "adv_exit_cons_bw": $ADV_EXIT_BW,
+ "adv_time": $ADV_TIME,
+ "num_adv_guards": $NUM_ADV_GUARDS,
+ "num_adv_exits": $NUM_ADV_EXITS,
+ "loglevel": "$LOGLEVEL",
+ "pathalg": "$PATH_ALG",
+ "pathalg_args": []}
+EOF
+python job_runner.py submit $SPEC_FILE $OUT_DIR
+python job_runner.py run $OUT_DIR --processes $PARALLEL_PROCESSES --python pypy
+python job_runner.py merge $OUT_DIR
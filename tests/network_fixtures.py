@@ -0,0 +1,189 @@
+### Synthetic network states for the tests ###
+# Writes small network state files in the pickle format written by
+# "pathsim.py process", with relays that exercise path selection: guards,
+# exits, guard-and-exit relays, BadExit and non-Fast/non-Stable relays,
+# relays without ntor onion keys, mutual and one-sided families declared by
+# fingerprint and nickname, relays sharing /16 subnets, a range of exit
+# policies, and hibernating status changes within consensus periods.
+
+import cPickle as pickle
+import datetime
+import os
+import os.path
+import random
+import StringIO
+from stem import Flag
+from stem.exit_policy import ExitPolicy
+import event_callbacks
+import models
+import parallel_simulation
+import pathsim
+import relay_tables
+
+EXIT_POLICIES = ['reject *:*',
+    'accept *:80, accept *:443, reject *:*',
+    'reject *:25, reject *:119, accept *:*',
+    'accept *:*',
+    'reject 74.125.0.0/16:*, accept *:80, reject *:*',
+    'accept 74.125.131.0/24:*, reject *:*',
+    'accept *:6660-6669, accept *:22, reject *:*']
+
+BW_WEIGHTS = {'Wbd':0, 'Wbe':0, 'Wbg':4148, 'Wbm':10000, 'Wdb':10000,
+    'Web':10000, 'Wed':3302, 'Wee':10000, 'Weg':3302, 'Wem':10000,
+    'Wgb':10000, 'Wgd':3395, 'Wgg':5852, 'Wgm':5852, 'Wmb':10000,
+    'Wmd':3302, 'Wme':0, 'Wmg':4148, 'Wmm':10000}
+
+START = datetime.datetime(2013, 8, 1)
+
+# user traces for the user models other than simple
+TRACE_FILE = os.path.join(os.path.dirname(os.path.dirname(\
+    os.path.abspath(__file__))), 'in', 'users2-processed.traces.pickle')
+
+
+def make_relays(num_relays, rng):
+    """Returns list of relays, each a dict of the consensus and descriptor
+    values of a relay."""
+    relays = []
+    for i in xrange(num_relays):
+        flags = [Flag.RUNNING, Flag.VALID]
+        if (rng.random() < 0.9):
+            flags.append(Flag.FAST)
+        if (rng.random() < 0.6):
+            flags.append(Flag.STABLE)
+        position = rng.random()
+        if (position < 0.35):
+            flags.append(Flag.GUARD)
+        elif (position < 0.7):
+            flags.append(Flag.EXIT)
+        elif (position < 0.8):
+            flags.extend([Flag.GUARD, Flag.EXIT])
+        if (rng.random() < 0.03):
+            flags.append(Flag.BADEXIT)
+        address = '{0}.{1}.{2}.{3}'.format(rng.randint(1, 20),
+            rng.randint(0, 3), rng.randint(0, 255), rng.randint(1, 254))
+        relays.append({'fingerprint':'{0:040X}'.format(rng.getrandbits(160)),
+            'nickname':'relay{0}'.format(i),
+            'flags':flags,
+            'bandwidth':rng.randint(10, 20000),
+            'address':address,
+            'exit_policy':rng.choice(EXIT_POLICIES),
+            'ntor_onion_key':('key' if (rng.random() < 0.9) else None),
+            'family':set()})
+    # families of three relays, listing each other by fingerprint and the
+    # first by nickname, with the last family member only listed one way
+    for j in xrange(0, num_relays-3, 11):
+        family = relays[j:j+3]
+        for relay in family[:2]:
+            relay['family'].update(['$' + member['fingerprint'] for member in\
+                family if (member is not relay)])
+            relay['family'].add(family[0]['nickname'])
+    return relays
+
+
+def write_network_state_files(out_dir, num_hours, num_relays, seed=1,
+    gap_hours=(), start=START):
+    """Writes network state files of num_hours consensus periods from start,
+    omitting those in gap_hours, for relays from make_relays().
+    Output:
+        filenames: list of the files written, in time order
+    """
+    rng = random.Random(seed)
+    if (not os.path.exists(out_dir)):
+        os.makedirs(out_dir)
+    relays = make_relays(num_relays, rng)
+    filenames = []
+    for hour in xrange(num_hours):
+        valid_after = start + datetime.timedelta(hours=hour)
+        fresh_until = valid_after + datetime.timedelta(hours=1)
+        cons_rel_stats = {}
+        descriptors = {}
+        hibernating_statuses = []
+        for relay in relays:
+            # relays come and go
+            if (rng.random() < 0.05):
+                continue
+            fprint = relay['fingerprint']
+            cons_rel_stats[fprint] = pathsim.RouterStatusEntry(fprint,
+                relay['nickname'], list(relay['flags']),
+                relay['bandwidth'] + rng.randint(0, 5))
+            descriptors[fprint] = pathsim.ServerDescriptor(fprint, False,
+                relay['nickname'], set(relay['family']), relay['address'],
+                ExitPolicy(*relay['exit_policy'].split(', ')),
+                relay['ntor_onion_key'])
+            hibernating_statuses.append((0, fprint, False))
+            if (rng.random() < 0.02):
+                t = pathsim.timestamp(valid_after) + rng.randint(0, 3000)
+                hibernating_statuses.append((t, fprint, True))
+                hibernating_statuses.append((t + 600, fprint, False))
+        if (hour in gap_hours):
+            continue
+        # statuses are popped from the end, as written by process
+        hibernating_statuses.sort(key=lambda x: x[0], reverse=True)
+        consensus = pathsim.NetworkStatusDocument(valid_after, fresh_until,
+            dict(BW_WEIGHTS), None, cons_rel_stats)
+        filename = os.path.join(out_dir,
+            valid_after.strftime('%Y-%m-%d-%H-%M-%S-network_state'))
+        with open(filename, 'wb') as f:
+            pickle.dump(consensus, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(descriptors, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(hibernating_statuses, f, pickle.HIGHEST_PROTOCOL)
+        filenames.append(filename)
+    return filenames
+
+
+def interned_relays(network_state, relay_ids=None, descriptors=None):
+    """Returns relay statuses and descriptors of network state keyed by
+    relay ID, as create_circuits() keeps them.
+    Output:
+        cons_rel_stats: dict of relay statuses keyed by ID
+        descriptors: DescriptorTable updated with the network state's
+            descriptors
+    """
+    if (relay_ids == None):
+        relay_ids = relay_tables.RelayIds()
+    if (descriptors == None):
+        descriptors = relay_tables.DescriptorTable()
+    cons_rel_stats = relay_ids.intern_keys(network_state.cons_rel_stats)
+    descriptors.update(relay_ids.intern_keys(network_state.descriptors))
+    return (cons_rel_stats, descriptors)
+
+
+def set_num_guards(num_guards):
+    """Sets the guard list size as "pathsim.py simulate --num_guards"
+    does."""
+    pathsim.TorOptions.num_guards = num_guards
+    pathsim.TorOptions.min_num_guards = max(num_guards-1, 1)
+
+
+def simulate(network_state_files, streams, num_samples, seed,
+    first_sample=0, workers=1, format='normal', **kwargs):
+    """Returns output of simulating num_samples samples from first_sample
+    with seed over network state files, as written by "pathsim.py simulate"
+    without its header line. Other keyword arguments are passed on to
+    pathsim.create_circuits()."""
+    out_file = StringIO.StringIO()
+    network_states = pathsim.get_network_states(network_state_files, [])
+    congmodel = models.CongestionModel(None)
+    pdelmodel = models.PropagationDelayModel(None)
+    if (workers > 1):
+        make_callbacks = lambda f: event_callbacks.PrintStreamAssignments(\
+            format, False, file=f)
+        parallel_simulation.simulate(pathsim.create_circuits,
+            network_states, streams, num_samples, congmodel, pdelmodel,
+            make_callbacks, workers, out_file, first_sample, seed=seed,
+            **kwargs)
+    else:
+        callbacks = event_callbacks.PrintStreamAssignments(format, False,
+            file=out_file)
+        pathsim.create_circuits(network_states, streams, num_samples,
+            congmodel, pdelmodel, callbacks, first_sample=first_sample,
+            seed=seed, **kwargs)
+    return out_file.getvalue()
+
+
+def lines_by_sample(output):
+    """Returns dict of the list of output lines of each sample ID."""
+    lines = {}
+    for line in output.splitlines():
+        lines.setdefault(int(line.split('\t', 1)[0]), []).append(line)
+    return lines
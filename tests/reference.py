@@ -0,0 +1,163 @@
+### Reference implementations for the tests ###
+# Straightforward versions of the path selection checks, as pathsim.py had
+# them before they were compiled, indexed and batched: flags are looked up
+# in flag lists, exit policies are checked against stem ExitPolicy objects,
+# and relays are identified by fingerprint. The tests compare the optimized
+# code with these.
+
+from stem import Flag
+from stem.exit_policy import ExitPolicy
+
+
+def stem_policy(desc):
+    """Returns stem ExitPolicy of descriptor, parsed from its string
+    form."""
+    return ExitPolicy(*str(desc.compiled_exit_policy).split(', '))
+
+
+def might_exit_to_port(policy, port):
+    for rule in policy:
+        if (port >= rule.min_port) and (port <= rule.max_port):
+            if rule.is_accept:
+                return True
+            else:
+                if (rule.is_address_wildcard()) or\
+                    (rule.get_masked_bits() == 0):
+                    return False
+    return True
+
+
+def can_exit_to_port(policy, port):
+    for rule in policy:
+        if (port >= rule.min_port) and (port <= rule.max_port):
+            if (rule.is_address_wildcard()) or\
+                (rule.get_masked_bits() == 0):
+                if rule.is_accept:
+                    return True
+                else:
+                    return False
+    return True
+
+
+def policy_is_reject_star(policy):
+    for rule in policy:
+        if rule.is_accept:
+            return False
+        elif (((rule.min_port <= 1) and (rule.max_port == 65535)) or\
+                (rule.is_port_wildcard())) and\
+            ((rule.is_address_wildcard()) or (rule.get_masked_bits == 0)):
+            return True
+    return True
+
+
+def exit_filter(exit, cons_rel_stats, descriptors, fast, stable, internal, ip,
+    port, loose):
+    rel_stat = cons_rel_stats[exit]
+    policy = stem_policy(descriptors[exit])
+    if (Flag.BADEXIT not in rel_stat.flags) and\
+        (Flag.RUNNING in rel_stat.flags) and\
+        (Flag.VALID in rel_stat.flags) and\
+        ((not fast) or (Flag.FAST in rel_stat.flags)) and\
+        ((not stable) or (Flag.STABLE in rel_stat.flags)):
+        if (internal):
+            return True
+        elif (ip != None):
+            return policy.can_exit_to(ip, port)
+        elif (port != None):
+            if (not loose):
+                return can_exit_to_port(policy, port)
+            else:
+                return might_exit_to_port(policy, port)
+        else:
+            return (not policy_is_reject_star(policy))
+    return False
+
+
+def in_same_family(descriptors, node1, node2):
+    desc1 = descriptors[node1]
+    desc2 = descriptors[node2]
+    node1_lists_node2 = False
+    for member in desc1.family:
+        if ((member[0] == '$') and (member[1:] == desc2.fingerprint)) or\
+            (member == desc2.nickname):
+            node1_lists_node2 = True
+    if (node1_lists_node2):
+        for member in desc2.family:
+            if ((member[0] == '$') and (member[1:] == desc1.fingerprint)) or\
+                (member == desc1.nickname):
+                return True
+    return False
+
+
+def in_same_16_subnet(address1, address2):
+    return (address1.split('.')[0:2] == address2.split('.')[0:2])
+
+
+def middle_filter(node, cons_rel_stats, descriptors, fast=None, stable=None,
+    exit_node=None, guard_node=None):
+    rel_stat = cons_rel_stats[node]
+    return (Flag.RUNNING in rel_stat.flags) and\
+        ((fast == None) or (not fast) or (Flag.FAST in rel_stat.flags)) and\
+        ((stable == None) or (not stable) or\
+            (Flag.STABLE in rel_stat.flags)) and\
+        ((exit_node == None) or\
+            ((exit_node != node) and\
+                (not in_same_family(descriptors, exit_node, node)) and\
+                (not in_same_16_subnet(descriptors[exit_node].address,\
+                    descriptors[node].address)))) and\
+        ((guard_node == None) or\
+            ((guard_node != node) and\
+                (not in_same_family(descriptors, guard_node, node)) and\
+                (not in_same_16_subnet(descriptors[guard_node].address,\
+                    descriptors[node].address))))
+
+
+def filter_guards(cons_rel_stats, descriptors):
+    return [fprint for fprint, rel_stat in cons_rel_stats.iteritems()\
+        if (Flag.RUNNING in rel_stat.flags) and\
+            (Flag.VALID in rel_stat.flags) and\
+            (Flag.GUARD in rel_stat.flags) and (fprint in descriptors)]
+
+
+def get_bw_weight(flags, position, bw_weights):
+    if (position == 'g'):
+        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
+            return bw_weights['Wgd']
+        elif (Flag.GUARD in flags):
+            return bw_weights['Wgg']
+        elif (Flag.EXIT not in flags):
+            return bw_weights['Wgm']
+        else:
+            raise ValueError('Wge weight does not exist.')
+    elif (position == 'm'):
+        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
+            return bw_weights['Wmd']
+        elif (Flag.GUARD in flags):
+            return bw_weights['Wmg']
+        elif (Flag.EXIT in flags):
+            return bw_weights['Wme']
+        else:
+            return bw_weights['Wmm']
+    elif (position == 'e'):
+        if (Flag.GUARD in flags) and (Flag.EXIT in flags):
+            return bw_weights['Wed']
+        elif (Flag.GUARD in flags):
+            return bw_weights['Weg']
+        elif (Flag.EXIT in flags):
+            return bw_weights['Wee']
+        else:
+            return bw_weights['Wem']
+    else:
+        raise ValueError('get_weight does not support position {0}.'.format(
+            position))
+
+
+def get_position_weights(nodes, cons_rel_stats, position, bw_weights,
+    bwweightscale):
+    weights = {}
+    for node in nodes:
+        bw = float(cons_rel_stats[node].bandwidth)
+        weight = float(get_bw_weight(cons_rel_stats[node].flags, position,
+            bw_weights)) / float(bwweightscale)
+        weights[node] = bw * weight
+    return weights
@@ -0,0 +1,73 @@
+import datetime
+import shutil
+import tempfile
+import unittest
+import pathsim
+from tests import network_fixtures
+
+
+class EveryMinuteEvents(pathsim.TimedEvents):
+    """TimedEvents that has every minute of the period updated for all
+    clients, as create_circuits() stepped through the period before minutes
+    without events were skipped."""
+
+    def due_clients(self, cur_time, client_states):
+        super(EveryMinuteEvents, self).due_clients(cur_time, client_states)
+        return client_states
+
+    def next_minute(self, cur_time):
+        return min(cur_time + self.time_step, self.period_end)
+
+
+class EventSkippingTest(unittest.TestCase):
+    """Checks that skipping minutes without timed events or streams, and
+    updating only clients whose wake-up time has come, gives the output of
+    updating every client every minute."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        # relays hibernate within periods, and the fourth hour is missing,
+        # over the morning's streams of the typical user model
+        cls.files = pathsim.pad_network_state_files(\
+            network_fixtures.write_network_state_files(cls.dir, 6, 150,
+                seed=4, gap_hours=(3,),
+                start=network_fixtures.START + datetime.timedelta(hours=8)))
+        cls.start_time = pathsim.get_network_state_period(cls.files[0])[0]
+        cls.end_time = pathsim.get_network_state_period(cls.files[-1])[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def setUp(self):
+        self.timed_events = pathsim.TimedEvents
+        network_fixtures.set_num_guards(3)
+
+    def tearDown(self):
+        pathsim.TimedEvents = self.timed_events
+
+    def check_output(self, streams, num_samples, **kwargs):
+        output = network_fixtures.simulate(self.files, streams, num_samples,
+            seed=6, **kwargs)
+        pathsim.TimedEvents = EveryMinuteEvents
+        reference_output = network_fixtures.simulate(self.files, streams,
+            num_samples, seed=6, **kwargs)
+        pathsim.TimedEvents = self.timed_events
+        self.assertTrue(output)
+        self.assertEqual(output, reference_output)
+
+    def test_simple_streams(self):
+        streams = pathsim.get_user_model(self.start_time, self.end_time,
+            session='simple=1800')
+        self.check_output(streams, 6)
+
+    def test_typical_streams(self):
+        streams = pathsim.get_user_model(self.start_time, self.end_time,
+            network_fixtures.TRACE_FILE, session='typical')
+        self.check_output(streams, 3)
+        self.check_output(streams, 3, batch=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import cPickle as pickle
+import shutil
+import tempfile
+import unittest
+from stem.exit_policy import ExitPolicy
+import exit_policies
+import pathsim
+from tests import network_fixtures
+from tests import reference
+
+POLICIES = network_fixtures.EXIT_POLICIES + [
+    'reject 0.0.0.0/8:*, reject 169.254.0.0/16:*, accept *:80-443, reject *:*',
+    'accept 10.0.0.0/255.0.0.0:*, reject *:*',
+    'reject *:1-1024, accept *:*',
+    'accept 74.125.131.105:443, reject 74.125.0.0/16:*, accept *:443, reject *:*',
+    'reject 0.0.0.0/0:80, accept *:*',
+    'accept [2001:db8::]/32:*, reject *:*']
+
+ADDRESSES = [None, '74.125.131.105', '74.125.1.1', '10.1.2.3', '169.254.3.4',
+    '1.2.3.4', '2001:db8::1', '2001:db9::1']
+
+# ports at and around the port boundaries of the policies
+PORTS = sorted(set([1, 2, 21, 22, 23, 24, 25, 26, 79, 80, 81, 118, 119, 120,
+    442, 443, 444, 1023, 1024, 1025, 6659, 6660, 6665, 6669, 6670, 8080,
+    65534, 65535]))
+
+
+class CompiledExitPolicyTest(unittest.TestCase):
+    """Checks compiled exit policies against stem and the port checks
+    pathsim made on stem policies."""
+
+    def test_port_checks(self):
+        for policy_str in POLICIES:
+            stem_policy = ExitPolicy(*policy_str.split(', '))
+            compiled = exit_policies.compile_exit_policy(policy_str)
+            self.assertEqual(compiled.is_reject_star(),
+                reference.policy_is_reject_star(stem_policy), policy_str)
+            for port in PORTS:
+                self.assertEqual(compiled.can_exit_to_port(port),
+                    reference.can_exit_to_port(stem_policy, port),
+                    (policy_str, port))
+                self.assertEqual(compiled.might_exit_to_port(port),
+                    reference.might_exit_to_port(stem_policy, port),
+                    (policy_str, port))
+
+    def test_can_exit_to(self):
+        for policy_str in POLICIES:
+            stem_policy = ExitPolicy(*policy_str.split(', '))
+            compiled = exit_policies.compile_exit_policy(policy_str)
+            for address in ADDRESSES:
+                for port in [None] + PORTS:
+                    # twice, the second time from the cache
+                    for i in xrange(2):
+                        self.assertEqual(compiled.can_exit_to(address, port),
+                            stem_policy.can_exit_to(address, port),
+                            (policy_str, address, port))
+
+    def test_interning(self):
+        for policy_str in POLICIES:
+            compiled = exit_policies.compile_exit_policy(policy_str)
+            self.assertIs(exit_policies.compile_exit_policy(\
+                ExitPolicy(*policy_str.split(', '))), compiled)
+            self.assertIs(pickle.loads(pickle.dumps(compiled,
+                pickle.HIGHEST_PROTOCOL)), compiled)
+            self.assertEqual(str(compiled.to_stem()), str(compiled))
+        # policy strings that stem writes differently are compiled once
+        num_policies = len(exit_policies._compiled_policies)
+        policy_str = 'accept 10.0.0.0/255.0.0.0:*, reject *:*'
+        compiled = exit_policies.compile_exit_policy(policy_str)
+        self.assertNotEqual(compiled.policy_str, policy_str)
+        self.assertIs(exit_policies._policy_aliases[policy_str], compiled)
+        self.assertIs(exit_policies.compile_exit_policy(policy_str), compiled)
+        self.assertEqual(len(exit_policies._compiled_policies), num_policies)
+        self.assertEqual(sorted(policy.policy_id for policy in\
+            exit_policies._compiled_policies.itervalues()),
+            range(num_policies))
+
+
+class ExitFilterTest(unittest.TestCase):
+    """Checks the exits pathsim filters for ports and streams against
+    checking every relay's stem exit policy."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        ns_file = network_fixtures.write_network_state_files(cls.dir, 1,
+            200)[0]
+        cls.network_state = pathsim.get_network_state(ns_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def reference_exits(self, fast, stable, internal, ip, port, loose):
+        cons_rel_stats = self.network_state.cons_rel_stats
+        return [relay for relay in cons_rel_stats\
+            if reference.exit_filter(relay, cons_rel_stats,
+                self.network_state.descriptors, fast, stable, internal, ip,
+                port, loose)]
+
+    def test_filter_exits(self):
+        cons_rel_stats = self.network_state.cons_rel_stats
+        descriptors = self.network_state.descriptors
+        for fast in (False, True):
+            for stable in (False, True):
+                for port in [None] + PORTS:
+                    self.assertEqual(pathsim.filter_exits(cons_rel_stats,
+                        descriptors, fast, stable, False, None, port),
+                        self.reference_exits(fast, stable, False, None, port,
+                            False))
+                    self.assertEqual(pathsim.filter_exits_loose(\
+                        cons_rel_stats, descriptors, fast, stable, False,
+                        None, port),
+                        self.reference_exits(fast, stable, False, None, port,
+                            True))
+                self.assertEqual(pathsim.filter_exits(cons_rel_stats,
+                    descriptors, fast, stable, True, None, None),
+                    self.reference_exits(fast, stable, True, None, None,
+                        False))
+                for ip in ADDRESSES[1:6]:
+                    self.assertEqual(pathsim.filter_exits(cons_rel_stats,
+                        descriptors, fast, stable, False, ip, 443),
+                        self.reference_exits(fast, stable, False, ip, 443,
+                            False))
+
+    def test_stream_exits(self):
+        network_state = self.network_state
+        exact_exits_cache = pathsim.ExactExitsCache()
+        for port in [80, 443, 22, 6667]:
+            stream = {'time':0, 'type':'connect', 'port':port}
+            port_exits = pathsim.get_stream_port_weighted_exits(port,
+                stream, network_state.cons_rel_stats,
+                network_state.descriptors, network_state.cons_bw_weights,
+                network_state.cons_bwweightscale)
+            stable = (port in pathsim.TorOptions.long_lived_ports)
+            self.assertEqual(port_exits.items, self.reference_exits(True,
+                stable, False, None, port, True))
+            for ip in ADDRESSES[1:6]:
+                stream['ip'] = ip
+                # twice, the second time from the cache
+                for i in xrange(2):
+                    exits = pathsim.get_stream_weighted_exits(stream,
+                        port_exits, exact_exits_cache,
+                        network_state.cons_rel_stats,
+                        network_state.descriptors,
+                        network_state.cons_bw_weights,
+                        network_state.cons_bwweightscale)
+                    self.assertEqual(exits.items,
+                        [exit for exit in port_exits.items\
+                            if reference.exit_filter(exit,
+                                network_state.cons_rel_stats,
+                                network_state.descriptors, True, stable,
+                                False, ip, port, False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
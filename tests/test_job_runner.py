@@ -0,0 +1,96 @@
+import os
+import os.path
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import job_runner
+from tests import network_fixtures
+
+PATHSIM_PATH = os.path.join(os.path.dirname(os.path.dirname(\
+    os.path.abspath(__file__))), 'pathsim.py')
+
+
+class JobRunnerTest(unittest.TestCase):
+    """Checks that experiments run as work units merge into the output of a
+    single simulation, and the handling of the units' states."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.nsf_dir = os.path.join(cls.dir, 'nsf')
+        network_fixtures.write_network_state_files(cls.nsf_dir, 3, 100,
+            seed=6)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def setUp(self):
+        self.exp_dir = tempfile.mkdtemp(dir=self.dir)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def spec(self, **kwargs):
+        spec = {'name':'test', 'nsf_dir':self.nsf_dir,
+            'user_model':'simple=300', 'format':'normal', 'num_guards':3,
+            'num_samples':7, 'samples_per_unit':3, 'seed':11}
+        spec.update(kwargs)
+        return spec
+
+    def test_single_simulation_output(self):
+        spec = self.spec()
+        self.assertEqual(job_runner.submit(spec, self.exp_dir), 3)
+        self.assertRaises(ValueError, job_runner.merge, self.exp_dir)
+        job_runner.run(self.exp_dir, processes=2, python=sys.executable,
+            poll_interval=1)
+        self.assertEqual(job_runner.status(self.exp_dir),
+            {'pending':0, 'running':0, 'done':3, 'failed':0})
+        with open(job_runner.merge(self.exp_dir)) as f:
+            merged = f.read()
+        command = [sys.executable, PATHSIM_PATH, 'simulate', '--nsf_dir',
+            spec['nsf_dir'], '--user_model', spec['user_model'], '--format',
+            spec['format'], '--num_guards', str(spec['num_guards']),
+            '--num_samples', str(spec['num_samples']), '--seed',
+            str(spec['seed']), 'tor']
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(command, stderr=devnull,
+                cwd=os.path.dirname(PATHSIM_PATH))
+        self.assertEqual(len(merged.splitlines()), 1 + 7 * 36)
+        self.assertEqual(merged, output)
+
+    def test_stale_units(self):
+        job_runner.submit(self.spec(max_attempts=2), self.exp_dir)
+        # a unit claimed from pending isn't stale, however long ago its file
+        # was last written
+        filename = job_runner.unit_filename(self.exp_dir, 'pending', 0)
+        os.utime(filename, (time.time() - 3600, time.time() - 3600))
+        self.assertTrue(job_runner.move_unit(self.exp_dir, 0, 'pending',
+            'running'))
+        job_runner.requeue_stale_units(self.exp_dir, 60)
+        self.assertEqual(job_runner.list_units(self.exp_dir, 'running'), [0])
+        # a running unit that isn't touched is requeued until it has used
+        # its attempts
+        time.sleep(0.1)
+        job_runner.requeue_stale_units(self.exp_dir, 0.05)
+        self.assertEqual(job_runner.list_units(self.exp_dir, 'pending'),
+            [0, 1, 2])
+        unit = job_runner.read_json(job_runner.unit_filename(self.exp_dir,
+            'pending', 0))
+        self.assertEqual(unit['attempts'], 1)
+        self.assertEqual(len(unit['errors']), 1)
+        job_runner.move_unit(self.exp_dir, 0, 'pending', 'running')
+        time.sleep(0.1)
+        job_runner.requeue_stale_units(self.exp_dir, 0.05)
+        self.assertEqual(job_runner.list_units(self.exp_dir, 'failed'), [0])
+        self.assertRaises(ValueError, job_runner.merge, self.exp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+import network_state_cache
+import network_state_formats
+import pathsim
+from tests import network_fixtures
+from tests.test_network_state_formats import network_state_values
+
+
+class SharedNetworkStateCacheTest(unittest.TestCase):
+    """Checks that network states read through the shared cache are those of
+    the network state files, with values read from the shared cache
+    entries."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.files = network_fixtures.write_network_state_files(\
+            os.path.join(cls.dir, 'pickle'), 3, 100)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def test_read(self):
+        cache_dir = os.path.join(self.dir, 'cache')
+        cache = network_state_cache.SharedNetworkStateCache(cache_dir)
+        entries = []
+        for ns_file in self.files:
+            network_state = cache.read(ns_file)
+            self.assertEqual(network_state_values(network_state),
+                network_state_values(pathsim.get_network_state(ns_file)))
+            entry = cache.entry_path(ns_file)
+            for desc in network_state.descriptors.itervalues():
+                self.assertTrue(isinstance(desc,
+                    network_state_formats.ColumnarDescriptor))
+                self.assertEqual(desc.state.path, entry)
+            for rel_stat in network_state.cons_rel_stats.itervalues():
+                self.assertTrue(isinstance(rel_stat,
+                    network_state_formats.ColumnarRelayStatus))
+            entries.append((entry, os.stat(entry).st_mtime))
+        # another process reads the entries already in the cache
+        other_cache = network_state_cache.SharedNetworkStateCache(cache_dir)
+        for ns_file, (entry, mtime) in zip(self.files, entries):
+            self.assertEqual(other_cache.add(ns_file), entry)
+            self.assertEqual(os.stat(entry).st_mtime, mtime)
+            self.assertEqual(network_state_values(other_cache.read(ns_file)),
+                network_state_values(pathsim.get_network_state(ns_file)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import cPickle as pickle
+import os.path
+import shutil
+import tempfile
+import unittest
+import models
+import network_state_formats
+import pathsim
+from tests import network_fixtures
+
+
+def network_state_values(network_state):
+    """Returns the values of network state used in simulation, in a form
+    that compares equal for equal network states."""
+    relays = dict((fprint, (rel_stat.nickname, frozenset(rel_stat.flags),
+        rel_stat.bandwidth, rel_stat.flag_mask))\
+        for fprint, rel_stat in network_state.cons_rel_stats.iteritems())
+    descriptors = dict((fprint, (desc.hibernating, desc.nickname,
+        frozenset(desc.family), desc.address, str(desc.compiled_exit_policy),
+        desc.ntor_onion_key))\
+        for fprint, desc in network_state.descriptors.iteritems())
+    return (network_state.cons_valid_after, network_state.cons_fresh_until,
+        network_state.cons_bw_weights, network_state.cons_bwweightscale,
+        relays, descriptors, list(network_state.hibernating_statuses))
+
+
+class MappedFilesRecorder(object):
+    """Callbacks recording the columnar files that the descriptors kept by
+    the simulation are read from in each network state."""
+
+    def __init__(self):
+        self.paths = []
+
+    def set_network_state(self, cons_valid_after, cons_fresh_until,
+        cons_bw_weights, cons_bwweightscale, cons_rel_stats, descriptors):
+        self.paths.append(set(desc.state.path for desc in descriptors\
+            if isinstance(desc, network_state_formats.ColumnarDescriptor)))
+
+    def set_sample_id(self, id):
+        pass
+
+    def circuit_creation(self, circuit):
+        pass
+
+    def stream_assignment(self, stream, circuit):
+        pass
+
+
+class NetworkStateFormatsTest(unittest.TestCase):
+    """Checks that the columnar and delta formats read back the network
+    states of the pickle files they were written from."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.files = network_fixtures.write_network_state_files(\
+            os.path.join(cls.dir, 'pickle'), 6, 120)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def test_columnar_round_trip(self):
+        for ns_file in self.files:
+            network_state = pathsim.get_network_state(ns_file)
+            path = os.path.join(self.dir, os.path.basename(ns_file) + '.col')
+            network_state_formats.write_columnar_network_state(path,
+                network_state.cons_valid_after,
+                network_state.cons_fresh_until,
+                network_state.cons_bw_weights,
+                network_state.cons_bwweightscale,
+                network_state.cons_rel_stats, network_state.descriptors,
+                network_state.hibernating_statuses)
+            self.assertTrue(network_state_formats.is_columnar_file(path))
+            self.assertEqual(pathsim.get_network_state_period(path),
+                pathsim.get_network_state_period(ns_file))
+            col_network_state = pathsim.get_network_state(path)
+            self.assertEqual(network_state_values(col_network_state),
+                network_state_values(network_state))
+            # the relays are views of the mapped file, which are pickled
+            # by reference to it
+            for desc in col_network_state.descriptors.itervalues():
+                self.assertTrue(isinstance(desc,
+                    network_state_formats.ColumnarDescriptor))
+                self.assertEqual(desc.subnet_16,
+                    network_state.descriptors[desc.fingerprint].subnet_16)
+            unpickled = pickle.loads(pickle.dumps(col_network_state,
+                pickle.HIGHEST_PROTOCOL))
+            self.assertEqual(network_state_values(unpickled),
+                network_state_values(network_state))
+            self.assertEqual(len(set(id(desc.state) for desc in\
+                unpickled.descriptors.itervalues())), 1)
+            # detached descriptors are copies
+            detached = dict((fprint,
+                network_state_formats.detach_descriptor(desc))\
+                for fprint, desc in col_network_state.descriptors.iteritems())
+            self.assertTrue(all(isinstance(desc, pathsim.ServerDescriptor)\
+                for desc in detached.itervalues()))
+            col_network_state.descriptors = detached
+            self.assertEqual(network_state_values(col_network_state),
+                network_state_values(network_state))
+
+    def test_delta_round_trip(self):
+        delta_dir = os.path.join(self.dir, 'delta')
+        os.makedirs(delta_dir)
+        # keyframe, then deltas each from the file before
+        shutil.copy(self.files[0], delta_dir)
+        delta_files = [os.path.join(delta_dir,
+            os.path.basename(self.files[0]))]
+        base = pathsim.get_network_state(self.files[0])
+        for ns_file in self.files[1:]:
+            network_state = pathsim.get_network_state(ns_file)
+            path = os.path.join(delta_dir, os.path.basename(ns_file))
+            network_state_formats.write_network_state_delta(path,
+                os.path.basename(delta_files[-1]),
+                network_state.cons_valid_after,
+                network_state.cons_fresh_until,
+                network_state.cons_bw_weights, None, base.cons_rel_stats,
+                base.descriptors, network_state.cons_rel_stats,
+                network_state.descriptors,
+                network_state.hibernating_statuses)
+            delta_files.append(path)
+            base = network_state
+        # read in sequence, applying each delta in place
+        reader = network_state_formats.NetworkStateReader()
+        for ns_file, delta_file in zip(self.files, delta_files):
+            self.assertEqual(network_state_values(reader.read(delta_file)),
+                network_state_values(pathsim.get_network_state(ns_file)))
+        # read on its own, from the keyframe
+        self.assertEqual(\
+            network_state_values(pathsim.get_network_state(delta_files[-1])),
+            network_state_values(pathsim.get_network_state(self.files[-1])))
+
+    def test_columnar_simulation(self):
+        # simulating columnar files gives the output of the pickle files
+        col_dir = os.path.join(self.dir, 'columnar')
+        os.makedirs(col_dir)
+        col_files = []
+        for ns_file in self.files:
+            network_state = pathsim.get_network_state(ns_file)
+            path = os.path.join(col_dir, os.path.basename(ns_file))
+            network_state_formats.write_columnar_network_state(path,
+                network_state.cons_valid_after,
+                network_state.cons_fresh_until,
+                network_state.cons_bw_weights, None,
+                network_state.cons_rel_stats, network_state.descriptors,
+                network_state.hibernating_statuses)
+            col_files.append(path)
+        start_time, end_time = pathsim.get_network_state_period(\
+            self.files[0])[0], pathsim.get_network_state_period(\
+            self.files[-1])[1]
+        streams = pathsim.get_user_model(start_time, end_time,
+            session='simple=300')
+        network_fixtures.set_num_guards(3)
+        output = network_fixtures.simulate(self.files, streams, 8, seed=5)
+        self.assertEqual(\
+            network_fixtures.simulate(col_files, streams, 8, seed=5), output)
+        self.assertEqual(network_fixtures.simulate(col_files, streams, 8,
+            seed=5, workers=2), output)
+        # descriptors kept from earlier network states don't keep their
+        # files mapped
+        recorder = MappedFilesRecorder()
+        pathsim.create_circuits(pathsim.get_network_states(col_files, []),
+            streams, 2, models.CongestionModel(None),
+            models.PropagationDelayModel(None), recorder, seed=5)
+        self.assertEqual(recorder.paths, [set([path]) for path in col_files])
+
+
+if __name__ == '__main__':
+    unittest.main()
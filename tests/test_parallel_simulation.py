@@ -0,0 +1,134 @@
+import datetime
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+import models
+import parallel_simulation
+import pathsim
+from tests import network_fixtures
+
+
+class CircuitRecorder(object):
+    """Callbacks recording the sample ID of each circuit created, with the
+    key of the pass over the clients that created it."""
+
+    def __init__(self):
+        self.key = None
+        self.sample_id = None
+        self.circuits = []
+
+    def start_segment(self, key):
+        self.key = key
+
+    def set_network_state(self, cons_valid_after, cons_fresh_until,
+        cons_bw_weights, cons_bwweightscale, cons_rel_stats, descriptors):
+        pass
+
+    def set_sample_id(self, id):
+        self.sample_id = id
+
+    def circuit_creation(self, circuit):
+        self.circuits.append((self.key, self.sample_id))
+
+    def stream_assignment(self, stream, circuit):
+        pass
+
+
+def killed_worker(network_states, streams, num_samples, congmodel,
+    pdelmodel, callbacks, first_sample=0, **kwargs):
+    """Stands in for create_circuits() in a worker that is killed."""
+    for network_state in network_states:
+        if (first_sample > 0):
+            os._exit(1)
+
+
+class ParallelSimulationTest(unittest.TestCase):
+    """Checks that a seeded simulation outputs the same paths for each
+    sample however its samples are divided among processes and runs."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.files = network_fixtures.write_network_state_files(cls.dir, 4,
+            120, seed=5,
+            start=network_fixtures.START + datetime.timedelta(hours=8))
+        start_time = pathsim.get_network_state_period(cls.files[0])[0]
+        end_time = pathsim.get_network_state_period(cls.files[-1])[1]
+        cls.streams = pathsim.get_user_model(start_time, end_time,
+            network_fixtures.TRACE_FILE, session='typical')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def setUp(self):
+        network_fixtures.set_num_guards(3)
+
+    def test_workers(self):
+        output = network_fixtures.simulate(self.files, self.streams, 7,
+            seed=8)
+        self.assertTrue(output)
+        self.assertEqual(network_fixtures.simulate(self.files, self.streams,
+            7, seed=8, workers=3), output)
+        self.assertEqual(network_fixtures.simulate(self.files, self.streams,
+            7, seed=8, workers=3, format='relay-adv'),
+            network_fixtures.simulate(self.files, self.streams, 7, seed=8,
+                format='relay-adv'))
+
+    def test_split_samples(self):
+        lines = network_fixtures.lines_by_sample(network_fixtures.simulate(\
+            self.files, self.streams, 7, seed=8))
+        split_lines = {}
+        for first_sample, num_samples in ((0, 2), (2, 1), (3, 4)):
+            split_lines.update(network_fixtures.lines_by_sample(\
+                network_fixtures.simulate(self.files, self.streams,
+                    num_samples, seed=8, first_sample=first_sample)))
+        self.assertEqual(sorted(lines), range(7))
+        self.assertEqual(split_lines, lines)
+        # other seeds give other paths
+        self.assertNotEqual(network_fixtures.lines_by_sample(\
+            network_fixtures.simulate(self.files, self.streams, 7, seed=9)),
+            lines)
+
+    def test_batch(self):
+        # batched draws are shared by the samples simulated together, and so
+        # are reproduced by simulating the same samples with the same seed
+        for workers in (1, 2):
+            output = network_fixtures.simulate(self.files, self.streams, 4,
+                seed=8, workers=workers, batch=True)
+            self.assertTrue(output)
+            self.assertEqual(network_fixtures.simulate(self.files,
+                self.streams, 4, seed=8, workers=workers, batch=True), output)
+
+    def test_batch_client_order(self):
+        # passes over the clients create circuits in order of sample ID,
+        # which the merged output of workers relies on, also when batched
+        for batch in (False, True):
+            recorder = CircuitRecorder()
+            pathsim.create_circuits(pathsim.get_network_states(self.files,
+                []), self.streams, 5, models.CongestionModel(None),
+                models.PropagationDelayModel(None), recorder, batch=batch,
+                seed=8)
+            self.assertTrue(recorder.circuits)
+            self.assertEqual(recorder.circuits, sorted(recorder.circuits))
+            # some passes create several circuits for a client
+            self.assertTrue(any((recorder.circuits[i] ==\
+                recorder.circuits[i+1])\
+                for i in xrange(len(recorder.circuits)-1)))
+
+    def test_killed_worker(self):
+        poll_interval = parallel_simulation.WORKER_POLL_INTERVAL
+        parallel_simulation.WORKER_POLL_INTERVAL = 0.1
+        try:
+            self.assertRaises(RuntimeError, parallel_simulation.simulate,
+                killed_worker, pathsim.get_network_states(self.files, []),
+                self.streams, 4, None, None, lambda f: CircuitRecorder(), 2,
+                StringIO.StringIO())
+        finally:
+            parallel_simulation.WORKER_POLL_INTERVAL = poll_interval
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import argparse
+import cPickle as pickle
+import random
+import shutil
+import socket
+import tempfile
+import unittest
+import network_modifiers
+import pathsim
+from tests import network_fixtures
+from tests import reference
+
+
+class GuardOrderTest(unittest.TestCase):
+    """Checks that clients keep their guards in the order they were added,
+    as in Tor's guard list, rather than in the order of relay IDs."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.files = network_fixtures.write_network_state_files(cls.dir, 4,
+            150, seed=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def setUp(self):
+        self.get_new_guard = pathsim.get_new_guard
+        self.get_guards_for_circ = pathsim.get_guards_for_circ
+
+    def tearDown(self):
+        pathsim.get_new_guard = self.get_new_guard
+        pathsim.get_guards_for_circ = self.get_guards_for_circ
+
+    def test_guard_order(self):
+        # guards added to each client's guard list, by id() of the list
+        added = {}
+        calls = []
+
+        def get_new_guard(bw_weights, bwweightscale, cons_rel_stats,
+            descriptors, client_guards, *args, **kwargs):
+            new_guard = self.get_new_guard(bw_weights, bwweightscale,
+                cons_rel_stats, descriptors, client_guards, *args, **kwargs)
+            guard_order = added.setdefault(id(client_guards), [])
+            if (new_guard in guard_order):
+                guard_order.remove(new_guard)
+            guard_order.append(new_guard)
+            return new_guard
+
+        def get_guards_for_circ(bw_weights, bwweightscale, cons_rel_stats,
+            descriptors, fast, stable, guards, *args, **kwargs):
+            circ_guards = self.get_guards_for_circ(bw_weights, bwweightscale,
+                cons_rel_stats, descriptors, fast, stable, guards, *args,
+                **kwargs)
+            guard_order = [guard for guard in added[id(guards)]\
+                if (guard in guards)]
+            self.assertEqual(list(guards), guard_order)
+            self.assertEqual(circ_guards, [guard for guard in guard_order\
+                if (guard in circ_guards)])
+            calls.append(guard_order)
+            return circ_guards
+
+        pathsim.get_new_guard = get_new_guard
+        pathsim.get_guards_for_circ = get_guards_for_circ
+        network_fixtures.set_num_guards(3)
+        start_time = pathsim.get_network_state_period(self.files[0])[0]
+        end_time = pathsim.get_network_state_period(self.files[-1])[1]
+        streams = pathsim.get_user_model(start_time, end_time,
+            session='simple=300')
+        network_fixtures.simulate(self.files, streams, 6, seed=3)
+        # the guards were added out of relay ID order
+        self.assertTrue(calls)
+        self.assertTrue(any((guard_order != sorted(guard_order))\
+            for guard_order in calls))
+
+
+class RelayFlagsTest(unittest.TestCase):
+    """Checks flag bitmasks and position weights looked up by flag class
+    against the flag lists they replace."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.ns_file = network_fixtures.write_network_state_files(cls.dir, 1,
+            200)[0]
+        cls.network_state = pathsim.get_network_state(cls.ns_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def test_flag_masks(self):
+        rng = random.Random(6)
+        for i in xrange(100):
+            flags = rng.sample(pathsim.RELAY_FLAGS,
+                rng.randint(0, len(pathsim.RELAY_FLAGS)))
+            mask = pathsim.flags_to_mask(flags + ['Unknown'])
+            self.assertEqual(sorted(pathsim.mask_to_flags(mask)),
+                sorted(flags))
+        for rel_stat in self.network_state.cons_rel_stats.itervalues():
+            self.assertEqual(rel_stat.flag_mask,
+                pathsim.flags_to_mask(rel_stat.flags))
+
+    def test_filter_guards(self):
+        self.assertEqual(pathsim.filter_guards(\
+            self.network_state.cons_rel_stats, self.network_state.descriptors),
+            reference.filter_guards(self.network_state.cons_rel_stats,
+                self.network_state.descriptors))
+
+    def test_position_weights(self):
+        network_state = self.network_state
+        cons_rel_stats = network_state.cons_rel_stats
+        guards = reference.filter_guards(cons_rel_stats,
+            network_state.descriptors)
+        for position, nodes in (('g', guards), ('m', cons_rel_stats.keys()),
+            ('e', cons_rel_stats.keys())):
+            self.assertEqual(pathsim.get_position_weights(nodes,
+                cons_rel_stats, position, network_state.cons_bw_weights,
+                network_state.cons_bwweightscale),
+                reference.get_position_weights(nodes, cons_rel_stats,
+                    position, network_state.cons_bw_weights,
+                    network_state.cons_bwweightscale))
+        exit_only = [relay for relay, rel_stat in cons_rel_stats.iteritems()\
+            if (rel_stat.flag_mask & pathsim.WEIGHT_CLASS_MASK ==\
+                pathsim.EXIT_MASK)]
+        self.assertRaises(ValueError, pathsim.get_position_weights,
+            exit_only[:1], cons_rel_stats, 'g', network_state.cons_bw_weights,
+            network_state.cons_bwweightscale)
+        self.assertRaises(ValueError, pathsim.get_position_weights,
+            guards, cons_rel_stats, 'x', network_state.cons_bw_weights,
+            network_state.cons_bwweightscale)
+
+    def test_guard_threshold(self):
+        network_state = pathsim.get_network_state(self.ns_file)
+        bandwidths = sorted(rel_stat.bandwidth for rel_stat in\
+            network_state.cons_rel_stats.itervalues())
+        threshold = bandwidths[len(bandwidths)//2]
+        args = argparse.Namespace(other_network_modifier=\
+            'network_modifiers.RaiseGuardConsBWThreshold-{0}'.format(threshold))
+        network_modifiers.RaiseGuardConsBWThreshold(args,
+            False).modify_network_state(network_state)
+        for rel_stat in network_state.cons_rel_stats.itervalues():
+            self.assertEqual(rel_stat.flag_mask,
+                pathsim.flags_to_mask(rel_stat.flags))
+            if (rel_stat.bandwidth < threshold):
+                self.assertFalse(rel_stat.flag_mask & pathsim.GUARD_MASK)
+
+
+class SubnetTest(unittest.TestCase):
+    """Checks /16 subnet comparisons against comparing the first two
+    octets of address strings."""
+
+    def test_addresses(self):
+        rng = random.Random(8)
+        addresses = ['{0}.{1}.{2}.{3}'.format(rng.choice([1, 10, 128, 255]),
+            rng.choice([0, 1, 255]), rng.randint(0, 255), rng.randint(0, 255))\
+            for i in xrange(60)]
+        descriptors = [pathsim.ServerDescriptor(str(i), False, str(i), set(),
+            address, 'reject *:*', None) for i, address in\
+            enumerate(addresses)]
+        descriptors = pickle.loads(pickle.dumps(descriptors,
+            pickle.HIGHEST_PROTOCOL))
+        for desc1 in descriptors:
+            for desc2 in descriptors:
+                same_subnet = reference.in_same_16_subnet(desc1.address,
+                    desc2.address)
+                self.assertEqual(pathsim.in_same_16_subnet(desc1.address,
+                    desc2.address), same_subnet)
+                self.assertEqual((desc1.subnet_16 == desc2.subnet_16),
+                    same_subnet)
+
+    def test_adversary_addresses(self):
+        # adversary relays have reserved addresses in distinct /16 subnets,
+        # also past 255 of them
+        adversary = network_modifiers.AdversaryInsertion(0, 160, 1000, 161,
+            1000, False)
+        addresses = [desc.address for desc in\
+            adversary.adv_descriptors.itervalues()]
+        self.assertEqual(len(addresses), network_modifiers.MAX_ADV_RELAYS)
+        for address in addresses:
+            socket.inet_aton(address)
+            octets = [int(octet) for octet in address.split('.')]
+            self.assertTrue(all((0 <= octet <= 255) for octet in octets))
+            self.assertTrue((octets[0] == 10) or\
+                ((octets[0] == 100) and (64 <= octets[1] < 128)) or\
+                ((octets[0] == 198) and (18 <= octets[1] < 20)), address)
+        self.assertEqual(len(set(tuple(address.split('.')[0:2])\
+            for address in addresses)), len(addresses))
+        subnets = set(desc.subnet_16 for desc in\
+            adversary.adv_descriptors.itervalues())
+        self.assertEqual(len(subnets), len(addresses))
+        # there are no more reserved /16 subnets to give further relays
+        self.assertRaises(ValueError, network_modifiers.adv_address,
+            network_modifiers.MAX_ADV_RELAYS + 1)
+        self.assertRaises(ValueError, network_modifiers.AdversaryInsertion,
+            0, 161, 1000, 161, 1000, False)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import pathsim
+import process_consensuses
+
+
+class DescriptorSpoolTest(unittest.TestCase):
+    """Checks that adding spooled descriptors in time order while evicting
+    those that can no longer be used leaves the index that adding all of them
+    at once does."""
+
+    def test_advance(self):
+        rng = random.Random(3)
+        fingerprints = ['{0:040X}'.format(i) for i in xrange(30)]
+        # descriptors in no particular time order, with some duplicates
+        records = []
+        for i in xrange(500):
+            records.append((rng.choice(fingerprints), rng.randint(0, 1000),
+                i))
+        records.extend(rng.sample(records, 20))
+        spool = process_consensuses.DescriptorSpool(True, run_size=64)
+        reference = process_consensuses.DescriptorIndex(True)
+        for fprint, t, desc in records:
+            spool.add(fprint, t, desc)
+            reference.add(fprint, t, desc)
+        self.assertEqual(len(spool.run_files), len(records) // 64)
+        self.assertTrue(fingerprints[0] in spool)
+
+        descriptors = process_consensuses.DescriptorIndex(True)
+        max_sizes = []
+        for max_time in xrange(100, 1000, 100):
+            spool.advance(descriptors, max_time)
+            self.assertTrue(all((times[-1] <= max_time)\
+                for times in descriptors.times.itervalues()))
+            descriptors.evict(max_time - 150)
+            max_sizes.append(sum(len(times) for times in\
+                descriptors.times.itervalues()))
+        spool.advance(descriptors)
+        descriptors.evict(900)
+        reference.evict(900)
+        self.assertEqual(descriptors.times, reference.times)
+        self.assertEqual(descriptors.descriptors, reference.descriptors)
+        # only a window of the descriptors was held at once
+        self.assertTrue(max(max_sizes) < len(records) // 2)
+        self.assertRaises(ValueError, spool.add, fingerprints[0], 0, 0)
+
+
+class ConsensusPeriodTest(unittest.TestCase):
+    """Checks reading the period of a consensus from its header."""
+
+    def test_read_consensus_period(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            pathname = os.path.join(out_dir, 'consensus')
+            with open(pathname, 'w') as f:
+                f.write('@type network-status-consensus-3 1.0\n'\
+                    'network-status-version 3\nvote-status consensus\n'\
+                    'consensus-method 9\nvalid-after 2013-08-02 21:00:00\n'\
+                    'fresh-until 2013-08-02 22:00:00\n'\
+                    'valid-until 2013-08-03 00:00:00\n')
+            self.assertEqual(process_consensuses.read_consensus_period(\
+                pathname), (pathsim.timestamp_from_string('2013-08-02-21'),
+                pathsim.timestamp_from_string('2013-08-02-22')))
+            with open(pathname, 'w') as f:
+                f.write('network-status-version 3\nr relay ...\n')
+            self.assertEqual(process_consensuses.read_consensus_period(\
+                pathname), None)
+        finally:
+            shutil.rmtree(out_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
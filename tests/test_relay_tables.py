@@ -0,0 +1,132 @@
+import cPickle as pickle
+import random
+import shutil
+import tempfile
+import unittest
+import pathsim
+import relay_tables
+from tests import network_fixtures
+from tests import reference
+
+
+class Descriptor(object):
+    """Descriptor with the values used by family checks."""
+
+    def __init__(self, fingerprint, nickname, family):
+        self.fingerprint = fingerprint
+        self.nickname = nickname
+        self.family = family
+
+
+class RelayIdsTest(unittest.TestCase):
+    """Checks that relay IDs don't depend on the iteration order of the
+    relay dicts they are assigned from."""
+
+    def test_intern_keys(self):
+        rng = random.Random(1)
+        fingerprints = ['{0:040X}'.format(rng.getrandbits(160))\
+            for i in xrange(200)]
+        relays = dict((fprint, i) for i, fprint in enumerate(fingerprints))
+        # the same relays, with dicts of different iteration order
+        shuffled = list(fingerprints)
+        rng.shuffle(shuffled)
+        shuffled_relays = {}
+        for fprint in shuffled:
+            shuffled_relays[fprint] = relays[fprint]
+        copies = []
+        for relay_dict in (relays, shuffled_relays,
+            pickle.loads(pickle.dumps(shuffled_relays,
+                pickle.HIGHEST_PROTOCOL))):
+            relay_ids = relay_tables.RelayIds()
+            interned = relay_ids.intern_keys(relay_dict)
+            self.assertEqual(relay_ids.fingerprints, sorted(fingerprints))
+            copies.append(interned.items())
+        self.assertEqual(copies[1], copies[0])
+        self.assertEqual(copies[2], copies[0])
+
+    def test_intern(self):
+        relay_ids = relay_tables.RelayIds()
+        first = relay_ids.intern_keys({'B':1, 'A':2})
+        second = relay_ids.intern_keys({'C':3, 'A':4})
+        self.assertEqual(first, {0:2, 1:1})
+        self.assertEqual(second, {0:4, 2:3})
+        self.assertEqual(relay_ids.intern('D'), 3)
+        self.assertEqual(relay_ids.intern('B'), 1)
+        self.assertEqual(relay_ids.fingerprints, ['A', 'B', 'C', 'D'])
+        self.assertEqual(len(relay_ids), 4)
+        self.assertEqual(relay_ids.intern_hibernating_statuses(\
+            [(10, 'C', True), (0, 'E', False)]), [(10, 2, True), (0, 4, False)])
+
+
+class RelayTableTest(unittest.TestCase):
+    """Checks that RelayTables act as the relay dicts they replace."""
+
+    def test_dict_operations(self):
+        table = relay_tables.RelayTable()
+        table[3] = 'c'
+        table.update({0:'a', 5:'e'})
+        self.assertEqual([relay_id for relay_id in xrange(8)\
+            if (relay_id in table)], [0, 3, 5])
+        self.assertEqual(table[3], 'c')
+        self.assertEqual(table.get(1), None)
+        self.assertEqual(table.get(7, 'x'), 'x')
+        self.assertEqual(table.get(5, 'x'), 'e')
+
+
+class DescriptorTableTest(unittest.TestCase):
+    """Checks the family index kept by DescriptorTable against the family
+    declarations of the descriptors."""
+
+    def check_families(self, descriptors):
+        # the index kept through updates is the one built from scratch
+        self.assertEqual(descriptors.families,
+            relay_tables.DescriptorTable(list(descriptors)).families)
+        relays = [relay_id for relay_id in xrange(len(descriptors))\
+            if (relay_id in descriptors)]
+        for relay1 in relays:
+            for relay2 in relays:
+                self.assertEqual(pathsim.in_same_family(descriptors, relay1,
+                    relay2), reference.in_same_family(descriptors, relay1,
+                    relay2))
+
+    def test_random_updates(self):
+        # relays change nicknames and families, which may list relays by
+        # fingerprints and nicknames not seen yet and shared nicknames
+        rng = random.Random(7)
+        fingerprints = ['{0:040X}'.format(i) for i in xrange(40)]
+        nicknames = ['relay{0}'.format(i) for i in xrange(15)]
+        for trial in xrange(20):
+            descriptors = relay_tables.DescriptorTable()
+            for step in xrange(10):
+                values = {}
+                for i in xrange(rng.randint(0, 10)):
+                    relay_id = rng.randrange(len(fingerprints))
+                    family = set()
+                    for j in xrange(rng.randint(0, 5)):
+                        if (rng.random() < 0.5):
+                            family.add('$' + rng.choice(fingerprints))
+                        else:
+                            family.add(rng.choice(nicknames))
+                    values[relay_id] = Descriptor(fingerprints[relay_id],
+                        rng.choice(nicknames), family)
+                descriptors.update(values)
+                self.check_families(descriptors)
+
+    def test_network_states(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            files = network_fixtures.write_network_state_files(out_dir, 3,
+                120)
+            relay_ids = relay_tables.RelayIds()
+            descriptors = relay_tables.DescriptorTable()
+            for ns_file in files:
+                network_fixtures.interned_relays(\
+                    pathsim.get_network_state(ns_file), relay_ids, descriptors)
+                self.assertTrue(descriptors.families)
+                self.check_families(descriptors)
+        finally:
+            shutil.rmtree(out_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
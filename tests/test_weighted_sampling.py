@@ -0,0 +1,144 @@
+from fractions import Fraction
+import random
+import shutil
+import tempfile
+import unittest
+import pathsim
+import weighted_sampling
+from tests import network_fixtures
+from tests import reference
+
+
+class FixedRandom(object):
+    """Random number generator whose randrange() returns a given value."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def randrange(self, stop):
+        assert (0 <= self.value < stop)
+        return self.value
+
+
+def alias_probabilities(sampler):
+    """Returns dict of the probability of drawing each item of AliasSampler,
+    computed from its tables."""
+    probs = dict((item, 0.0) for item in sampler.items)
+    for i in xrange(sampler.n):
+        probs[sampler.items[i]] += sampler.prob[i] / sampler.n
+        probs[sampler.items[sampler.alias[i]]] +=\
+            (1.0 - sampler.prob[i]) / sampler.n
+    return probs
+
+
+class AliasSamplerTest(unittest.TestCase):
+    """Checks that samplers draw items in proportion to their weights."""
+
+    def test_probabilities(self):
+        rng = random.Random(3)
+        weight_lists = [[1], [5, 0, 5], [1, 2, 3, 4], [0.25, 0.5, 1e-10, 3.0],
+            [rng.randint(0, 20000) for i in xrange(500)],
+            [rng.random() * rng.randint(1, 10000) for i in xrange(500)]]
+        for weights in weight_lists:
+            items = range(len(weights))
+            probs = alias_probabilities(weighted_sampling.AliasSampler(items,
+                weights))
+            total = Fraction(sum(Fraction(weight) for weight in weights))
+            for item, weight in zip(items, weights):
+                self.assertAlmostEqual(probs[item],
+                    float(Fraction(weight) / total), places=12)
+
+    def test_zero_total(self):
+        self.assertRaises(ValueError, weighted_sampling.AliasSampler,
+            ['a', 'b'], [0, 0])
+
+    def test_sample_excluding(self):
+        # drawing every target of randrange() draws each item not excluded
+        # as many times as its weight
+        rng = random.Random(4)
+        for trial in xrange(50):
+            n = rng.randint(1, 30)
+            items = ['item{0}'.format(i) for i in xrange(n)]
+            weights = [rng.randint(0, 6) for i in xrange(n)]
+            if (sum(weights) == 0):
+                weights[0] = 1
+            sampler = weighted_sampling.ConditionalSampler(items, weights)
+            excluded = set(rng.sample(items, rng.randint(0, n-1)))
+            excluded.add('not drawn')
+            if (sum(weight for item, weight in zip(items, weights)\
+                if (item not in excluded)) == 0):
+                self.assertRaises(ValueError, sampler.exclusion, excluded)
+                continue
+            exclusion = sampler.exclusion(excluded)
+            counts = dict((item, 0) for item in items)
+            for target in xrange(exclusion[0]):
+                counts[sampler.sample_excluding(exclusion,
+                    FixedRandom(target))] += 1
+            for item, weight in zip(items, weights):
+                self.assertEqual(counts[item],
+                    (0 if (item in excluded) else weight))
+
+
+class WeightedMiddlesTest(unittest.TestCase):
+    """Checks that the middles drawn for circuits are the middles passing
+    middle_filter() as pathsim checked it for each draw."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        ns_file = network_fixtures.write_network_state_files(cls.dir, 1,
+            300)[0]
+        cls.network_state = pathsim.get_network_state(ns_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def check_middles(self, cons_rel_stats, descriptors):
+        network_state = self.network_state
+        middles = [relay for relay in cons_rel_stats\
+            if pathsim.middle_filter(relay, cons_rel_stats, descriptors)]
+        weights = pathsim.get_position_weights(middles, cons_rel_stats, 'm',
+            network_state.cons_bw_weights, network_state.cons_bwweightscale)
+        weighted_middles = pathsim.get_weighted_middles(middles, weights,
+            cons_rel_stats, descriptors)
+        guards = reference.filter_guards(cons_rel_stats, descriptors)
+        exits = [relay for relay in cons_rel_stats\
+            if reference.exit_filter(relay, cons_rel_stats, descriptors,
+                False, False, False, None, None, True)]
+        rng = random.Random(5)
+        circuits = [(None, None)] +\
+            [(rng.choice(exits), rng.choice(guards)) for i in xrange(20)] +\
+            [(exit, None) for exit in exits if descriptors[exit].family] +\
+            [(None, guard) for guard in guards if descriptors[guard].family]
+        for exit, guard in circuits:
+            for fast in (False, True):
+                for stable in (False, True):
+                    sampler, exclusion = weighted_middles.circuit_exclusion(\
+                        fast, stable, exit, guard)
+                    passing = [middle for middle in middles\
+                        if reference.middle_filter(middle, cons_rel_stats,
+                            descriptors, fast, stable, exit, guard)]
+                    # the weight left after exclusion is that of the
+                    # passing middles
+                    self.assertEqual(exclusion[0],
+                        sum(sampler.weights[sampler.index[middle]]\
+                            for middle in passing if (middle in\
+                                sampler.index)))
+                    passing = set(passing)
+                    for i in xrange(20):
+                        self.assertIn(weighted_middles.sample_middle(fast,
+                            stable, exit, guard, rng), passing)
+
+    def test_fingerprint_middles(self):
+        self.check_middles(self.network_state.cons_rel_stats,
+            self.network_state.descriptors)
+
+    def test_relay_id_middles(self):
+        cons_rel_stats, descriptors = network_fixtures.interned_relays(\
+            self.network_state)
+        self.check_middles(cons_rel_stats, descriptors)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -306,13 +306,13 @@ def create_circuit(cons_rel_stats, cons_valid_after, cons_fresh_until,
         circ_port: (int) desired TCP port (None if not known)
         congmodel: congestion model
         pdelmodel: propagation delay model
-        weighted_exits: (list) (middle, cum_weight) pairs for exit position
+        weighted_exits: (AliasSampler) weighted exits, see get_weighted_nodes()
         exits_exact: (bool) Is weighted_exits exact or does it need rechecking?
             weighed_exits is special because exits are chosen first and thus
             don't depend on the other circuit positions, and so potentially are        
             precomputed exactly.
-        weighted_middles: (list) (middle, cum_weight) pairs for middle position
-        weighted_guards: (list) (middle, cum_weight) pairs for middle position
+        weighted_middles: (AliasSampler) weighted middles
+        weighted_guards: (AliasSampler) weighted guards
         callbacks: object w/ method circuit_creation(circuit)        
     Output:
         circuit: (dict) a newly created circuit with keys
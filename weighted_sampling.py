@@ -0,0 +1,141 @@
+### Weighted random selection of relays ###
+# Relays are selected with probability proportional to their position-
+# weighted bandwidths. An AliasSampler is built once per list of relays
+# (e.g. the guards of a consensus) with Vose's alias method, after which
+# each draw takes constant time and a single call to random(), rather than
+# a binary search over cumulative probabilities. The table is built from
+# the weights scaled exactly to integers, so the weights are never
+# normalized by floating division and no rounding accumulates over the
+# list.
+# A ConditionalSampler can also draw relays conditioned on not drawing a given
+# set of excluded relays (e.g. those in the family of a circuit's exit),
+# rather than drawing until the relay drawn isn't excluded. It keeps the
+# cumulative integer weights, draws from the weight remaining after removing
+# the excluded relays, and maps the draw back onto the cumulative weights by
+# adding the weight of the excluded relays before it, which are found by
+# binary search.
+# Draws are made from the given random number generator, by default the random
+# module, so that each sample of a simulation can draw from its own stream.
+
+from array import array
+from bisect import bisect_right
+import random
+
+
+def integer_weights(weights):
+    """Returns list of integers proportional to the given int, long or float
+    weights, computed exactly."""
+    if all(isinstance(weight, (int, long)) for weight in weights):
+        return list(weights)
+    # floats are integers over powers of two
+    ratios = [float(weight).as_integer_ratio() for weight in weights]
+    denominator = max([den for num, den in ratios] + [1])
+    return [num * (denominator // den) for num, den in ratios]
+
+
+class AliasSampler(object):
+    """Draws items with probability proportional to non-negative weights,
+    using Vose's alias method."""
+
+    def __init__(self, items, weights):
+        """
+        Inputs:
+            items: list of items to draw
+            weights: list of weight of each item, with positive total
+        """
+        n = len(items)
+        scaled = integer_weights(weights)
+        total = sum(scaled)
+        if (total <= 0):
+            raise ValueError('Weights must have positive total.')
+        # probability of keeping each column's own item, else take alias
+        self.items = list(items)
+        self.prob = array('d', [1.0]) * n
+        self.alias = array('l', range(n))
+        self.n = n
+        # compare each item's weight times n with the total, i.e. mean of 1
+        scaled = [weight * n for weight in scaled]
+        small = []
+        large = []
+        for i in xrange(n-1, -1, -1):
+            if (scaled[i] < total):
+                small.append(i)
+            else:
+                large.append(i)
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = float(scaled[s]) / total
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - total
+            if (scaled[l] < total):
+                small.append(l)
+            else:
+                large.append(l)
+        # columns remaining in either list are full up to rounding
+
+    def __len__(self):
+        return self.n
+
+    def sample(self, rng=random):
+        """Returns item randomly drawn using random number generator rng."""
+        u = rng.random() * self.n
+        i = int(u)
+        if ((u - i) < self.prob[i]):
+            return self.items[i]
+        return self.items[self.alias[i]]
+
+
+class ConditionalSampler(AliasSampler):
+    """AliasSampler that can also draw items conditioned on not drawing any of
+    a set of excluded items, without rejection."""
+
+    def __init__(self, items, weights):
+        """
+        Inputs:
+            items: list of items to draw
+            weights: list of weight of each item, with positive total
+        """
+        AliasSampler.__init__(self, items, weights)
+        self.weights = integer_weights(weights)
+        self.index = dict((item, i) for i, item in enumerate(self.items))
+        # cumulative[i] is the total weight of items 0 to i
+        self.cumulative = []
+        total = 0
+        for weight in self.weights:
+            total += weight
+            self.cumulative.append(total)
+        self.total = total
+
+    def exclusion(self, excluded):
+        """Returns exclusion of excluded items for sample_excluding().
+        Excluded items that aren't drawn by the sampler are ignored.
+        Output:
+            exclusion: (remaining, starts, skips), where remaining is the
+                total weight of the items not excluded, starts lists where
+                each excluded item would start in the cumulative weight of the
+                items not excluded, and skips lists the total weight of the
+                excluded items up to and including each one
+        """
+        positions = sorted(set(self.index[item] for item in excluded\
+            if (item in self.index)))
+        starts = []
+        skips = [0]
+        for i in positions:
+            if (self.weights[i] > 0):
+                starts.append(self.cumulative[i] - self.weights[i] -\
+                    skips[-1])
+                skips.append(skips[-1] + self.weights[i])
+        remaining = self.total - skips[-1]
+        if (remaining <= 0):
+            raise ValueError('Excluded items have all of the weight.')
+        return (remaining, starts, skips)
+
+    def sample_excluding(self, exclusion, rng=random):
+        """Returns item not excluded by exclusion randomly drawn using random
+        number generator rng."""
+        remaining, starts, skips = exclusion
+        target = rng.randrange(remaining)
+        # skip over the excluded items starting at or before target
+        target += skips[bisect_right(starts, target)]
+        return self.items[bisect_right(self.cumulative, target)]